@@ -0,0 +1,69 @@
+import asyncio
+from collections import Counter, deque
+from conf import MAX_IN_FLIGHT_REQUESTS, MAX_QUEUED_REQUESTS, \
+    QUEUE_TIMEOUT
+
+
+class AdmissionController:
+    '''
+    Limits the number of requests processed at once.
+    When all slots are busy up to max_queued requests wait for a slot
+    for at most queue_timeout seconds, the rest are shed right away.
+    Shed requests are counted by reason
+    '''
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT_REQUESTS,
+                 max_queued: int = MAX_QUEUED_REQUESTS,
+                 queue_timeout: float = QUEUE_TIMEOUT) -> None:
+        self._max_in_flight = max_in_flight
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+        self._waiters = deque()
+        self.in_flight = 0
+        self.shed = Counter()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def record_shed(self, reason: str) -> None:
+        self.shed[reason] += 1
+
+    async def enter(self) -> bool:
+        '''
+        Takes a slot for a request, returns False if the request
+        has to be rejected
+        '''
+        if self.in_flight < self._max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return True
+        if len(self._waiters) >= self._max_queued:
+            self.record_shed('overloaded')
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self._queue_timeout)
+        except asyncio.TimeoutError:
+            self.record_shed('queue_timeout')
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was already handed over to us
+                self.leave()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return True
+
+    def leave(self) -> None:
+        '''
+        Frees the slot, handing it over to the first waiting request
+        '''
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
@@ -0,0 +1,52 @@
+import argparse
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+from storage import FilePhoneBook, DURABILITY_NONE, DURABILITY_FSYNC, \
+    DURABILITY_GROUP
+
+
+async def bench_writes(durability: str, writes: int, concurrency: int,
+                       names: int) -> dict:
+    '''
+    Makes writes to FilePhoneBook with the given durability mode
+    from concurrency tasks and returns the throughput
+    '''
+    folder = tempfile.mkdtemp(dir='.')
+    storage = FilePhoneBook(folder, durability=durability)
+    counter = iter(range(writes))
+
+    async def writer():
+        for i in counter:
+            await storage.write(f'name {i % names}', [f'7{i:010d}'])
+
+    started = time.perf_counter()
+    await asyncio.gather(*[writer() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    await storage.close()
+    shutil.rmtree(folder)
+    return {'durability': durability, 'writes': writes,
+            'concurrency': concurrency, 'seconds': round(elapsed, 3),
+            'writes_per_second': round(writes / elapsed)}
+
+
+async def main(args: argparse.Namespace) -> None:
+    for durability in args.modes:
+        result = await bench_writes(durability, args.writes,
+                                    args.concurrency, args.names)
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures FilePhoneBook write throughput '
+                    'for each durability mode')
+    parser.add_argument('--writes', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--names', type=int, default=1000)
+    parser.add_argument('--modes', nargs='+',
+                        default=[DURABILITY_NONE, DURABILITY_FSYNC,
+                                 DURABILITY_GROUP])
+    asyncio.run(main(parser.parse_args()))
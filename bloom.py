@@ -0,0 +1,237 @@
+import asyncio
+import math
+from conf import logger, BLOOM_CAPACITY, BLOOM_ERROR_RATE, \
+    BLOOM_REBUILD_INTERVAL
+from metrics import REGISTRY, SNAPSHOT_RESTORED
+from storage import Storage, name_digest
+
+
+LOOKUPS = REGISTRY.counter(
+    'rksok_bloom_lookups_total',
+    'Lookups in the bloom filter by result: absent names answered without '
+    'the storage, present ones and false positives', ('result',))
+
+
+class BloomFilter:
+    '''
+    Set of name digests that may answer 'maybe' for a digest
+    never added, with probability error_rate while it holds
+    no more than capacity of them, but never 'no' for an added one
+    '''
+    def __init__(self, capacity: int = BLOOM_CAPACITY,
+                 error_rate: float = BLOOM_ERROR_RATE) -> None:
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self._bits = max(8, int(-capacity * math.log(error_rate) /
+                                math.log(2) ** 2))
+        self._hashes = max(1, round(self._bits / capacity * math.log(2)))
+        self._array = bytearray((self._bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: bytes):
+        # the digest is sha256, so its parts are independent hashes
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._bits
+
+    def add(self, digest: bytes) -> None:
+        for position in self._positions(digest):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(digest))
+
+    def to_state(self) -> dict:
+        return {'capacity': self.capacity, 'bits': self._bits,
+                'hashes': self._hashes, 'count': self.count,
+                'array': bytes(self._array)}
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'BloomFilter':
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.capacity = state['capacity']
+        bloom_filter._bits = state['bits']
+        bloom_filter._hashes = state['hashes']
+        bloom_filter.count = state['count']
+        bloom_filter._array = bytearray(state['array'])
+        if len(bloom_filter._array) != (bloom_filter._bits + 7) // 8:
+            raise ValueError('Bloom filter state does not match its size')
+        return bloom_filter
+
+
+class BloomStorage(Storage):
+    '''
+    Keeps a bloom filter of the names in any Storage, so lookups
+    and deletes of names that were never written are answered
+    with FileNotFoundError without touching the storage.
+    The filter is built from storage.scan_keys() on open() unless
+    it is restored from a snapshot, names are added on write and it is
+    rebuilt every rebuild_interval seconds (or as soon as it is over
+    capacity) to forget the deleted ones.
+    Until the first build finishes every call goes to the storage
+    '''
+    def __init__(self, storage: Storage,
+                 capacity: int = BLOOM_CAPACITY,
+                 error_rate: float = BLOOM_ERROR_RATE,
+                 rebuild_interval: float = BLOOM_REBUILD_INTERVAL) -> None:
+        self._storage = storage
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._rebuild_interval = rebuild_interval
+        self._filter = None
+        # names written while a rebuild scans the storage
+        self._written = None
+        # number of writes in progress by name
+        self._in_flight = {}
+        self._rebuild_needed = None
+        self._rebuild_task = None
+
+    @property
+    def inner(self) -> Storage:
+        return self._storage
+
+    @property
+    def filter(self) -> BloomFilter | None:
+        return self._filter
+
+    def _absent(self, digest: bytes) -> bool:
+        if self._filter is None:
+            return False
+        if digest in self._filter:
+            return False
+        LOOKUPS.inc(result='absent')
+        return True
+
+    async def get(self, name: str) -> str:
+        digest = name_digest(name)
+        if self._absent(digest):
+            raise FileNotFoundError(name)
+        try:
+            contents = await self._storage.get(name)
+        except FileNotFoundError:
+            if self._filter is not None:
+                LOOKUPS.inc(result='false_positive')
+            raise
+        LOOKUPS.inc(result='present')
+        return contents
+
+    async def write(self, name: str, phones: list) -> None:
+        '''
+        Adds the name to the filter before writing it, so a read
+        that sees the new file never gets NOTFOUND from the filter
+        '''
+        digest = name_digest(name)
+        if self._filter is not None:
+            self._filter.add(digest)
+            if self._filter.count > self._filter.capacity and \
+                    self._rebuild_needed is not None:
+                self._rebuild_needed.set()
+        if self._written is not None:
+            self._written.add(digest)
+        self._in_flight[digest] = self._in_flight.get(digest, 0) + 1
+        try:
+            await self._storage.write(name, phones)
+        finally:
+            writes = self._in_flight.pop(digest) - 1
+            if writes:
+                self._in_flight[digest] = writes
+
+    async def delete(self, name: str) -> None:
+        '''
+        Deletes the name from the storage, the filter forgets it
+        on the next rebuild
+        '''
+        if self._absent(name_digest(name)):
+            raise FileNotFoundError(name)
+        await self._storage.delete(name)
+
+    async def scan_keys(self) -> list:
+        return await self._storage.scan_keys()
+
+    async def snapshot(self, clean: bool) -> dict:
+        '''
+        Keeps the filter only when the storage can not change anymore,
+        writes made while a snapshot is taken could be missing from it
+        '''
+        state = {'storage': await self._storage.snapshot(clean)}
+        if clean and self._filter is not None:
+            state['filter'] = self._filter.to_state()
+        return state
+
+    async def restore(self, state: dict | None) -> bool:
+        '''
+        Takes the filter of the snapshot if the storage
+        has not changed since
+        '''
+        if state is None:
+            return False
+        unchanged = await self._storage.restore(state['storage'])
+        if unchanged and state.get('filter') is not None:
+            self._filter = BloomFilter.from_state(state['filter'])
+            SNAPSHOT_RESTORED.set(self._filter.count,
+                                  component='bloom_filter')
+        return unchanged
+
+    async def rebuild(self) -> None:
+        '''
+        Builds a new filter from the names in the storage,
+        the names written during the scan and the ones still being
+        written, which the scan may have missed
+        '''
+        if self._written is not None:
+            return
+        self._written = set()
+        try:
+            keys = await self._storage.scan_keys()
+            bloom_filter = BloomFilter(
+                max(self._capacity, 2 * (len(keys) + len(self._written) +
+                                         len(self._in_flight))),
+                self._error_rate)
+            for digest in keys:
+                bloom_filter.add(digest)
+            for digest in self._written:
+                bloom_filter.add(digest)
+            for digest in self._in_flight:
+                bloom_filter.add(digest)
+        finally:
+            self._written = None
+        self._filter = bloom_filter
+        logger.info(f'Bloom filter rebuilt with {bloom_filter.count} names')
+
+    async def _run_rebuilds(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._rebuild_needed.wait(),
+                                       self._rebuild_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._rebuild_needed.clear()
+            try:
+                await self.rebuild()
+            except OSError:
+                logger.exception('Could not rebuild the bloom filter')
+
+    async def open(self) -> None:
+        '''
+        Opens the storage, builds the filter and starts the rebuilds
+        '''
+        await self._storage.open()
+        if self._filter is None:
+            await self.rebuild()
+        if self._rebuild_task is None and self._rebuild_interval:
+            self._rebuild_needed = asyncio.Event()
+            self._rebuild_task = asyncio.create_task(self._run_rebuilds())
+
+    async def close(self) -> None:
+        if self._rebuild_task is not None:
+            self._rebuild_task.cancel()
+            try:
+                await self._rebuild_task
+            except asyncio.CancelledError:
+                pass
+            self._rebuild_task = None
+            self._rebuild_needed = None
+        await self._storage.close()
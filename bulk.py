@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import time
+from conf import logger, STORAGE_BACKEND, BULK_PARALLELISM, \
+    BULK_CHECKPOINT_EVERY, BULK_REPORT_INTERVAL
+from logstorage import PUT, iter_records, make_record
+from server import make_backend
+from storage import Storage
+
+
+class Progress:
+    '''
+    Counts the names done by a bulk run and logs the throughput
+    every report_interval seconds
+    '''
+    def __init__(self, action: str, done: int = 0,
+                 report_interval: float = BULK_REPORT_INTERVAL) -> None:
+        self._action = action
+        self._report_interval = report_interval
+        self._started = self._reported = time.monotonic()
+        self._done_before = done
+        self.done = done
+        self.skipped = 0
+
+    @property
+    def rate(self) -> float:
+        '''
+        Names per second done by this run
+        '''
+        elapsed = time.monotonic() - self._started
+        return (self.done - self._done_before) / elapsed if elapsed else 0.0
+
+    def add(self, done: int, skipped: int = 0) -> None:
+        self.done += done
+        self.skipped += skipped
+        if time.monotonic() - self._reported >= self._report_interval:
+            self.report()
+
+    def report(self) -> None:
+        self._reported = time.monotonic()
+        logger.info(f'{self._action}: {self.done} names done, '
+                    f'{self.skipped} skipped, {self.rate:.0f} names/s')
+
+
+def read_checkpoint(path: str | None) -> dict | None:
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path: str | None, state: dict) -> None:
+    '''
+    Replaces the checkpoint at once, so a crash leaves
+    either the old or the new one
+    '''
+    if path is None:
+        return
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _sync(f) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+async def _get(storage: Storage, key: bytes) -> str | None:
+    try:
+        return await storage.get_key(key)
+    except FileNotFoundError:
+        # deleted after the keys were scanned
+        return None
+
+
+async def export_storage(storage: Storage, dump_path: str,
+                         parallelism: int = BULK_PARALLELISM,
+                         checkpoint_path: str | None = None,
+                         checkpoint_every: int = BULK_CHECKPOINT_EVERY,
+                         report_interval: float = BULK_REPORT_INTERVAL
+                         ) -> Progress:
+    '''
+    Writes every name of the storage to the dump as a logstorage record
+    of its name_digest and phones, reading up to parallelism names
+    at once. Names are exported in the order of their keys, so a run
+    stopped after a checkpoint resumes from the last checkpointed key
+    with the dump cut back to the checkpointed size.
+    Only the keys are held in memory, not the phones
+    '''
+    keys = sorted(await storage.scan_keys())
+    state = read_checkpoint(checkpoint_path)
+    progress = Progress('Export', state['done'] if state else 0,
+                        report_interval)
+    if state:
+        keys = keys[bisect.bisect_right(keys, bytes.fromhex(state['key'])):]
+        logger.info(f'Resuming the export to {dump_path} after '
+                    f'{progress.done} names')
+    with open(dump_path, 'r+b' if state else 'wb') as f:
+        if state:
+            f.truncate(state['offset'])
+            f.seek(state['offset'])
+        since_checkpoint = 0
+        for start in range(0, len(keys), parallelism):
+            batch = keys[start:start + parallelism]
+            values = await asyncio.gather(
+                *[_get(storage, key) for key in batch])
+            for key, value in zip(batch, values):
+                if value is not None:
+                    f.write(make_record(PUT, key, value.encode()))
+            skipped = values.count(None)
+            progress.add(len(batch) - skipped, skipped)
+            since_checkpoint += len(batch)
+            if since_checkpoint >= checkpoint_every:
+                _sync(f)
+                write_checkpoint(checkpoint_path, {
+                    'key': batch[-1].hex(), 'offset': f.tell(),
+                    'done': progress.done})
+                since_checkpoint = 0
+        _sync(f)
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    progress.report()
+    return progress
+
+
+async def import_dump(storage: Storage, dump_path: str,
+                      parallelism: int = BULK_PARALLELISM,
+                      checkpoint_path: str | None = None,
+                      checkpoint_every: int = BULK_CHECKPOINT_EVERY,
+                      report_interval: float = BULK_REPORT_INTERVAL
+                      ) -> Progress:
+    '''
+    Writes the names of the dump to the storage, up to parallelism
+    of them at once. A run stopped after a checkpoint resumes
+    from the checkpointed offset of the dump, the names written after
+    the checkpoint are written again. A torn or corrupted record
+    ends the import with an error
+    '''
+    state = read_checkpoint(checkpoint_path)
+    progress = Progress('Import', state['done'] if state else 0,
+                        report_interval)
+    offset = state['offset'] if state else 0
+    if state:
+        logger.info(f'Resuming the import of {dump_path} from offset '
+                    f'{offset} after {progress.done} names')
+    since_checkpoint = 0
+
+    async def write(batch: list, next_offset: int) -> None:
+        nonlocal since_checkpoint
+        await asyncio.gather(*[storage.write_key(key, [value.decode()])
+                               for key, value in batch])
+        progress.add(len(batch))
+        since_checkpoint += len(batch)
+        if since_checkpoint >= checkpoint_every:
+            write_checkpoint(checkpoint_path, {'offset': next_offset,
+                                               'done': progress.done})
+            since_checkpoint = 0
+
+    with open(dump_path, 'rb') as f:
+        records = iter_records(f, offset)
+        batch = []
+        while True:
+            try:
+                record_offset, record_type, key, _, value = next(records)
+            except StopIteration as end:
+                offset = end.value
+                break
+            if len(batch) >= parallelism:
+                await write(batch, record_offset)
+                batch = []
+            if record_type == PUT:
+                batch.append((key, value))
+        if batch:
+            await write(batch, offset)
+        size = os.fstat(f.fileno()).st_size
+    if offset != size:
+        raise ValueError(f'Dump {dump_path} has a torn or corrupted record '
+                         f'at {offset}, the names before it are imported')
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    progress.report()
+    return progress
+
+
+async def run(action: str, storage: Storage, dump_path: str,
+              **kwargs) -> Progress:
+    await storage.open()
+    try:
+        if action == 'export':
+            return await export_storage(storage, dump_path, **kwargs)
+        return await import_dump(storage, dump_path, **kwargs)
+    finally:
+        await storage.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Exports the phonebook storage to a dump '
+                    'or imports a dump into it')
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('dump')
+    parser.add_argument('--backend', choices=('file', 'log', 'sqlite'),
+                        default=STORAGE_BACKEND)
+    parser.add_argument('--path', help='folder or file of the storage, '
+                                       'the configured one by default')
+    parser.add_argument('--parallelism', type=int, default=BULK_PARALLELISM)
+    parser.add_argument('--checkpoint',
+                        help='checkpoint file to resume the run from, '
+                             'DUMP.checkpoint by default')
+    parser.add_argument('--checkpoint-every', type=int,
+                        default=BULK_CHECKPOINT_EVERY)
+    parser.add_argument('--report-interval', type=float,
+                        default=BULK_REPORT_INTERVAL)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    asyncio.run(run(
+        args.action, make_backend(args.backend, args.path), args.dump,
+        parallelism=args.parallelism,
+        checkpoint_path=args.checkpoint or f'{args.dump}.checkpoint',
+        checkpoint_every=args.checkpoint_every,
+        report_interval=args.report_interval))
@@ -0,0 +1,281 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+from conf import logger, PROTOCOL, RequestVerb, ResponseStatus, \
+    CLUSTER_NODES, CLUSTER_NODE, CLUSTER_SECRET, CLUSTER_REPLICAS, \
+    CLUSTER_VNODES, CLUSTER_TIMEOUT
+from metrics import REGISTRY
+from regagent import RegAgentPool
+from storage import Storage, format_phones, name_digest
+
+
+CLUSTER_PROTOCOL = 'РКСОК-КЛАСТЕР/1.0'
+# the node that owns the name replicates the call,
+# a replica only applies it to its own storage
+ROLE_OWNER = 'ВЛАДЕЛЕЦ'
+ROLE_REPLICA = 'КОПИЯ'
+
+FORWARDED = REGISTRY.counter(
+    'rksok_cluster_forwarded_total',
+    'Storage calls sent to other nodes by verb and result',
+    ('verb', 'result'))
+
+
+class HashRing:
+    '''
+    Consistent-hash ring of the nodes. Every node is put on the ring
+    vnodes times, a name belongs to the first node clockwise
+    from the sha256 of the name, the same digest storages use
+    '''
+    def __init__(self, nodes: list, vnodes: int = CLUSTER_VNODES) -> None:
+        if not nodes:
+            raise ValueError('The ring needs at least one node')
+        self.nodes = sorted(set(nodes))
+        points = sorted(
+            (self._position(hashlib.sha256(f'{node}#{i}'.encode()).digest()),
+             node)
+            for node in self.nodes for i in range(vnodes))
+        self._positions = [position for position, _ in points]
+        self._owners = [node for _, node in points]
+
+    def _position(self, digest: bytes) -> int:
+        return int.from_bytes(digest[:8], 'big')
+
+    def owners(self, digest: bytes, count: int = 1) -> list:
+        '''
+        Returns count distinct nodes for the digest of a name,
+        the owner first and then its successors
+        '''
+        count = min(count, len(self.nodes))
+        i = bisect.bisect(self._positions, self._position(digest))
+        owners = []
+        while len(owners) < count:
+            node = self._owners[i % len(self._owners)]
+            if node not in owners:
+                owners.append(node)
+            i += 1
+        return owners
+
+
+def _split_address(address: str) -> tuple:
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+class ClusterStorage(Storage):
+    '''
+    Storage of one node of a cluster. Names owned by this node
+    (or replicated to it) are kept in the local storage, calls
+    for the other names are forwarded to their owner over pooled
+    connections to its cluster port. The owner applies writes and
+    deletes to the replicas set, reads go to any node of the set.
+    The cluster port is served from open() till close(),
+    calls to it must carry the shared secret
+    '''
+    def __init__(self, local: Storage,
+                 nodes: list = CLUSTER_NODES,
+                 node: str = CLUSTER_NODE,
+                 secret: str = CLUSTER_SECRET,
+                 replicas: int = CLUSTER_REPLICAS,
+                 vnodes: int = CLUSTER_VNODES,
+                 timeout: float = CLUSTER_TIMEOUT,
+                 reuse_port: bool = False) -> None:
+        if node not in nodes:
+            raise ValueError(f'Node {node!r} is not one of {nodes}')
+        if not secret:
+            raise ValueError('Cluster mode needs a shared secret')
+        self._local = local
+        self._ring = HashRing(nodes, vnodes)
+        self._node = node
+        self._secret = secret
+        self._replicas = replicas
+        self._timeout = timeout
+        self._reuse_port = reuse_port
+        self._pools = {}
+        self._server = None
+
+    @property
+    def inner(self) -> Storage:
+        return self._local
+
+    @property
+    def ring(self) -> HashRing:
+        return self._ring
+
+    def _owners(self, name: str) -> list:
+        return self._ring.owners(name_digest(name), 1 + self._replicas)
+
+    def _pool(self, node: str) -> RegAgentPool:
+        pool = self._pools.get(node)
+        if pool is None:
+            pool = self._pools[node] = RegAgentPool(*_split_address(node))
+        return pool
+
+    async def _forward(self, node: str, verb: RequestVerb, role: str,
+                       name: str, phones: list = ()) -> tuple:
+        '''
+        Sends the call to another node, returns the status
+        and the phones of its answer
+        '''
+        lines = [f'{verb} {CLUSTER_PROTOCOL}', self._secret, role, name,
+                 *(phone.strip() for phone in phones if phone.strip())]
+        try:
+            response = await asyncio.wait_for(
+                self._pool(node).request(
+                    ('\r\n'.join(lines) + '\r\n\r\n').encode()),
+                self._timeout)
+        except BaseException:
+            FORWARDED.inc(verb=verb, result='error')
+            raise
+        status_line, _, phones = response.decode().partition('\r\n')
+        status = status_line.split(' ', 1)[0]
+        FORWARDED.inc(verb=verb, result=status)
+        if status not in (ResponseStatus.OK, ResponseStatus.NOTFOUND):
+            raise ConnectionError(f'Node {node} refused the call: '
+                                  f'{status_line!r}')
+        return status, phones.strip()
+
+    async def get(self, name: str) -> str:
+        '''
+        Reads the name locally if this node keeps it, otherwise
+        from its owner, falling back to the replicas
+        '''
+        owners = self._owners(name)
+        if self._node in owners:
+            return await self._local.get(name)
+        error = None
+        for node in owners:
+            try:
+                status, phones = await self._forward(
+                    node, RequestVerb.GET, ROLE_OWNER, name)
+            except (OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                logger.error(f'Could not read {name!r} from node {node}: '
+                             f'{e!r}')
+                error = e
+                continue
+            if status == ResponseStatus.NOTFOUND:
+                raise FileNotFoundError(name)
+            return phones
+        raise error
+
+    async def _replicate(self, replicas: list, verb: RequestVerb,
+                         name: str, phones: list = ()) -> None:
+        results = await asyncio.gather(
+            *[self._forward(node, verb, ROLE_REPLICA, name, phones)
+              for node in replicas], return_exceptions=True)
+        for node, result in zip(replicas, results):
+            if isinstance(result, BaseException):
+                logger.error(f'Could not replicate {verb} of {name!r} '
+                             f'to node {node}: {result!r}')
+
+    async def write(self, name: str, phones: list) -> None:
+        '''
+        Writes the name on its owner and its replicas
+        '''
+        owner, *replicas = self._owners(name)
+        if owner != self._node:
+            await self._forward(owner, RequestVerb.WRITE, ROLE_OWNER, name,
+                                phones)
+            return
+        await self._local.write(name, phones)
+        await self._replicate(replicas, RequestVerb.WRITE, name, phones)
+
+    async def delete(self, name: str) -> None:
+        '''
+        Deletes the name on its owner and its replicas
+        '''
+        owner, *replicas = self._owners(name)
+        if owner != self._node:
+            status, _ = await self._forward(
+                owner, RequestVerb.DELETE, ROLE_OWNER, name)
+            if status == ResponseStatus.NOTFOUND:
+                raise FileNotFoundError(name)
+            return
+        try:
+            await self._local.delete(name)
+        finally:
+            await self._replicate(replicas, RequestVerb.DELETE, name)
+
+    async def _apply(self, verb: str, role: str, name: str,
+                     phones: list) -> str:
+        '''
+        Serves a call forwarded by another node
+        '''
+        storage = self if role == ROLE_OWNER else self._local
+        try:
+            if verb == RequestVerb.GET:
+                contents = await storage.get(name)
+                return f'{ResponseStatus.OK} {PROTOCOL}\r\n' + \
+                    (f'{contents}\r\n' if contents else '') + '\r\n'
+            if verb == RequestVerb.WRITE:
+                await storage.write(name, phones)
+            elif verb == RequestVerb.DELETE:
+                await storage.delete(name)
+            else:
+                return f'{ResponseStatus.INCORRECT_REQUEST} {PROTOCOL}\r\n\r\n'
+        except FileNotFoundError:
+            return f'{ResponseStatus.NOTFOUND} {PROTOCOL}\r\n\r\n'
+        return f'{ResponseStatus.OK} {PROTOCOL}\r\n\r\n'
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                data = await reader.readuntil(separator=b'\r\n\r\n')
+                lines = data.decode().split('\r\n')
+                try:
+                    verb, protocol = lines[0].split(' ')
+                    secret, role, name = lines[1:4]
+                except ValueError:
+                    verb = protocol = secret = role = name = ''
+                if protocol != CLUSTER_PROTOCOL or \
+                        role not in (ROLE_OWNER, ROLE_REPLICA) or \
+                        not hmac.compare_digest(secret.encode(),
+                                                self._secret.encode()):
+                    logger.error('Refused a cluster call from '
+                                 f'{writer.get_extra_info("peername")}')
+                    writer.write(f'{ResponseStatus.INCORRECT_REQUEST} '
+                                 f'{PROTOCOL}\r\n\r\n'.encode())
+                    break
+                response = await self._apply(
+                    verb, role, name, format_phones(lines[4:]).split('\r\n'))
+                writer.write(response.encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def scan_keys(self) -> list:
+        return await self._local.scan_keys()
+
+    async def snapshot(self, clean: bool) -> dict:
+        return {'storage': await self._local.snapshot(clean)}
+
+    async def restore(self, state: dict | None) -> bool:
+        if state is None:
+            return False
+        return await self._local.restore(state['storage'])
+
+    async def open(self) -> None:
+        '''
+        Opens the local storage and starts serving the cluster port
+        '''
+        await self._local.open()
+        host, port = _split_address(self._node)
+        self._server = await asyncio.start_server(
+            self._handle, host, port, reuse_port=self._reuse_port)
+        logger.info(f'Serving cluster calls on {self._node}')
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for pool in self._pools.values():
+            await pool.close()
+        self._pools = {}
+        await self._local.close()
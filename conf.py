@@ -1,5 +1,7 @@
+import os
 from enum import Enum
 from loguru import logger
+from logs import BatchingSink, set_sample_rate
 
 
 PROTOCOL = "РКСОК/1.0"
@@ -7,10 +9,32 @@ ENCODING = "UTF-8"
 PHONEBOOKFILESPATH = 'phonebook'
 
 
-logger.add('RKSOK_logs.log',
-           format='{time}, {level}, {message}',
-           level='INFO',
-           enqueue=True, rotation='1 week', compression='zip')
+'''Logging, see logs.py'''
+LOG_FILE = 'RKSOK_logs.log'
+LOG_LEVEL = 'INFO'
+# 'full' logs every request, response and connection through loguru's
+# queue. 'sampled' logs the bodies of LOG_SAMPLE_RATE of the requests only
+# and appends records to LOG_FILE in batches from a background thread,
+# without rotation. Errors and denials are logged in full in both modes
+LOG_MODE = os.environ.get('RKSOK_LOG_MODE', 'full')
+LOG_SAMPLE_RATE = 0.01
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 0.5
+# records waiting for the writer thread, the ones past it are dropped
+LOG_MAX_QUEUED = 65536
+
+
+if LOG_MODE == 'sampled':
+    set_sample_rate(LOG_SAMPLE_RATE)
+    logger.add(BatchingSink(LOG_FILE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL,
+                            LOG_MAX_QUEUED),
+               format='{time}, {level}, {message}',
+               level=LOG_LEVEL)
+else:
+    logger.add(LOG_FILE,
+               format='{time}, {level}, {message}',
+               level=LOG_LEVEL,
+               enqueue=True, rotation='1 week', compression='zip')
 
 
 class RequestVerb(str, Enum):
@@ -31,12 +55,219 @@ class ResponseStatus(str, Enum):
 
 
 '''Information about regulatory agent for RKSOK protocol'''
-REG_HOST = 'vragi-vezde.to.digital'
-REG_PORT = 51624
+# can be overridden from the environment, e.g. to point the server
+# at the stand-in agent from fake_reg_agent.py
+REG_HOST = os.environ.get('RKSOK_REG_HOST', 'vragi-vezde.to.digital')
+REG_PORT = int(os.environ.get('RKSOK_REG_PORT', 51624))
 REG_PREFIX = 'АМОЖНА? РКСОК/1.0\r\n'
+# max number of idle connections kept open to the regulatory agent
+REG_POOL_SIZE = 16
+# seconds after which an idle connection is not reused
+REG_POOL_IDLE_TIMEOUT = 30
+# send the permission checks that arrive within REG_PIPELINE_WINDOW seconds
+# back-to-back over one connection in one write, at most
+# REG_PIPELINE_MAX_BATCH of them, see RegAgentPipeline in regagent.py
+REG_PIPELINE = False
+REG_PIPELINE_WINDOW = 0.001
+REG_PIPELINE_MAX_BATCH = 64
+# seconds a permission check may take, None waits for the agent forever
+REG_TIMEOUT = 5
+# send a second attempt if the first one has not been answered
+# by the p95 latency of the last REG_HEDGE_WINDOW answers of the agent,
+# but not earlier than REG_HEDGE_MIN_DELAY seconds
+REG_HEDGE = False
+REG_HEDGE_WINDOW = 1000
+REG_HEDGE_MIN_DELAY = 0.005
+# after REG_BREAKER_FAILURES failed checks in a row the agent is taken
+# as down for REG_BREAKER_RESET seconds, then one check is let through
+REG_BREAKER_FAILURES = 5
+REG_BREAKER_RESET = 10
+# verdict used when the agent is down or does not answer in time
+REG_FALLBACK_RESPONSE = f'{ResponseStatus.NOT_APPROVED} {PROTOCOL}\r\n' + \
+    'Регулирующий орган недоступен\r\n\r\n'
+
+'''Cache of regulatory agent verdicts, keyed by the request sent to it'''
+VERDICT_CACHE_ENABLED = False
+VERDICT_CACHE_SIZE = 10000
+# seconds a verdict stays valid, can be set separately for each verdict
+VERDICT_CACHE_TTL = 60
+VERDICT_CACHE_TTL_APPROVED = VERDICT_CACHE_TTL
+VERDICT_CACHE_TTL_DENIED = VERDICT_CACHE_TTL
+# concurrent identical requests share one round trip to the agent
+REG_SINGLE_FLIGHT = True
 
 
 '''Server configuration'''
 HOST = '0.0.0.0'
 PORT = 8888
 FOLDERPATH = 'phonebook'
+# serve several requests over one connection instead of closing it
+# after the first response
+KEEP_ALIVE = False
+# seconds to wait for the next request on a persistent connection
+KEEP_ALIVE_TIMEOUT = 15
+KEEP_ALIVE_MAX_REQUESTS = 100
+# 'streams' serves connections with StreamReader/StreamWriter,
+# 'protocol' with the incremental bytes parser in protocol.py
+TRANSPORT = 'streams'
+# initial size of the receive buffer of a connection in 'protocol' mode
+READ_BUFFER_SIZE = 64 * 1024
+# reading from a client pauses while this many of its requests wait
+MAX_PIPELINED_REQUESTS = 64
+# start reading the phones of an ОТДОВАЙ request while the regulatory
+# agent is being asked, the data is sent only if the answer is МОЖНА
+SPECULATIVE_GET = False
+# seconds given to requests in progress to finish on shutdown
+SHUTDOWN_TIMEOUT = 10
+# storage backend: 'file' keeps a file per name in FOLDERPATH,
+# 'log' keeps all names in one append-only file LOG_STORAGE_PATH,
+# 'sqlite' keeps them in the SQLite database SQLITE_PATH
+STORAGE_BACKEND = 'file'
+# durability of FilePhoneBook writes: 'none' leaves flushing to the OS,
+# 'fsync' syncs every write, 'group' syncs the writes made within
+# GROUP_COMMIT_WINDOW seconds together, see bench_storage.py
+FILE_DURABILITY = 'none'
+GROUP_COMMIT_WINDOW = 0.002
+# levels of two hex character folders FilePhoneBook nests its files in,
+# e.g. 2 keeps the file of a name in FOLDERPATH/ab/cd/abcd..., 0 keeps
+# all files in FOLDERPATH. Files of the flat layout are still read and
+# are moved on access and by a background task, FILE_MIGRATION_BATCH of
+# them every FILE_MIGRATION_INTERVAL seconds, 0 moves them on access only
+FILE_FANOUT = 0
+FILE_MIGRATION_BATCH = 1000
+FILE_MIGRATION_INTERVAL = 0.1
+# threads of the pool storage I/O runs on, apart from the default executor
+STORAGE_IO_THREADS = 8
+
+
+'''Log-structured storage, see logstorage.py'''
+LOG_STORAGE_PATH = 'phonebook.log'
+# seconds between checks whether the data file needs compaction
+LOG_COMPACTION_INTERVAL = 60
+# compaction starts when outdated records take at least this many bytes
+# and at least this share of the data file
+LOG_COMPACTION_MIN_GARBAGE = 1024 * 1024
+LOG_COMPACTION_RATIO = 0.5
+
+
+'''SQLite storage, see sqlitestorage.py'''
+SQLITE_PATH = 'phonebook.sqlite3'
+
+
+'''In-memory cache of phonebook entries in front of the storage'''
+STORAGE_CACHE_ENABLED = False
+STORAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# seconds an entry is trusted, None keeps it until it is evicted.
+# Each worker process has its own cache, so with several workers set
+# a TTL to bound how long a write made by another worker goes unseen
+STORAGE_CACHE_TTL = None
+
+
+'''Write-behind buffer in front of the storage, see writebehind.py'''
+# acknowledge ЗОПИШИ as soon as the phones are buffered and write only
+# the last value of every name, every WRITE_BEHIND_INTERVAL seconds or
+# when WRITE_BEHIND_MAX_PENDING names are waiting. Values not flushed yet
+# are lost if the process crashes and are not seen by other workers
+WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_INTERVAL = 0.05
+WRITE_BEHIND_MAX_PENDING = 1000
+
+'''Bloom filter of stored names in front of the storage, see bloom.py'''
+# answer НИНАШОЛ for names that were never written without touching
+# the storage. Works in a single process only: writes made by other
+# workers would be missed, so it is not used with several workers
+BLOOM_ENABLED = False
+# names the filter is sized for, it grows with the storage on rebuilds
+BLOOM_CAPACITY = 1000000
+BLOOM_ERROR_RATE = 0.01
+# seconds between rebuilds from the storage, which forget deleted names
+BLOOM_REBUILD_INTERVAL = 600
+
+
+'''Bulk export and import of the storage, see bulk.py'''
+# storage calls made at once
+BULK_PARALLELISM = 64
+# names between two checkpoints of a bulk run
+BULK_CHECKPOINT_EVERY = 10000
+# seconds between throughput reports
+BULK_REPORT_INTERVAL = 5
+
+
+'''Warm-start snapshots, see snapshot.py'''
+# save the storage cache, the index of the log storage, the bloom filter
+# and the verdict cache to SNAPSHOT_PATH every SNAPSHOT_INTERVAL seconds
+# and on shutdown, and load them before accepting connections. Worker N
+# of a multi-process server uses SNAPSHOT_PATH.N. Snapshots older than
+# SNAPSHOT_MAX_AGE seconds are discarded, the bloom filter is loaded only
+# from a snapshot taken on shutdown if the storage has not changed since
+SNAPSHOT_ENABLED = False
+SNAPSHOT_PATH = 'rksok.snapshot'
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_MAX_AGE = 24 * 60 * 60
+# names of the storage cache read back at once when it is restored
+SNAPSHOT_WARM_PARALLELISM = 64
+
+
+'''Admission control, see admission.py'''
+# requests larger than this are answered with НИПОНЯЛ
+MAX_REQUEST_SIZE = 64 * 1024
+# seconds to receive the first line of a request and then the rest of it
+REQUEST_HEADER_TIMEOUT = 10
+REQUEST_BODY_TIMEOUT = 10
+# requests processed at once, the regulatory agent and storage included
+MAX_IN_FLIGHT_REQUESTS = 1000
+# requests waiting for a slot, the ones beyond that are rejected at once
+MAX_QUEUED_REQUESTS = 1000
+# seconds a request may wait for a slot
+QUEUE_TIMEOUT = 5
+# status of the response to a rejected request
+OVERLOAD_STATUS = ResponseStatus.INCORRECT_REQUEST
+
+
+'''Multi-process mode, see workers.py'''
+# number of worker processes sharing the port, 1 runs a single process
+WORKERS = 1
+# seconds to wait before restarting a crashed worker
+WORKER_RESTART_DELAY = 1
+
+
+'''Metrics, see metrics.py'''
+# serve the metrics in Prometheus text format on METRICS_HOST:METRICS_PORT,
+# worker N of a multi-process server uses METRICS_PORT + N.
+# If the port is taken the server logs a warning and runs without metrics
+METRICS_ENABLED = False
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
+
+
+'''Diagnostics, see diagnostics.py'''
+# SIGUSR1 or GET /debug/profile on the metrics port starts cProfile,
+# the next one stops it and dumps the stats to DIAG_PROFILE_DIR
+DIAG_PROFILER = False
+DIAG_PROFILE_DIR = 'profiles'
+# seconds a callback may block the event loop before it is logged,
+# None disables. Runs the loop in asyncio debug mode, which is slower
+DIAG_SLOW_CALLBACK = None
+# seconds after which the stack of a request or a permission check still
+# running is logged, None disables
+DIAG_LATENCY_BUDGET = None
+
+
+'''Cluster mode, see cluster.py'''
+# cluster addresses 'host:port' of all nodes, separated by commas.
+# Every node owns part of the names on a consistent-hash ring and
+# forwards the storage calls for the other names to their owners,
+# no addresses runs a single node
+CLUSTER_NODES = [node for node in os.environ.get(
+    'RKSOK_CLUSTER_NODES', '').split(',') if node]
+# cluster address of this node, one of CLUSTER_NODES
+CLUSTER_NODE = os.environ.get('RKSOK_CLUSTER_NODE', '')
+# shared by all nodes, forwarded calls without it are refused
+CLUSTER_SECRET = os.environ.get('RKSOK_CLUSTER_SECRET', '')
+# copies of every name kept on the next nodes of the ring,
+# reads are served by any of them
+CLUSTER_REPLICAS = 0
+# points of every node on the ring, more spread the names more evenly
+CLUSTER_VNODES = 64
+# seconds a forwarded call may take
+CLUSTER_TIMEOUT = 5
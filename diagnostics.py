@@ -0,0 +1,275 @@
+import asyncio
+import cProfile
+import linecache
+import logging
+import os
+import signal
+import time
+from conf import logger, DIAG_PROFILER, DIAG_PROFILE_DIR, \
+    DIAG_SLOW_CALLBACK, DIAG_LATENCY_BUDGET
+from metrics import REGISTRY
+
+
+SLOW_CALLBACKS = REGISTRY.counter(
+    'rksok_slow_callbacks_total',
+    'Callbacks that blocked the event loop longer than the threshold')
+BUDGET_OVERRUNS = REGISTRY.counter(
+    'rksok_latency_budget_overruns_total',
+    'Watched calls still running after the latency budget', ('call',))
+
+# the watchdog of the running server, None when it is off
+_watchdog = None
+
+
+def coroutine_stack(coro) -> str:
+    '''
+    Formats the chain of coroutines awaited by coro,
+    outermost first, like a traceback
+    '''
+    lines = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or \
+            getattr(coro, 'gi_frame', None)
+        if frame is None:
+            lines.append(f'  awaiting {coro!r}')
+            break
+        code = frame.f_code
+        lines.append(f'  File "{code.co_filename}", line {frame.f_lineno}, '
+                     f'in {code.co_name}')
+        source = linecache.getline(code.co_filename, frame.f_lineno).strip()
+        if source:
+            lines.append(f'    {source}')
+        coro = getattr(coro, 'cr_await', None) or \
+            getattr(coro, 'gi_yieldfrom', None)
+    return '\n'.join(lines)
+
+
+class _Watch:
+    '''
+    Registers the current task with the watchdog for the duration
+    of a with block
+    '''
+    __slots__ = ('_watchdog', '_call')
+
+    def __init__(self, watchdog, call: str) -> None:
+        self._watchdog = watchdog
+        self._call = call
+
+    def __enter__(self) -> None:
+        self._watchdog.watch(self, self._call)
+
+    def __exit__(self, *exc_info) -> None:
+        self._watchdog.unwatch(self)
+
+
+class _NotWatched:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NOT_WATCHED = _NotWatched()
+
+
+def watched(call: str):
+    '''
+    Context manager under which the current task is watched
+    for running past the latency budget, does nothing while
+    the watchdog is off
+    '''
+    if _watchdog is None:
+        return _NOT_WATCHED
+    return _Watch(_watchdog, call)
+
+
+class Watchdog:
+    '''
+    Logs the coroutine stack of every watched call still running
+    budget seconds after it started, once per call
+    '''
+    def __init__(self, budget: float = DIAG_LATENCY_BUDGET) -> None:
+        self._budget = budget
+        self._watched = {}
+        self._task = None
+
+    def watch(self, token: object, call: str) -> None:
+        self._watched[token] = (call, asyncio.current_task(),
+                                time.monotonic())
+
+    def unwatch(self, token: object) -> None:
+        self._watched.pop(token, None)
+
+    def check(self) -> int:
+        '''
+        Logs the calls over the budget and stops watching them,
+        returns their number
+        '''
+        now = time.monotonic()
+        overdue = [(token, call, task, started)
+                   for token, (call, task, started) in self._watched.items()
+                   if now - started >= self._budget]
+        for token, call, task, started in overdue:
+            del self._watched[token]
+            BUDGET_OVERRUNS.inc(call=call)
+            stack = coroutine_stack(task.get_coro()) if task else ''
+            logger.warning(f'{call} has been running for '
+                           f'{now - started:.3f}s, over the budget of '
+                           f'{self._budget}s:\n{stack}')
+        return len(overdue)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._budget / 2)
+            self.check()
+
+    def start(self) -> None:
+        global _watchdog
+        _watchdog = self
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        global _watchdog
+        if _watchdog is self:
+            _watchdog = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._watched = {}
+
+
+class Profiler:
+    '''
+    cProfile of the event loop thread switched on and off at runtime,
+    the stats of every run are dumped to a file in profile_dir
+    '''
+    def __init__(self, profile_dir: str = DIAG_PROFILE_DIR) -> None:
+        self._profile_dir = profile_dir
+        self._profile = None
+        self._runs = 0
+
+    @property
+    def running(self) -> bool:
+        return self._profile is not None
+
+    def start(self) -> None:
+        if self._profile is not None:
+            return
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        logger.info('Profiler started')
+
+    def stop(self) -> str | None:
+        '''
+        Stops profiling and returns the path the stats are dumped to
+        '''
+        if self._profile is None:
+            return None
+        profile, self._profile = self._profile, None
+        profile.disable()
+        self._runs += 1
+        os.makedirs(self._profile_dir, exist_ok=True)
+        path = os.path.join(
+            self._profile_dir, f'rksok-{os.getpid()}-'
+            f'{time.strftime("%Y%m%d-%H%M%S")}-{self._runs}.prof')
+        profile.dump_stats(path)
+        logger.info(f'Profiler stopped, stats are dumped to {path}')
+        return path
+
+    def toggle(self) -> str | None:
+        if self._profile is None:
+            self.start()
+            return None
+        return self.stop()
+
+    def handle_route(self, query: str) -> tuple:
+        '''
+        GET /debug/profile?start, ?stop or no query to toggle
+        '''
+        if query == 'start':
+            self.start()
+            path = None
+        elif query == 'stop':
+            path = self.stop()
+        else:
+            path = self.toggle()
+        if self.running:
+            body = 'profiling\n'
+        elif path is not None:
+            body = f'stats dumped to {path}\n'
+        else:
+            body = 'not profiling\n'
+        return '200 OK', 'text/plain; charset=utf-8', body
+
+
+class _AsyncioLogHandler(logging.Handler):
+    '''
+    Passes the warnings of the asyncio logger, slow callbacks
+    among them, to loguru
+    '''
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if message.startswith('Executing'):
+            SLOW_CALLBACKS.inc()
+        logger.opt(exception=record.exc_info).log(record.levelname, message)
+
+
+class Diagnostics:
+    '''
+    Opt-in diagnostics of a running server: the profiler toggled
+    by SIGUSR1 or GET /debug/profile on the metrics port, asyncio
+    slow callback warnings past slow_callback seconds and the watchdog
+    of calls running past latency_budget seconds
+    '''
+    def __init__(self, profiler: bool = DIAG_PROFILER,
+                 profile_dir: str = DIAG_PROFILE_DIR,
+                 slow_callback: float | None = DIAG_SLOW_CALLBACK,
+                 latency_budget: float | None = DIAG_LATENCY_BUDGET
+                 ) -> None:
+        self.profiler = Profiler(profile_dir) if profiler else None
+        self._slow_callback = slow_callback
+        self.watchdog = Watchdog(latency_budget) if latency_budget else None
+        self._log_handler = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.profiler is not None or \
+            self._slow_callback is not None or self.watchdog is not None
+
+    def start(self, metrics_server=None) -> None:
+        '''
+        Switches on the configured diagnostics on the running loop,
+        the profiler route is added to metrics_server if there is one
+        '''
+        loop = asyncio.get_running_loop()
+        if self.profiler is not None:
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.toggle)
+            if metrics_server is not None:
+                metrics_server.add_route('/debug/profile',
+                                         self.profiler.handle_route)
+        if self._slow_callback is not None:
+            self._log_handler = _AsyncioLogHandler(logging.WARNING)
+            logging.getLogger('asyncio').addHandler(self._log_handler)
+            loop.slow_callback_duration = self._slow_callback
+            loop.set_debug(True)
+        if self.watchdog is not None:
+            self.watchdog.start()
+
+    async def close(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.profiler is not None:
+            loop.remove_signal_handler(signal.SIGUSR1)
+            self.profiler.stop()
+        if self._log_handler is not None:
+            loop.set_debug(False)
+            logging.getLogger('asyncio').removeHandler(self._log_handler)
+            self._log_handler = None
+        if self.watchdog is not None:
+            await self.watchdog.close()
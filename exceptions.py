@@ -30,3 +30,15 @@ class InvalidProtocolError(RKSOKException):
     """Error that occurs when the client attempts
     to use protocol which is not supported by RKSOK server"""
     pass
+
+
+class RequestTooLargeError(RKSOKException):
+    """Error that occurs when the request to RKSOK server
+    is larger than allowed"""
+    pass
+
+
+class RequestTimeoutError(RKSOKException):
+    """Error that occurs when the client does not send
+    the whole request to RKSOK server in time"""
+    pass
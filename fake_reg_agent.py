@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import random
+import zlib
+from conf import logger, REG_PORT, ResponseStatus, PROTOCOL
+
+
+class FakeRegAgent:
+    '''
+    Local stand-in for the regulatory agent for benchmarks and tests
+    Answers every request after latency seconds (plus up to jitter
+    seconds more), approving approve_ratio of the distinct requests.
+    The verdict depends only on the request, so the same request
+    always gets the same answer, like from the real agent.
+    Connections are kept open, so pooled clients can reuse them
+    '''
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0,
+                 approve_ratio: float = 1.0) -> None:
+        self._host = host
+        self._port = port
+        self._latency = latency
+        self._jitter = jitter
+        self._approve_ratio = approve_ratio
+        self._server = None
+        self.requests = 0
+        self.connections = 0
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    def verdict(self, request: bytes) -> str:
+        if zlib.crc32(request) % 10000 < self._approve_ratio * 10000:
+            return f'{ResponseStatus.APPROVED} {PROTOCOL}\r\n\r\n'
+        return f'{ResponseStatus.NOT_APPROVED} {PROTOCOL}\r\n' + \
+            'Уже едем\r\n\r\n'
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request = await reader.readuntil(separator=b'\r\n\r\n')
+                self.requests += 1
+                delay = self._latency + random.uniform(0, self._jitter)
+                if delay:
+                    await asyncio.sleep(delay)
+                writer.write(self.verdict(request).encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, self._host, self._port, limit=64 * 1024)
+
+    async def close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+
+async def main(args: argparse.Namespace) -> None:
+    agent = FakeRegAgent(args.host, args.port, args.latency, args.jitter,
+                         args.approve_ratio)
+    await agent.start()
+    logger.info(f'Fake regulatory agent is serving on '
+                f'{args.host}:{agent.port}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the RKSOK regulatory agent. '
+                    'Point the server at it with RKSOK_REG_HOST and '
+                    'RKSOK_REG_PORT')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=REG_PORT)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before every answer')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many seconds added to latency')
+    parser.add_argument('--approve-ratio', type=float, default=1.0,
+                        help='share of requests that are approved')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from conf import HOST, PORT, PROTOCOL, RequestVerb, ResponseStatus
+
+
+DEFAULT_MIX = 'get=80,write=15,delete=5'
+VERBS = {'get': RequestVerb.GET, 'write': RequestVerb.WRITE,
+         'delete': RequestVerb.DELETE}
+
+
+def parse_mix(mix: str) -> dict:
+    '''
+    Parses 'get=80,write=15,delete=5' into weights of the verbs
+    '''
+    weights = {}
+    for part in mix.split(','):
+        verb, weight = part.split('=')
+        weights[VERBS[verb.strip().lower()]] = float(weight)
+    return weights
+
+
+def percentile(values: list, share: float) -> float:
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(share * len(values) + 0.5) - 1))
+    return values[rank]
+
+
+def summarize(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'p999_ms': round(percentile(latencies, 0.999) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+class LoadGenerator:
+    '''
+    Drives a mix of ОТДОВАЙ/ЗОПИШИ/УДОЛИ requests against an RKSOK server
+    from concurrency clients for duration seconds and reports
+    throughput, latency percentiles, response statuses and errors
+    '''
+    def __init__(self, host: str, port: int, concurrency: int = 50,
+                 duration: float = 10.0, mix: dict | None = None,
+                 names: int = 1000, keep_alive: bool = False,
+                 timeout: float = 10.0, seed: int | None = None) -> None:
+        self._host = host
+        self._port = port
+        self._concurrency = concurrency
+        self._duration = duration
+        self._mix = mix or parse_mix(DEFAULT_MIX)
+        self._names = names
+        self._keep_alive = keep_alive
+        self._timeout = timeout
+        self._random = random.Random(seed)
+        self._latencies = defaultdict(list)
+        self._statuses = Counter()
+        self._errors = Counter()
+
+    def _make_request(self) -> tuple:
+        verb = self._random.choices(list(self._mix),
+                                    weights=list(self._mix.values()))[0]
+        name = f'name{self._random.randrange(self._names)}'
+        body = ''
+        if verb == RequestVerb.WRITE:
+            body = f'7{self._random.randrange(10 ** 10):010d}\r\n'
+        return verb, f'{verb.value} {name} {PROTOCOL}\r\n{body}\r\n'.encode()
+
+    async def _request(self, connection: tuple | None,
+                       request: bytes) -> tuple:
+        '''
+        Sends the request, opening a connection if there is none,
+        returns the connection to reuse (or None) and the response
+        '''
+        if connection is None:
+            connection = await asyncio.open_connection(
+                self._host, self._port)
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+        response = await reader.readuntil(separator=b'\r\n\r\n')
+        if not self._keep_alive:
+            writer.close()
+            connection = None
+        return connection, response
+
+    async def _client(self, deadline: float) -> None:
+        connection = None
+        while time.monotonic() < deadline:
+            verb, request = self._make_request()
+            started = time.perf_counter()
+            try:
+                connection, response = await asyncio.wait_for(
+                    self._request(connection, request), self._timeout)
+            except (OSError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, asyncio.TimeoutError) as e:
+                self._errors[type(e).__name__] += 1
+                if connection is not None:
+                    connection[1].close()
+                    connection = None
+                continue
+            self._latencies[verb.value].append(
+                time.perf_counter() - started)
+            self._statuses[response.split(maxsplit=1)[0].decode()] += 1
+        if connection is not None:
+            connection[1].close()
+
+    async def run(self) -> dict:
+        started = time.monotonic()
+        deadline = started + self._duration
+        await asyncio.gather(
+            *[self._client(deadline) for _ in range(self._concurrency)])
+        elapsed = time.monotonic() - started
+
+        latencies = [latency for verb_latencies in self._latencies.values()
+                     for latency in verb_latencies]
+        answered = len(latencies)
+        errors = sum(self._errors.values()) + \
+            self._statuses[ResponseStatus.INCORRECT_REQUEST.value]
+        attempted = answered + sum(self._errors.values())
+        return {
+            'config': {
+                'host': self._host, 'port': self._port,
+                'concurrency': self._concurrency,
+                'duration': self._duration,
+                'mix': {verb.value: weight
+                        for verb, weight in self._mix.items()},
+                'names': self._names, 'keep_alive': self._keep_alive,
+            },
+            'elapsed': round(elapsed, 3),
+            'throughput': round(answered / elapsed, 1),
+            'latency': summarize(latencies),
+            'latency_by_verb': {verb: summarize(verb_latencies)
+                                for verb, verb_latencies
+                                in self._latencies.items()},
+            'statuses': dict(self._statuses),
+            'errors': dict(self._errors),
+            'error_rate': round(errors / attempted, 6) if attempted else 0.0,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load generator for the RKSOK server, '
+                    'prints a JSON report')
+    parser.add_argument('--host', default='127.0.0.1' if HOST == '0.0.0.0'
+                        else HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weights of the verbs, e.g. ' + DEFAULT_MIX)
+    parser.add_argument('--names', type=int, default=1000,
+                        help='number of distinct names used')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='reuse connections, needs KEEP_ALIVE on '
+                             'the server')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadGenerator(
+        args.host, args.port, args.concurrency, args.duration,
+        parse_mix(args.mix), args.names, args.keep_alive, args.timeout,
+        args.seed).run())
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report_json)
+    print(report_json)
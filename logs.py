@@ -0,0 +1,113 @@
+import os
+import random
+import threading
+from collections import deque
+from contextvars import ContextVar
+
+
+_sample_rate = 1.0
+# whether the bodies of the request being handled are logged
+_sampled = ContextVar('sampled', default=True)
+
+
+def set_sample_rate(rate: float) -> None:
+    '''
+    Sets the share of requests whose bodies are logged
+    '''
+    global _sample_rate
+    _sample_rate = rate
+
+
+def should_sample() -> bool:
+    return _sample_rate >= 1 or random.random() < _sample_rate
+
+
+def sample_request() -> bool:
+    '''
+    Decides whether the request being handled is logged,
+    the decision holds for the rest of the current task
+    '''
+    decision = should_sample()
+    _sampled.set(decision)
+    return decision
+
+
+def sampled() -> bool:
+    '''
+    Tells whether the request being handled is logged
+    '''
+    return _sampled.get()
+
+
+class BatchingSink:
+    '''
+    loguru sink that collects formatted records and appends them
+    to the file in batches from a background thread, so the event loop
+    neither waits for the disk nor pickles records into a queue.
+    A batch is written when batch_size records are collected
+    or flush_interval seconds pass. Records that come while max_records
+    are waiting are dropped.
+    The thread is started by the first write of every process,
+    so forked workers write their own records
+    '''
+    def __init__(self, path: str, batch_size: int = 256,
+                 flush_interval: float = 0.5,
+                 max_records: int = 65536) -> None:
+        self._path = path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_records = max_records
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    def _start(self) -> None:
+        # the records of the parent are written by the parent
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, message: str) -> None:
+        if self._pid != os.getpid():
+            self._start()
+        if len(self._records) >= self._max_records:
+            self.dropped += 1
+            return
+        self._records.append(str(message))
+        if len(self._records) >= self._batch_size:
+            self._wakeup.set()
+
+    def _take_batch(self) -> list:
+        batch = []
+        while self._records:
+            batch.append(self._records.popleft())
+        return batch
+
+    def _run(self) -> None:
+        with open(self._path, 'a', encoding='utf-8') as f:
+            while True:
+                self._wakeup.wait(self._flush_interval)
+                self._wakeup.clear()
+                batch = self._take_batch()
+                if batch:
+                    f.write(''.join(batch))
+                    f.flush()
+                if self._stopping and not self._records:
+                    return
+
+    def stop(self) -> None:
+        '''
+        Writes the remaining records, loguru calls it when the sink
+        is removed
+        '''
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
@@ -0,0 +1,398 @@
+import asyncio
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from conf import logger, LOG_COMPACTION_INTERVAL, \
+    LOG_COMPACTION_MIN_GARBAGE, LOG_COMPACTION_RATIO
+from metrics import SNAPSHOT_RESTORED
+from storage import Storage, format_phones, name_digest, \
+    get_storage_executor
+
+
+# crc32 of the rest of the record, record type, length of the value.
+# The header is followed by the 32 byte sha256 of the name and the value
+HEADER = struct.Struct('>IBI')
+KEY_SIZE = 32
+PUT = 1
+TOMBSTONE = 0
+# key, value offset, value length, record size of an index entry
+# in a snapshot
+INDEX_ENTRY = struct.Struct('>32sQII')
+
+
+def make_record(record_type: int, key: bytes, value: bytes = b'') -> bytes:
+    body = HEADER.pack(0, record_type, len(value))[4:] + key + value
+    return struct.pack('>I', zlib.crc32(body)) + body
+
+
+def iter_records(f, offset: int = 0):
+    '''
+    Reads records from a binary file object starting at offset.
+    Yields (offset, record type, key, value offset, value)
+    and stops at the end of the file or at the first torn or corrupted
+    record, the offset after the last valid record is returned
+    '''
+    f.seek(offset)
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return offset
+        crc, record_type, length = HEADER.unpack(header)
+        rest = f.read(KEY_SIZE + length)
+        if len(rest) < KEY_SIZE + length or \
+                zlib.crc32(header[4:] + rest) != crc:
+            return offset
+        value_offset = offset + HEADER.size + KEY_SIZE
+        yield offset, record_type, rest[:KEY_SIZE], value_offset, \
+            rest[KEY_SIZE:]
+        offset = value_offset + length
+
+
+class _DataFile:
+    '''
+    Open data file, closed only when nobody reads from it anymore
+    '''
+    def __init__(self, path: str) -> None:
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._readers = 0
+        self._retired = False
+
+    def acquire(self) -> int:
+        self._readers += 1
+        return self.fd
+
+    def release(self) -> None:
+        self._readers -= 1
+        if self._retired and not self._readers:
+            os.close(self.fd)
+
+    def retire(self) -> None:
+        self._retired = True
+        if not self._readers:
+            os.close(self.fd)
+
+
+class LogPhoneBook(Storage):
+    '''
+    Class for storing phones in one append-only data file
+    Each write appends a record with the new phones, each delete
+    appends a tombstone, an in-memory index maps the sha256 of every
+    name to the latest value in the file.
+    The index is rebuilt from the file on first use unless it is
+    restored from a snapshot, outdated records are removed
+    by the background compaction.
+    File I/O runs on executor, the storage thread pool by default
+    '''
+    def __init__(self, file_path: str,
+                 compaction_interval: float = LOG_COMPACTION_INTERVAL,
+                 compaction_min_garbage: int = LOG_COMPACTION_MIN_GARBAGE,
+                 compaction_ratio: float = LOG_COMPACTION_RATIO,
+                 executor: ThreadPoolExecutor | None = None) -> None:
+        self._file_path = file_path
+        self._executor = executor or get_storage_executor()
+        self._compaction_interval = compaction_interval
+        self._compaction_min_garbage = compaction_min_garbage
+        self._compaction_ratio = compaction_ratio
+        folder = os.path.dirname(file_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._index = None
+        self._garbage = 0
+        self._end = 0
+        self._data_file = _DataFile(file_path)
+        self._compacting = False
+        self._compaction_task = None
+        self._load_lock = asyncio.Lock()
+        # appends are made one at a time, so records land in the file
+        # at the offsets the index is given
+        self._append_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        if self._index is None:
+            self._load()
+        return len(self._index)
+
+    @property
+    def garbage(self) -> int:
+        '''
+        Number of bytes taken by outdated records
+        '''
+        if self._index is None:
+            self._load()
+        return self._garbage
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self._garbage >= self._compaction_min_garbage and \
+            self._garbage >= self._end * self._compaction_ratio
+
+    def _replay(self, f, offset: int, index: dict) -> tuple:
+        '''
+        Applies the records of the file starting at offset to the index.
+        Returns the offset after the last valid record and the number
+        of bytes taken by the records that are outdated now
+        '''
+        garbage = 0
+        records = iter_records(f, offset)
+        while True:
+            try:
+                offset, record_type, key, value_offset, value = \
+                    next(records)
+            except StopIteration as end:
+                return end.value, garbage
+            length = len(value)
+            record_size = value_offset - offset + length
+            old = index.pop(key, None)
+            if old is not None:
+                garbage += old[2]
+            if record_type == PUT:
+                index[key] = (value_offset, length, record_size)
+            else:
+                garbage += record_size
+
+    def _load(self) -> None:
+        '''
+        Rebuilds the index from the data file, cutting off the torn
+        record a crash may have left at the end of it
+        '''
+        index = {}
+        with open(self._file_path, 'rb') as f:
+            end, garbage = self._replay(f, 0, index)
+        if end != os.path.getsize(self._file_path):
+            logger.error(f'Data file {self._file_path} has a torn or '
+                         f'corrupted record at {end}, truncating it')
+            os.truncate(self._file_path, end)
+        self._index, self._end, self._garbage = index, end, garbage
+
+    async def _ensure_loaded(self) -> None:
+        '''
+        Loads the index on the executor unless it is loaded already
+        '''
+        if self._index is not None:
+            return
+        async with self._load_lock:
+            if self._index is None:
+                await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._load)
+
+    def _write_record(self, fd: int, record: bytes) -> None:
+        view = memoryview(record)
+        while view:
+            view = view[os.write(fd, view):]
+
+    async def _append(self, record: bytes) -> int:
+        '''
+        Appends the record to the data file and returns its offset
+        '''
+        async with self._append_lock:
+            offset = self._end
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_record, self._data_file.fd,
+                record)
+            self._end += len(record)
+        return offset
+
+    async def get(self, name: str) -> str:
+        '''
+        Returns the phones recorded for a given name
+        '''
+        return await self.get_key(name_digest(name))
+
+    async def get_key(self, key: bytes) -> str:
+        await self._ensure_loaded()
+        entry = self._index.get(key)
+        if entry is None:
+            raise FileNotFoundError(key.hex())
+        value_offset, length, _ = entry
+        data_file = self._data_file
+        fd = data_file.acquire()
+        try:
+            value = await asyncio.get_running_loop().run_in_executor(
+                self._executor, os.pread, fd, length, value_offset)
+        finally:
+            data_file.release()
+        return value.decode()
+
+    async def write(self, name: str, phones: list) -> None:
+        '''
+        Appends the phones of a given name to the data file
+        '''
+        await self.write_key(name_digest(name), phones)
+
+    async def write_key(self, key: bytes, phones: list) -> None:
+        await self._ensure_loaded()
+        value = format_phones(phones).encode()
+        record = make_record(PUT, key, value)
+        offset = await self._append(record)
+        old = self._index.get(key)
+        if old is not None:
+            self._garbage += old[2]
+        self._index[key] = (offset + HEADER.size + KEY_SIZE, len(value),
+                            len(record))
+
+    async def delete(self, name: str) -> None:
+        '''
+        Appends a tombstone of a given name to the data file
+        '''
+        await self._ensure_loaded()
+        key = name_digest(name)
+        if key not in self._index:
+            raise FileNotFoundError(name)
+        record = make_record(TOMBSTONE, key)
+        await self._append(record)
+        # the name may have been deleted while the tombstone was written
+        old = self._index.pop(key, None)
+        self._garbage += len(record) + (old[2] if old is not None else 0)
+
+    async def scan_keys(self) -> list:
+        await self._ensure_loaded()
+        return list(self._index)
+
+    def _pack_index(self, index: dict) -> bytes:
+        return b''.join(INDEX_ENTRY.pack(key, *entry)
+                        for key, entry in index.items())
+
+    async def snapshot(self, clean: bool) -> dict:
+        '''
+        Keeps the index with the identity of the data file it belongs to
+        '''
+        await self._ensure_loaded()
+        stat = os.stat(self._file_path)
+        state = {'device': stat.st_dev, 'inode': stat.st_ino,
+                 'mtime': stat.st_mtime_ns, 'end': self._end,
+                 'garbage': self._garbage}
+        state['index'] = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._pack_index, dict(self._index))
+        return state
+
+    def _restore_index(self, state: dict) -> bool:
+        '''
+        Takes the index of the snapshot if it is of the same data file,
+        the records appended after the snapshot are replayed over it
+        '''
+        stat = os.stat(self._file_path)
+        if (stat.st_dev, stat.st_ino) != (state['device'], state['inode']) \
+                or stat.st_size < state['end']:
+            logger.info(f'Data file {self._file_path} was replaced since '
+                        'the snapshot, rebuilding the index')
+            return False
+        index = {key: (value_offset, length, record_size)
+                 for key, value_offset, length, record_size
+                 in INDEX_ENTRY.iter_unpack(state['index'])}
+        with open(self._file_path, 'rb') as f:
+            end, garbage = self._replay(f, state['end'], index)
+        if end != stat.st_size:
+            # the torn record is cut off by a full load
+            return False
+        self._index, self._end = index, end
+        self._garbage = state['garbage'] + garbage
+        return True
+
+    async def restore(self, state: dict | None) -> bool:
+        if state is None or self._index is not None:
+            return False
+        restored = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._restore_index, state)
+        if not restored:
+            return False
+        SNAPSHOT_RESTORED.set(len(self._index), component='log_index')
+        return self._end == state['end'] and \
+            os.stat(self._file_path).st_mtime_ns == state['mtime']
+
+    def _write_compacted(self, fd: int, index: dict, path: str) -> dict:
+        '''
+        Copies the values of the index into a new data file,
+        returns the index of the new file
+        '''
+        compacted = {}
+        offset = 0
+        with open(path, 'wb') as f:
+            for key, (value_offset, length, _) in index.items():
+                value = os.pread(fd, length, value_offset)
+                record = make_record(PUT, key, value)
+                f.write(record)
+                compacted[key] = (offset + HEADER.size + KEY_SIZE, length,
+                                  len(record))
+                offset += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        return compacted
+
+    async def compact(self) -> None:
+        '''
+        Rewrites the data file keeping only the latest value of every
+        name. The copying runs in a thread, the records appended
+        meanwhile are moved to the new file before it replaces the old one
+        '''
+        if self._compacting:
+            return
+        await self._ensure_loaded()
+        self._compacting = True
+        compacted_path = f'{self._file_path}.compact'
+        data_file = self._data_file
+        index = dict(self._index)
+        end = self._end
+        garbage_before = self._garbage
+        fd = data_file.acquire()
+        try:
+            compacted = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_compacted, fd, index,
+                compacted_path)
+
+            # no appends are in progress and no awaits are made
+            # from here on until the new data file is in place
+            async with self._append_lock:
+                tail = os.pread(fd, self._end - end, end)
+                with open(compacted_path, 'ab') as f:
+                    compacted_end = f.tell()
+                    f.write(tail)
+                with open(compacted_path, 'rb') as f:
+                    new_end, garbage = self._replay(f, compacted_end,
+                                                    compacted)
+                os.replace(compacted_path, self._file_path)
+                self._data_file = _DataFile(self._file_path)
+                data_file.retire()
+                self._index = compacted
+                self._end = new_end
+                self._garbage = garbage
+            logger.info(f'Compacted {self._file_path}: '
+                        f'{garbage_before} bytes of garbage removed')
+        except BaseException:
+            if os.path.exists(compacted_path):
+                os.remove(compacted_path)
+            raise
+        finally:
+            data_file.release()
+            self._compacting = False
+
+    async def _run_compaction(self) -> None:
+        while True:
+            await asyncio.sleep(self._compaction_interval)
+            if self.needs_compaction:
+                try:
+                    await self.compact()
+                except OSError:
+                    logger.exception('Compaction failed')
+
+    async def open(self) -> None:
+        '''
+        Loads the index and starts the background compaction
+        '''
+        await self._ensure_loaded()
+        if self._compaction_task is None and self._compaction_interval:
+            self._compaction_task = asyncio.create_task(
+                self._run_compaction())
+
+    async def close(self) -> None:
+        '''
+        Stops the background compaction and closes the data file
+        '''
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            try:
+                await self._compaction_task
+            except asyncio.CancelledError:
+                pass
+            self._compaction_task = None
+        self._data_file.retire()
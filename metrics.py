@@ -0,0 +1,327 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Callable
+from conf import logger, METRICS_HOST, METRICS_PORT
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_value(value) -> str:
+    if isinstance(value, Enum):
+        value = value.value
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    '''
+    Common part of the metrics: a name, a help line, label names
+    and a value for every combination of label values
+    '''
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(_label_value(labels.get(name, ''))
+                     for name in self.labelnames)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def samples(self):
+        '''
+        Yields (name suffix, label values, extra label, value)
+        '''
+        for key, value in self._values.items():
+            yield '', key, '', value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{_format_labels(self.labelnames, key, extra)} '
+                         f'{_format_number(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    @contextmanager
+    def track(self, **labels):
+        '''
+        Counts the code inside the block as in progress
+        '''
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # counts for every bucket and +Inf, then the sum
+            counts = self._values[key] = [0] * (len(self._buckets) + 1) + \
+                [0.0]
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observes how long the code inside the block takes
+        '''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float('inf'),),
+                                    counts):
+                cumulative += count
+                yield '_bucket', key, f'le="{_format_number(bound)}"', \
+                    cumulative
+            yield '_sum', key, '', counts[-1]
+            yield '_count', key, '', cumulative
+
+
+class CallbackMetric(Metric):
+    '''
+    Metric whose value is taken from a function when it is rendered.
+    The function returns a number or a dict of numbers by label values
+    '''
+    def __init__(self, name: str, documentation: str, type: str,
+                 function: Callable, labelnames: tuple = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self._function = function
+
+    def samples(self):
+        values = self._function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            if not isinstance(key, tuple):
+                key = (key,)
+            yield '', tuple(_label_value(value) for value in key), '', value
+
+
+class Registry:
+    '''
+    Collection of metrics rendered together in Prometheus text format
+    '''
+    def __init__(self) -> None:
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str,
+                labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str,
+              labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str,
+                  labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, type: str,
+                 function: Callable, labelnames: tuple = ()) -> None:
+        '''
+        Registers a metric computed by function on every scrape,
+        replacing the previous one with the same name
+        '''
+        self.register(CallbackMetric(name, documentation, type, function,
+                                     labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception(f'Could not collect metric {metric.name}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'rksok_requests_total', 'Requests answered by the server',
+    ('verb', 'status'))
+REQUEST_LATENCY = REGISTRY.histogram(
+    'rksok_request_duration_seconds',
+    'Time from receiving a request to sending the response',
+    ('verb', 'status'))
+STAGE_LATENCY = REGISTRY.histogram(
+    'rksok_stage_duration_seconds',
+    'Time spent in every stage of handling a request: parse, '
+    'permission, storage and write', ('stage', 'verb'))
+IN_FLIGHT = REGISTRY.gauge(
+    'rksok_in_flight', 'Requests currently in every stage', ('stage',))
+SPECULATIVE_READS = REGISTRY.counter(
+    'rksok_speculative_reads_total',
+    'Storage reads started before the permission, by whether they were '
+    'used or discarded', ('result',))
+CONNECTIONS = REGISTRY.gauge(
+    'rksok_open_connections', 'Client connections currently open')
+STARTUP = REGISTRY.gauge(
+    'rksok_startup_seconds',
+    'Seconds from the start of the server to accepting connections')
+SNAPSHOT_RESTORED = REGISTRY.gauge(
+    'rksok_snapshot_restored_entries',
+    'Entries restored from the warm-start snapshot by component',
+    ('component',))
+
+
+def status_of(response: str) -> str:
+    '''
+    Returns the status word of a response
+    '''
+    return response.split(' ', 1)[0].split('\r', 1)[0]
+
+
+class MetricsServer:
+    '''
+    Small HTTP server exposing the registry on /metrics.
+    It runs on the event loop of the RKSOK server, other modules may add
+    their own GET routes
+    '''
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                 registry: Registry = REGISTRY) -> None:
+        self._host = host
+        self._port = port
+        self._registry = registry
+        self._server = None
+        self._routes = {'/metrics': self._metrics}
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    def add_route(self, path: str, handler: Callable) -> None:
+        '''
+        handler receives the query string and returns
+        (status, content type, body), it may be a coroutine function
+        '''
+        self._routes[path] = handler
+
+    def _metrics(self, query: str) -> tuple:
+        return ('200 OK', 'text/plain; version=0.0.4; charset=utf-8',
+                self._registry.render())
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(separator=b'\r\n\r\n'), 5)
+            method, target, _ = head.split(b'\r\n', 1)[0].decode(
+                'latin-1').split(' ', 2)
+            path, _, query = target.partition('?')
+            handler = self._routes.get(path)
+            if method != 'GET' or handler is None:
+                status, content_type, body = \
+                    '404 Not Found', 'text/plain', 'not found\n'
+            else:
+                result = handler(query)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                status, content_type, body = result
+            body = body.encode()
+            writer.write(f'HTTP/1.0 {status}\r\n'
+                         f'Content-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, self._host, self._port, limit=16 * 1024)
+        logger.info(f'Serving metrics on {self._host}:{self.port}')
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
@@ -0,0 +1,266 @@
+import asyncio
+import time
+from collections import deque
+from conf import logger, READ_BUFFER_SIZE, MAX_PIPELINED_REQUESTS, \
+    MAX_REQUEST_SIZE, REQUEST_HEADER_TIMEOUT, REQUEST_BODY_TIMEOUT
+from exceptions import RKSOKException
+from logs import sample_request, should_sample
+from metrics import STAGE_LATENCY
+from request import Request
+
+
+class RKSOKProtocol(asyncio.BufferedProtocol):
+    '''
+    RKSOK transport built on asyncio.BufferedProtocol
+    Received bytes land in a reusable buffer, where requests are framed
+    incrementally, parsed right from bytes and answered one by one
+    in the order they came, pipelined requests included.
+    Reading is paused while too many requests are waiting for an answer
+    and answering is paused while the client does not read.
+    A request larger than max_request_size or with a body that does not
+    arrive within body_timeout is rejected and the connection is closed,
+    so is a connection that does not send a first line in header_timeout.
+    Once no more requests are taken, whatever still arrives is dropped,
+    so the buffer does not grow while the last answers are on their way
+    '''
+    def __init__(self, server, keep_alive: bool,
+                 keep_alive_timeout: float, keep_alive_max_requests: int,
+                 buffer_size: int = READ_BUFFER_SIZE,
+                 max_pipelined: int = MAX_PIPELINED_REQUESTS,
+                 max_request_size: int = MAX_REQUEST_SIZE,
+                 header_timeout: float = REQUEST_HEADER_TIMEOUT,
+                 body_timeout: float = REQUEST_BODY_TIMEOUT) -> None:
+        self._server = server
+        self._keep_alive = keep_alive
+        self._keep_alive_timeout = keep_alive_timeout
+        self._keep_alive_max_requests = keep_alive_max_requests
+        self._max_pipelined = max_pipelined
+        self._max_request_size = max_request_size
+        self._header_timeout = header_timeout
+        self._body_timeout = body_timeout
+        self._buffer = bytearray(buffer_size)
+        # received data is self._buffer[self._start:self._end],
+        # no frame ends before self._scan
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+        self._requests = deque()
+        self._accepted = 0
+        self._closing = False
+        self._reading_paused = False
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self._transport = None
+        self._peer = None
+        self._task = None
+        self._idle_handle = None
+        self._read_handle = None
+        self._read_phase = None
+        self._rejection = None
+        self._log_connection = should_sample()
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        if self._log_connection:
+            logger.info('connection opened')
+        self._transport = transport
+        self._peer = transport.get_extra_info('peername')
+        self._server.protocol_opened(self)
+        self._watch_read(waiting=True)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self._closing = True
+        self._can_write.set()
+        self._cancel_idle_timer()
+        self._cancel_read_timer()
+        if self._task is not None:
+            self._task.cancel()
+        self._server.protocol_closed(self)
+        if self._log_connection:
+            logger.info('connection closed')
+
+    def pause_writing(self) -> None:
+        self._can_write.clear()
+
+    def resume_writing(self) -> None:
+        self._can_write.set()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._closing:
+            # no more requests are taken, received bytes are dropped
+            self._start = self._end = self._scan = 0
+        elif self._end == len(self._buffer):
+            if self._start:
+                # move the unparsed tail to the beginning of the buffer
+                pending = self._end - self._start
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+                self._scan -= self._start
+                self._start, self._end = 0, pending
+            else:
+                self._buffer = self._buffer + bytes(len(self._buffer))
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        if self._closing:
+            return
+        self._end += nbytes
+        self._cancel_idle_timer()
+        self._parse_frames()
+
+    def eof_received(self) -> bool:
+        # let the requests in progress be answered, then close
+        self._closing = True
+        if self._task is None:
+            self._transport.close()
+        return True
+
+    def _parse_frames(self) -> None:
+        '''
+        Takes every complete request from the buffer
+        '''
+        while not self._closing:
+            frame_end = self._buffer.find(
+                b'\r\n\r\n', self._scan, self._end)
+            if frame_end < 0:
+                self._scan = max(self._start, self._end - 3)
+                break
+            frame_end += 4
+            if frame_end - self._start > self._max_request_size:
+                self._reject('too_large')
+                break
+            self._requests.append((time.perf_counter(), self._parse(
+                bytes(memoryview(self._buffer)[self._start:frame_end]))))
+            self._start = self._scan = frame_end
+            self._accepted += 1
+            if not self._keep_alive or \
+                    self._accepted >= self._keep_alive_max_requests:
+                self._closing = True
+
+        if self._end - self._start > self._max_request_size and \
+                not self._closing:
+            self._reject('too_large')
+        if self._closing or self._start == self._end:
+            self._start = self._end = self._scan = 0
+        self._watch_read()
+        if len(self._requests) >= self._max_pipelined and \
+                not self._reading_paused:
+            self._reading_paused = True
+            self._transport.pause_reading()
+        self._ensure_serving()
+
+    def _ensure_serving(self) -> None:
+        if (self._requests or self._rejection) and self._task is None:
+            self._task = asyncio.create_task(self._serve())
+
+    def _reject(self, reason: str) -> None:
+        '''
+        Stops taking requests, the connection is closed
+        with a rejection after the requests taken before are answered
+        '''
+        self._closing = True
+        self._rejection = reason
+        self._cancel_read_timer()
+        self._ensure_serving()
+
+    def _watch_read(self, waiting: bool = False) -> None:
+        '''
+        Runs the header timer until the first line of the request
+        being received is complete and the body timer after that
+        '''
+        if self._closing or (self._start == self._end and not waiting):
+            self._cancel_read_timer()
+            return
+        if self._read_phase == 'body':
+            return
+        header_received = self._buffer.find(
+            b'\r\n', self._start, self._end) >= 0
+        phase = 'body' if header_received else 'header'
+        if phase == self._read_phase:
+            return
+        self._cancel_read_timer()
+        self._read_phase = phase
+        self._read_handle = asyncio.get_running_loop().call_later(
+            self._body_timeout if header_received else self._header_timeout,
+            self._read_timed_out)
+
+    def _cancel_read_timer(self) -> None:
+        if self._read_handle is not None:
+            self._read_handle.cancel()
+            self._read_handle = None
+        self._read_phase = None
+
+    def _read_timed_out(self) -> None:
+        phase = self._read_phase
+        self._read_handle = None
+        self._read_phase = None
+        if phase == 'body':
+            self._reject('read_timeout')
+        else:
+            self.close_if_idle()
+
+    def _parse(self, data: bytes) -> Request | None:
+        started = time.perf_counter()
+        try:
+            request = Request.from_bytes(data)
+        except RKSOKException:
+            logger.info(f'Could not parse request from {self._peer}: '
+                        f'{data!r}')
+            request = None
+        STAGE_LATENCY.observe(
+            time.perf_counter() - started, stage='parse',
+            verb='invalid' if request is None else request.method)
+        return request
+
+    async def _serve(self) -> None:
+        '''
+        Answers the requests in the order they came
+        '''
+        task = asyncio.current_task()
+        self._server.request_started(task)
+        try:
+            while self._requests:
+                started, request = self._requests.popleft()
+                if self._reading_paused and \
+                        len(self._requests) < self._max_pipelined // 2:
+                    self._reading_paused = False
+                    self._transport.resume_reading()
+                sample_request()
+                response = await self._server.respond(request, self._peer)
+                if self._transport.is_closing():
+                    return
+                verb = 'invalid' if request is None else request.method
+                with STAGE_LATENCY.time(stage='write', verb=verb):
+                    self._transport.write(response.encode())
+                    await self._can_write.wait()
+                self._server.request_answered(
+                    self._peer, verb, response, started)
+            if self._rejection is not None and \
+                    not self._transport.is_closing():
+                response = self._server.reject(self._rejection)
+                logger.info(f'Rejected request from {self._peer} '
+                            f'({self._rejection}): {response!r}')
+                self._transport.write(response.encode())
+        finally:
+            self._server.request_finished(task)
+            self._task = None
+        if self._closing or self._server.is_stopping:
+            self._transport.close()
+        else:
+            self._start_idle_timer()
+
+    def _start_idle_timer(self) -> None:
+        self._idle_handle = asyncio.get_running_loop().call_later(
+            self._keep_alive_timeout, self._transport.close)
+
+    def _cancel_idle_timer(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def close_if_idle(self) -> None:
+        '''
+        Stops taking new requests, closes the connection right away
+        if no request is in progress
+        '''
+        self._closing = True
+        if self._task is None:
+            self._transport.close()
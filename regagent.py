@@ -1,39 +1,691 @@
 import asyncio
-from conf import logger, REG_PORT, REG_HOST, REG_PREFIX, ResponseStatus
+import time
+import weakref
+from collections import deque, OrderedDict
+from conf import logger, REG_PORT, REG_HOST, REG_PREFIX, ResponseStatus, \
+    REG_POOL_SIZE, REG_POOL_IDLE_TIMEOUT, VERDICT_CACHE_ENABLED, \
+    VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL_APPROVED, VERDICT_CACHE_TTL_DENIED, \
+    REG_SINGLE_FLIGHT, REG_PIPELINE, REG_PIPELINE_WINDOW, \
+    REG_PIPELINE_MAX_BATCH, REG_TIMEOUT, REG_HEDGE, REG_HEDGE_WINDOW, \
+    REG_HEDGE_MIN_DELAY, REG_BREAKER_FAILURES, REG_BREAKER_RESET, \
+    REG_FALLBACK_RESPONSE
+from diagnostics import watched
 from exceptions import UndefinedResponseFromRegAgent
+from logs import sampled
+from metrics import REGISTRY
+
+
+class RegAgentPool:
+    '''
+    Keeps a bounded set of warm connections to the regulatory agent
+    so that consecutive permission checks do not pay for a TCP handshake.
+    Idle connections are health-checked before reuse, broken ones
+    are closed and replaced by fresh ones.
+    '''
+    def __init__(self, host: str, port: int,
+                 size: int = REG_POOL_SIZE,
+                 idle_timeout: float = REG_POOL_IDLE_TIMEOUT) -> None:
+        self._host = host
+        self._port = port
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._idle = deque()
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def _is_healthy(self, reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter, last_used: float) -> bool:
+        '''
+        Checks that an idle connection can be used for the next request:
+        it is not closed by either side, has no pending errors
+        and has not been idle for too long
+        '''
+        if writer.is_closing() or reader.at_eof():
+            return False
+        if reader.exception() is not None:
+            return False
+        return time.monotonic() - last_used < self._idle_timeout
+
+    async def _open(self) -> tuple:
+        return await asyncio.open_connection(
+            self._host, self._port, limit=float('inf'))
+
+    async def acquire(self) -> tuple:
+        '''
+        Returns (reader, writer, reused) with a healthy idle connection
+        if there is one, otherwise opens a new connection
+        '''
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if self._is_healthy(reader, writer, last_used):
+                return reader, writer, True
+            self._close(writer)
+        reader, writer = await self._open()
+        return reader, writer, False
+
+    def release(self, reader: asyncio.StreamReader,
+                writer: asyncio.StreamWriter) -> None:
+        '''
+        Returns a connection to the pool or closes it if the pool is full
+        '''
+        if len(self._idle) >= self._size or writer.is_closing():
+            self._close(writer)
+            return
+        self._idle.append((reader, writer, time.monotonic()))
+
+    def _close(self, writer: asyncio.StreamWriter) -> None:
+        if not writer.is_closing():
+            writer.close()
+
+    async def request(self, payload: bytes) -> bytes:
+        '''
+        Sends the payload over a pooled connection and reads one response.
+        If a reused connection turns out to be dead, the request
+        is retried once over a fresh connection.
+        '''
+        reader, writer, reused = await self.acquire()
+        try:
+            writer.write(payload)
+            await writer.drain()
+            response = await reader.readuntil(separator=b'\r\n\r\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self._close(writer)
+            if not reused:
+                raise
+            logger.info('Connection to regulatory agent ' +
+                        f'({self._host}, {self._port}) was broken, reopening')
+            reader, writer = await self._open()
+            try:
+                writer.write(payload)
+                await writer.drain()
+                response = await reader.readuntil(separator=b'\r\n\r\n')
+            except BaseException:
+                self._close(writer)
+                raise
+        except BaseException:
+            self._close(writer)
+            raise
+        self.release(reader, writer)
+        return response
+
+    async def close(self) -> None:
+        '''
+        Closes all idle connections
+        '''
+        while self._idle:
+            _, writer, _ = self._idle.pop()
+            self._close(writer)
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class RegAgentPipeline:
+    '''
+    Gathers the permission checks that arrive within window seconds
+    and sends them back-to-back over one pooled connection in one write,
+    the responses are matched to the requests in the order they come.
+    An agent that answers part of a batch and closes the connection,
+    does not send the next response within timeout seconds
+    or answers a batch with something that is not a verdict is taken
+    as not supporting pipelining: the unanswered requests and all
+    later ones are sent one per connection through the pool
+    '''
+    def __init__(self, pool: RegAgentPool,
+                 window: float = REG_PIPELINE_WINDOW,
+                 max_batch: int = REG_PIPELINE_MAX_BATCH,
+                 msg_approved: str = ResponseStatus.APPROVED,
+                 msg_denied: str = ResponseStatus.NOT_APPROVED,
+                 timeout: float = REG_TIMEOUT) -> None:
+        self._pool = pool
+        self._window = window
+        self._max_batch = max_batch
+        self._timeout = timeout
+        self._verdicts = (msg_approved.encode(), msg_denied.encode())
+        self._pending = []
+        self._flush_handle = None
+        self._batches = set()
+        self.supported = True
+
+    async def request(self, payload: bytes) -> bytes:
+        '''
+        Sends the payload with the next batch and returns its response
+        '''
+        if not self.supported:
+            return await self._pool.request(payload)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((payload, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self._window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _exchange(self, batch: list, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> int:
+        '''
+        Writes the whole batch and resolves the requests with
+        the responses in order, returns the number of answered ones
+        '''
+        answered = 0
+        try:
+            writer.write(b''.join(payload for payload, _ in batch))
+            await writer.drain()
+            while answered < len(batch):
+                response = await asyncio.wait_for(
+                    reader.readuntil(separator=b'\r\n\r\n'), self._timeout)
+                if len(batch) > 1 and not response.startswith(self._verdicts):
+                    self._disable('answered a batch with ' + repr(response))
+                    break
+                future = batch[answered][1]
+                if not future.done():
+                    future.set_result(response)
+                answered += 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if answered:
+                self._disable(f'closed the connection after {answered} of '
+                              f'{len(batch)} responses')
+        except asyncio.TimeoutError:
+            if answered:
+                self._disable(f'stopped answering after {answered} of '
+                              f'{len(batch)} responses')
+        if answered < len(batch):
+            self._pool._close(writer)
+        else:
+            self._pool.release(reader, writer)
+        return answered
+
+    def _disable(self, reason: str) -> None:
+        if self.supported:
+            self.supported = False
+            logger.info('Regulatory agent does not support pipelining, '
+                        f'it {reason}, sending one request per connection')
+
+    async def _send(self, batch: list) -> None:
+        PIPELINE_BATCH_SIZE.observe(len(batch))
+        try:
+            reader, writer, reused = await self._pool.acquire()
+            answered = await self._exchange(batch, reader, writer)
+            if not answered and reused:
+                reader, writer = await self._pool._open()
+                answered = await self._exchange(batch, reader, writer)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # the callers that gave up waiting are not sent again
+        await asyncio.gather(*[self._send_alone(payload, future)
+                               for payload, future in batch[answered:]
+                               if not future.done()])
+
+    async def _send_alone(self, payload: bytes,
+                          future: asyncio.Future) -> None:
+        try:
+            response = await asyncio.wait_for(self._pool.request(payload),
+                                              self._timeout)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(response)
+
+    async def close(self) -> None:
+        '''
+        Sends the gathered requests and waits for the batches in flight
+        '''
+        self._flush()
+        if self._batches:
+            await asyncio.wait(self._batches)
+
+
+class SingleFlight:
+    '''
+    Deduplicates concurrent calls with the same key:
+    the first caller starts the call and all callers that come
+    while it is in flight wait for the same result or exception
+    '''
+    def __init__(self) -> None:
+        self._calls = {}
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def _forget(self, key, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # the exception is delivered to the waiters,
+            # retrieve it here in case all of them were cancelled
+            task.exception()
+
+    async def do(self, key, call):
+        '''
+        Awaits call() or joins the call with the same key in flight.
+        Cancelling one waiter does not cancel the shared call
+        '''
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda task: self._forget(key, task))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+
+class CircuitBreaker:
+    '''
+    Counts failed calls to the regulatory agent in a row.
+    After failures of them the circuit opens and calls fail fast
+    for reset_timeout seconds, then one trial call is let through:
+    its success closes the circuit, its failure opens it again
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures: int = REG_BREAKER_FAILURES,
+                 reset_timeout: float = REG_BREAKER_RESET) -> None:
+        self._failures = failures
+        self._reset_timeout = reset_timeout
+        self._failed = 0
+        self._opened_at = 0.0
+        self.state = self.CLOSED
+
+    def allow(self) -> bool:
+        '''
+        Tells whether a call may be made now
+        '''
+        if self.state == self.CLOSED:
+            return True
+        # a trial call that got lost without a result does not keep
+        # the circuit half open forever
+        if time.monotonic() - self._opened_at >= self._reset_timeout:
+            self.state = self.HALF_OPEN
+            self._opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self._failed = 0
+        self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        self._failed += 1
+        if self.state == self.HALF_OPEN or self._failed >= self._failures:
+            if self.state != self.OPEN:
+                logger.error('Regulatory agent is down, answering with the '
+                             f'fallback verdict for {self._reset_timeout}s')
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    '''
+    Keeps the last size latencies of the agent to tell its percentiles,
+    they are recomputed every refresh observations
+    '''
+    def __init__(self, size: int = REG_HEDGE_WINDOW, min_samples: int = 20,
+                 refresh: int = 50) -> None:
+        self._latencies = deque(maxlen=size)
+        self._min_samples = min_samples
+        self._refresh = refresh
+        self._observed = 0
+        self._p95 = None
+
+    def observe(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._observed += 1
+        if self._observed % self._refresh == 0:
+            self._p95 = None
+
+    @property
+    def p95(self) -> float | None:
+        '''
+        Returns None until there are enough latencies
+        '''
+        if self._p95 is None and len(self._latencies) >= self._min_samples:
+            latencies = sorted(self._latencies)
+            self._p95 = latencies[int(len(latencies) * 0.95) - 1]
+        return self._p95
+
+
+async def hedge_call(call, delay: float):
+    '''
+    Awaits call(), if it has not finished in delay seconds starts
+    a second call() and returns the result of the first one to succeed
+    '''
+    first = asyncio.ensure_future(call())
+    attempts = {first}
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if done:
+            return first.result()
+        HEDGES.inc(result='sent')
+        attempts.add(asyncio.ensure_future(call()))
+        while attempts:
+            done, attempts = await asyncio.wait(
+                attempts, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None:
+                    if attempt is not first:
+                        HEDGES.inc(result='won')
+                    return attempt.result()
+        raise attempt.exception()
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+
+_pools = weakref.WeakKeyDictionary()
+_pipelines = weakref.WeakKeyDictionary()
+_single_flights = weakref.WeakKeyDictionary()
+# circuit breakers and latencies by agent address
+_breakers = {}
+_latencies = {}
+
+
+def get_pool(reg_host: str, reg_port: int) -> RegAgentPool:
+    '''
+    Returns the connection pool to the given regulatory agent
+    for the running event loop, creating it on first use
+    '''
+    loop_pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    pool = loop_pools.get((reg_host, reg_port))
+    if pool is None:
+        pool = loop_pools[(reg_host, reg_port)] = RegAgentPool(
+            reg_host, reg_port)
+    return pool
+
+
+def get_pipeline(reg_host: str, reg_port: int) -> RegAgentPipeline:
+    '''
+    Returns the pipeline to the given regulatory agent for the running
+    event loop, it sends its batches over the connections of get_pool
+    '''
+    loop_pipelines = _pipelines.setdefault(asyncio.get_running_loop(), {})
+    pipeline = loop_pipelines.get((reg_host, reg_port))
+    if pipeline is None:
+        pipeline = loop_pipelines[(reg_host, reg_port)] = RegAgentPipeline(
+            get_pool(reg_host, reg_port))
+    return pipeline
+
+
+class VerdictCache:
+    '''
+    LRU cache of regulatory agent responses with a time to live.
+    Keys are the requests sent to the agent, approvals and denials
+    may have different TTLs, responses that are neither are not cached.
+    '''
+    def __init__(self, size: int = VERDICT_CACHE_SIZE,
+                 ttl_approved: float = VERDICT_CACHE_TTL_APPROVED,
+                 ttl_denied: float = VERDICT_CACHE_TTL_DENIED,
+                 msg_approved: str = ResponseStatus.APPROVED,
+                 msg_denied: str = ResponseStatus.NOT_APPROVED) -> None:
+        self._size = size
+        self._ttls = ((msg_approved, ttl_approved), (msg_denied, ttl_denied))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, reg_request: str) -> str | None:
+        '''
+        Returns the cached response or None if there is no fresh one
+        '''
+        entry = self._entries.get(reg_request)
+        if entry is not None:
+            reg_response, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(reg_request)
+                self.hits += 1
+                return reg_response
+            del self._entries[reg_request]
+        self.misses += 1
+        return None
+
+    def put(self, reg_request: str, reg_response: str) -> None:
+        '''
+        Stores the response, evicting the least recently used ones
+        if the cache is full
+        '''
+        for msg, ttl in self._ttls:
+            if reg_response.startswith(msg):
+                break
+        else:
+            return
+        if ttl <= 0 or self._size <= 0:
+            return
+        self._entries[reg_request] = (reg_response, time.monotonic() + ttl)
+        self._entries.move_to_end(reg_request)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def snapshot(self) -> list:
+        '''
+        Returns the fresh entries as [request, response, expiry time],
+        the expiry time is taken from time.time()
+        '''
+        now, wall_now = time.monotonic(), time.time()
+        return [[reg_request, reg_response, wall_now + expires_at - now]
+                for reg_request, (reg_response, expires_at)
+                in self._entries.items() if expires_at > now]
+
+    def restore(self, entries: list) -> None:
+        '''
+        Puts the entries returned by snapshot() that are still fresh
+        back into the cache
+        '''
+        now, wall_now = time.monotonic(), time.time()
+        for reg_request, reg_response, expires_at in entries:
+            if expires_at > wall_now:
+                self._entries[reg_request] = (reg_response,
+                                              now + expires_at - wall_now)
+                self._entries.move_to_end(reg_request)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+verdict_cache = VerdictCache() if VERDICT_CACHE_ENABLED else None
+
+if verdict_cache is not None:
+    REGISTRY.callback(
+        'rksok_verdict_cache_requests_total',
+        'Lookups in the verdict cache by result', 'counter',
+        lambda: {'hit': verdict_cache.hits, 'miss': verdict_cache.misses},
+        ('result',))
+    REGISTRY.callback('rksok_verdict_cache_entries',
+                      'Verdicts in the cache', 'gauge',
+                      lambda: len(verdict_cache))
+REG_CALLS = REGISTRY.counter(
+    'rksok_reg_calls_total',
+    'Calls to the regulatory agent by result: ok, timeout, error '
+    'or short_circuited while the circuit is open', ('result',))
+REG_LATENCY = REGISTRY.histogram(
+    'rksok_reg_latency_seconds', 'Time the regulatory agent takes to answer')
+HEDGES = REGISTRY.counter(
+    'rksok_reg_hedges_total',
+    'Second attempts sent to the regulatory agent and those that '
+    'answered first', ('result',))
+REGISTRY.callback(
+    'rksok_reg_circuit_open', 'Whether the regulatory agent is taken as down',
+    'gauge', lambda: {f'{host}:{port}': int(
+        breaker.state != CircuitBreaker.CLOSED)
+        for (host, port), breaker in _breakers.items()}, ('agent',))
+PIPELINE_BATCH_SIZE = REGISTRY.histogram(
+    'rksok_reg_pipeline_batch_size',
+    'Permission checks sent to the regulatory agent in one write',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+REGISTRY.callback(
+    'rksok_reg_single_flight_shared_total',
+    'Permission checks that joined one already in flight', 'counter',
+    lambda: sum(single_flight.shared
+                for single_flight in list(_single_flights.values())))
+REGISTRY.callback(
+    'rksok_reg_pool_idle_connections',
+    'Idle connections to the regulatory agent', 'gauge',
+    lambda: sum(pool.idle_count for loop_pools in list(_pools.values())
+                for pool in loop_pools.values()))
+
+
+def get_single_flight() -> SingleFlight:
+    '''
+    Returns the in-flight permission checks of the running event loop
+    '''
+    loop = asyncio.get_running_loop()
+    single_flight = _single_flights.get(loop)
+    if single_flight is None:
+        single_flight = _single_flights[loop] = SingleFlight()
+    return single_flight
 
 
 def prepare_request_to_reg_agent(raw_request: str, prefix: str) -> str:
     return f'{prefix}{raw_request}'
 
 
+async def _request_reg_agent(reg_request: str,
+                             reg_host: str,
+                             reg_port: int,
+                             cache: VerdictCache | None,
+                             pipeline: bool = REG_PIPELINE) -> str:
+    '''
+    Makes one round trip to the regulatory agency over a pooled connection,
+    batched with other requests if pipeline is set
+    '''
+    if sampled():
+        logger.opt(lazy=True).info(
+            'Asked for permission from regulatory agency ({}, {}): {!r}',
+            lambda: reg_host, lambda: reg_port, lambda: reg_request)
+
+    if pipeline:
+        client = get_pipeline(reg_host, reg_port)
+    else:
+        client = get_pool(reg_host, reg_port)
+    reg_response = await client.request(reg_request.encode())
+    reg_response = f'{reg_response.decode()}'
+    if sampled():
+        logger.opt(lazy=True).info(
+            'Got response from regulatory agent ({}, {}): {!r}',
+            lambda: reg_host, lambda: reg_port, lambda: reg_response)
+    if cache is not None:
+        cache.put(reg_request, reg_response)
+    return reg_response
+
+
+async def _call_reg_agent(reg_request: str,
+                          reg_host: str,
+                          reg_port: int,
+                          cache: VerdictCache | None,
+                          pipeline: bool,
+                          timeout: float | None,
+                          hedge: bool) -> str:
+    '''
+    Asks the regulatory agency within timeout seconds, hedging the request
+    if hedge is set. Answers with REG_FALLBACK_RESPONSE when the agent
+    fails, does not answer in time or is taken as down
+    '''
+    breaker = _breakers.setdefault((reg_host, reg_port), CircuitBreaker())
+    if not breaker.allow():
+        REG_CALLS.inc(result='short_circuited')
+        return REG_FALLBACK_RESPONSE
+
+    latencies = _latencies.setdefault((reg_host, reg_port), LatencyWindow())
+    delay = latencies.p95 if hedge else None
+    started = time.monotonic()
+    try:
+        if delay is None:
+            call = _request_reg_agent(
+                reg_request, reg_host, reg_port, cache, pipeline)
+        else:
+            call = hedge_call(
+                lambda: _request_reg_agent(
+                    reg_request, reg_host, reg_port, cache, pipeline),
+                max(delay, REG_HEDGE_MIN_DELAY))
+        reg_response = await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        breaker.record_failure()
+        REG_CALLS.inc(result='timeout')
+        logger.error(f'Regulatory agency ({reg_host}, {reg_port}) did not '
+                     f'answer in {timeout}s: {reg_request!r}')
+        return REG_FALLBACK_RESPONSE
+    except (OSError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError) as e:
+        breaker.record_failure()
+        REG_CALLS.inc(result='error')
+        logger.error(f'Could not ask regulatory agency ({reg_host}, '
+                     f'{reg_port}): {e!r}')
+        return REG_FALLBACK_RESPONSE
+    latency = time.monotonic() - started
+    breaker.record_success()
+    latencies.observe(latency)
+    REG_LATENCY.observe(latency)
+    REG_CALLS.inc(result='ok')
+    return reg_response
+
+
 async def ask_permission(raw_request: str,
                          reg_host: str = REG_HOST,
                          reg_port: int = REG_PORT,
-                         reg_prefix: str = REG_PREFIX
+                         reg_prefix: str = REG_PREFIX,
+                         cache: VerdictCache | None = None,
+                         single_flight: bool = REG_SINGLE_FLIGHT,
+                         pipeline: bool = REG_PIPELINE,
+                         timeout: float | None = REG_TIMEOUT,
+                         hedge: bool = REG_HEDGE
                          ) -> str:
     '''
-    Creates a connection to the regulatory agency
-    sends a request and saves a response
+    Sends a request to the regulatory agency and returns its response.
+    If the verdict cache is enabled, fresh verdicts are taken from it.
+    Concurrent identical requests share one round trip to the agency,
+    with pipeline concurrent different ones share one write.
+    If the agency does not answer in timeout seconds or is down,
+    the fallback verdict REG_FALLBACK_RESPONSE is returned
     '''
     reg_request = prepare_request_to_reg_agent(
         raw_request, reg_prefix)
 
-    reader, writer = await asyncio.open_connection(
-        reg_host, reg_port, limit=float('inf'))
-
-    logger.info(f'Asked for permission from regulatory \
-        agency ({reg_host}, {reg_port}): {reg_request!r}')
+    if cache is None:
+        cache = verdict_cache
+    if cache is not None:
+        reg_response = cache.get(reg_request)
+        if reg_response is not None:
+            return reg_response
 
-    writer.write(reg_request.encode())
-    await writer.drain()
-    reg_response = await reader.readuntil(separator=b'\r\n\r\n')
-    reg_response = f'{reg_response.decode()}'
-    logger.info(f'Got response from regulatory agent: \
-        ({reg_host}, {reg_port}): {reg_request!r}')
-    writer.close()
-    await writer.wait_closed()
-    return reg_response
+    with watched('ask_permission'):
+        if not single_flight:
+            return await _call_reg_agent(reg_request, reg_host, reg_port,
+                                         cache, pipeline, timeout, hedge)
+        return await get_single_flight().do(
+            (reg_host, reg_port, reg_request),
+            lambda: _call_reg_agent(reg_request, reg_host, reg_port, cache,
+                                    pipeline, timeout, hedge))
 
 
 async def process_permission(reg_agent_response: str,
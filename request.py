@@ -3,6 +3,10 @@ from exceptions import NameIsTooLongError, CanNotParseRequestError, \
 from conf import RequestVerb, PROTOCOL
 
 
+MAX_NAME_LENGTH = 30
+VALID_VERBS = [RequestVerb.GET, RequestVerb.DELETE, RequestVerb.WRITE]
+
+
 class Request:
     '''Class for managing requests sent to RKSOK server'''
     def __init__(self, raw_request: str) -> None:
@@ -13,6 +17,21 @@ class Request:
         self._body = None
         self.parse_request()
 
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Request':
+        '''
+        Creates a request right from the received bytes
+        of a complete request, see parse_bytes
+        '''
+        request = cls.__new__(cls)
+        request._raw_request = None
+        request._method = None
+        request._name = None
+        request._protocol = None
+        request._body = None
+        request.parse_bytes(data)
+        return request
+
     @property
     def raw_request(self):
         return self._raw_request
@@ -59,11 +78,10 @@ class Request:
         self._name = ' '.join(first_line_words[1:-1])
         self._protocol = first_line_words[-1]
 
-        valid_verbs = [RequestVerb.GET, RequestVerb.DELETE, RequestVerb.WRITE]
-        if self.method not in valid_verbs:
+        if self.method not in VALID_VERBS:
             raise InvalidMethodError
 
-        if len(self._name) > 30:
+        if len(self._name) > MAX_NAME_LENGTH:
             raise NameIsTooLongError
 
         if self._protocol != PROTOCOL:
@@ -73,6 +91,48 @@ class Request:
             self._body = [line.strip() for line in request_lines
                           if line.strip()][1:]
 
+    def parse_bytes(self, data: bytes) -> None:
+        '''
+        Parses a complete request (ending with an empty line)
+        the same way as parse_request, but checks the first line
+        before decoding the rest, so bad requests are rejected cheaply.
+        The first line is split as a str, on any Unicode whitespace
+        like parse_request does. The request is decoded once
+        and the body is stripped once
+        '''
+        if not data.endswith(b'\r\n'):
+            raise CanNotParseRequestError
+
+        first_line_end = data.find(b'\n')
+        try:
+            first_line_words = data[:first_line_end].decode().split()
+        except UnicodeDecodeError:
+            raise CanNotParseRequestError
+        if len(first_line_words) <= 2:
+            raise CanNotParseRequestError
+
+        if first_line_words[0] not in VALID_VERBS:
+            raise InvalidMethodError
+        method = RequestVerb(first_line_words[0])
+
+        self._name = ' '.join(first_line_words[1:-1])
+        if len(self._name) > MAX_NAME_LENGTH:
+            raise NameIsTooLongError
+
+        if first_line_words[-1] != PROTOCOL:
+            raise InvalidProtocolError
+        try:
+            self._raw_request = data.decode()
+        except UnicodeDecodeError:
+            raise CanNotParseRequestError
+
+        self._method = method
+        self._protocol = PROTOCOL
+        if method == RequestVerb.WRITE:
+            body_start = self._raw_request.find('\n') + 1
+            body = self._raw_request[body_start:].split('\n')
+            self._body = [line for line in map(str.strip, body) if line]
+
     def __str__(self):
         return f'Request object. Method: {self._method} \
             Name: {self._name}, Protocol: {self._protocol}, Body: {self._body}'
@@ -1,10 +1,24 @@
-from conf import logger, RequestVerb, ResponseStatus, PROTOCOL
+import asyncio
+import time
+from conf import logger, RequestVerb, ResponseStatus, PROTOCOL, \
+    OVERLOAD_STATUS, SPECULATIVE_GET
+from metrics import STAGE_LATENCY, IN_FLIGHT, SPECULATIVE_READS
 from regagent import ask_permission, process_permission
 from request import Request
 from exceptions import RKSOKException
 from storage import FilePhoneBook, Storage
 
 
+def _discard(read: asyncio.Future) -> None:
+    '''
+    Drops a speculative read, its result or error is never looked at
+    '''
+    SPECULATIVE_READS.inc(result='discarded')
+    read.cancel()
+    read.add_done_callback(
+        lambda read: read.cancelled() or read.exception())
+
+
 class Response:
     '''
     Class for creating a response to the RKSOK request
@@ -20,7 +34,26 @@ class Response:
         self._request = self.set_request(raw_request)
         self._response = ''
 
+    @classmethod
+    def from_request(cls, request: Request | None) -> 'Response':
+        '''
+        Creates a response to an already parsed request,
+        None stands for a request that could not be parsed
+        '''
+        response = cls.__new__(cls)
+        response._request = request
+        response._response = ''
+        return response
+
+    @property
+    def verb(self) -> str:
+        '''
+        Verb of the request, 'invalid' if it could not be parsed
+        '''
+        return 'invalid' if self._request is None else self._request.method
+
     def set_request(self, raw_request: str) -> Request | None:
+        started = time.perf_counter()
         try:
             self._request = Request(raw_request)
         except (RKSOKException):
@@ -28,14 +61,21 @@ class Response:
                              during the parsing of the request',
                              backtrace=False, diagnose=False)
             self._request = None
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage='parse',
+                              verb=self.verb)
         return self._request
 
-    async def _make_get(self, storage: Storage) -> str:
+    async def _make_get(self, storage: Storage,
+                        prefetched: asyncio.Future | None = None) -> str:
         '''
-        Prepares a response to a GET ('ОТДОВАЙ') request from RKSOK client
+        Prepares a response to a GET ('ОТДОВАЙ') request from RKSOK client,
+        prefetched is a read of the phones started in advance
         '''
         try:
-            phone = await storage.get(self._request.name)
+            if prefetched is None:
+                phone = await storage.get(self._request.name)
+            else:
+                phone = await prefetched
             self._response = f'{ResponseStatus.OK} ' + \
                 f'{PROTOCOL}\r\n{phone.strip()}\r\n\r\n'
 
@@ -56,7 +96,7 @@ class Response:
         Prepares a response to a DELETE ('УДОЛИ') request from RKSOK client
         '''
         try:
-            storage.delete(self._request.name)
+            await storage.delete(self._request.name)
             self._response = f'{ResponseStatus.OK} {PROTOCOL}\r\n\r\n'
         except FileNotFoundError:
             self._response = f'{ResponseStatus.NOTFOUND} {PROTOCOL}\r\n\r\n'
@@ -70,20 +110,54 @@ class Response:
             f'{PROTOCOL}\r\n\r\n'
         return self._response
 
-    async def make_response(self, storage: FilePhoneBook) -> str:
+    def _make_overloaded(self) -> str:
+        '''
+        Prepares a response for the RKSOK request we rejected
+        because the server is overloaded
+        '''
+        self._response = f'{OVERLOAD_STATUS} {PROTOCOL}\r\n\r\n'
+        return self._response
+
+    async def make_response(self, storage: FilePhoneBook,
+                            speculative_get: bool = SPECULATIVE_GET) -> str:
         '''
         Matches RKSOK request to the appropriate handling method
+        With speculative_get the phones of an ОТДОВАЙ request are read
+        while the regulatory agent is being asked and thrown away
+        unless the request is approved. Other verbs change the storage,
+        so they always wait for the permission
         '''
 
         if self._request is None:
             return self._make_bad_request()
 
-        reg_agent_response = await ask_permission(self._request.raw_request)
+        verb = self.verb
+        prefetched = None
+        if speculative_get and self._request.method == RequestVerb.GET:
+            prefetched = asyncio.ensure_future(
+                storage.get(self._request.name))
+        try:
+            with STAGE_LATENCY.time(stage='permission', verb=verb), \
+                    IN_FLIGHT.track(stage='permission'):
+                reg_agent_response = await ask_permission(
+                    self._request.raw_request)
 
-        permission_granted = await process_permission(reg_agent_response)
+                permission_granted = await process_permission(
+                    reg_agent_response)
+        except BaseException:
+            if prefetched is not None:
+                _discard(prefetched)
+            raise
 
         if not permission_granted:
+            if prefetched is not None:
+                _discard(prefetched)
             self._response = reg_agent_response
             return self._response
-        return await getattr(self, self.method_map[self._request.method],
-                             self._make_bad_request)(storage)
+        with STAGE_LATENCY.time(stage='storage', verb=verb), \
+                IN_FLIGHT.track(stage='storage'):
+            if prefetched is not None:
+                SPECULATIVE_READS.inc(result='used')
+                return await self._make_get(storage, prefetched)
+            return await getattr(self, self.method_map[self._request.method],
+                                 self._make_bad_request)(storage)
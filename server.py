@@ -1,67 +1,477 @@
+import argparse
 import asyncio
-import sys
-from storage import FilePhoneBook, Storage
-from conf import logger, HOST, PORT, FOLDERPATH
+import signal
+import time
+from storage import FilePhoneBook, CachedStorage, Storage, find_layer
+from conf import logger, HOST, PORT, FOLDERPATH, KEEP_ALIVE, \
+    KEEP_ALIVE_TIMEOUT, KEEP_ALIVE_MAX_REQUESTS, SHUTDOWN_TIMEOUT, WORKERS, \
+    STORAGE_CACHE_ENABLED, STORAGE_BACKEND, LOG_STORAGE_PATH, SQLITE_PATH, \
+    BLOOM_ENABLED, WRITE_BEHIND_ENABLED, TRANSPORT, MAX_REQUEST_SIZE, \
+    REQUEST_HEADER_TIMEOUT, REQUEST_BODY_TIMEOUT, METRICS_ENABLED, \
+    METRICS_HOST, METRICS_PORT, CLUSTER_NODES, SNAPSHOT_ENABLED, \
+    SNAPSHOT_PATH, ResponseStatus
+from admission import AdmissionController
+from bloom import BloomStorage
+from cluster import ClusterStorage
+from diagnostics import Diagnostics, watched
+from exceptions import RequestTooLargeError, RequestTimeoutError
+from logs import sample_request, sampled, should_sample
+from logstorage import LogPhoneBook
+from metrics import REGISTRY, REQUESTS, REQUEST_LATENCY, STAGE_LATENCY, \
+    IN_FLIGHT, CONNECTIONS, STARTUP, MetricsServer, status_of
+from protocol import RKSOKProtocol
+from request import Request
 from response import Response
+from snapshot import Snapshotter
+from sqlitestorage import SQLitePhoneBook
+from workers import WorkerSupervisor
+from writebehind import WriteBehindStorage
+
+
+# statuses of responses logged only when the request is sampled
+LOGGED_IF_SAMPLED = {ResponseStatus.OK, ResponseStatus.NOTFOUND}
 
 
 class Server:
-    def __init__(self, addr: str, port: int, phonebook: Storage):
+    def __init__(self, addr: str, port: int, phonebook: Storage,
+                 keep_alive: bool = KEEP_ALIVE,
+                 keep_alive_timeout: float = KEEP_ALIVE_TIMEOUT,
+                 keep_alive_max_requests: int = KEEP_ALIVE_MAX_REQUESTS,
+                 reuse_port: bool = False,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT,
+                 transport: str = TRANSPORT,
+                 max_request_size: int = MAX_REQUEST_SIZE,
+                 header_timeout: float = REQUEST_HEADER_TIMEOUT,
+                 body_timeout: float = REQUEST_BODY_TIMEOUT,
+                 admission: AdmissionController | None = None,
+                 metrics_port: int | None = None,
+                 diagnostics: Diagnostics | None = None,
+                 snapshotter: Snapshotter | None = None):
         self._addr = addr
         self._port = port
         self._phonebook = phonebook
+        self._keep_alive = keep_alive
+        self._keep_alive_timeout = keep_alive_timeout
+        self._keep_alive_max_requests = keep_alive_max_requests
+        self._reuse_port = reuse_port
+        self._shutdown_timeout = shutdown_timeout
+        self._stopping = None
+        self._transport = transport
+        self._max_request_size = max_request_size
+        self._header_timeout = header_timeout
+        self._body_timeout = body_timeout
+        self._admission = admission or AdmissionController()
+        self._connections = set()
+        self._idle_connections = set()
+        self._protocols = set()
+        self._metrics_port = metrics_port
+        self._diagnostics = diagnostics
+        self._snapshotter = snapshotter
+
+    @property
+    def admission(self) -> AdmissionController:
+        return self._admission
+
+    async def _read_body(self, reader: asyncio.StreamReader,
+                         size: int) -> bytes:
+        '''
+        Reads the lines after the first one up to the empty line
+        '''
+        lines = []
+        while True:
+            line = await reader.readuntil(separator=b'\r\n')
+            size += len(line)
+            if size > self._max_request_size:
+                raise RequestTooLargeError
+            lines.append(line)
+            if line == b'\r\n':
+                return b''.join(lines)
+
+    async def _read_request(self, reader: asyncio.StreamReader,
+                            timeout: float) -> bytes | None:
+        '''
+        Reads one request from the stream: the first line within
+        timeout, the rest of it within the body timeout.
+        Returns None if the client has closed the connection
+        or has not started a request in time.
+        Raises RequestTooLargeError or RequestTimeoutError
+        for requests that can not be accepted
+        '''
+        try:
+            header = await asyncio.wait_for(
+                reader.readuntil(separator=b'\r\n'), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise RequestTooLargeError
+        if len(header) > self._max_request_size:
+            raise RequestTooLargeError
+
+        try:
+            return header + await asyncio.wait_for(
+                self._read_body(reader, len(header)), self._body_timeout)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise RequestTooLargeError
+        except asyncio.TimeoutError:
+            raise RequestTimeoutError
+
+    async def _make_response(self, data: bytes, addr) -> tuple:
+        '''
+        Decodes the request and prepares a response to it,
+        returns the verb of the request and the response
+        '''
+        try:
+            raw_request = data.decode()
+        except UnicodeDecodeError:
+            logger.info('UnicodeDecodeError while parsing' +
+                        f'request from {addr}: {data!r}')
+            response = Response(data.decode(errors='replace'))
+            return response.verb, response._make_bad_request()
+
+        if sampled():
+            logger.opt(lazy=True).info(
+                'Received incoming request from {}: {!r}',
+                lambda: addr, lambda: raw_request)
+        response = Response(raw_request)
+        return response.verb, await self._admit(response)
+
+    async def _admit(self, response: Response) -> str:
+        '''
+        Makes the response if the server has capacity for it,
+        otherwise rejects the request
+        '''
+        if not await self._admission.enter():
+            return response._make_overloaded()
+        try:
+            with IN_FLIGHT.track(stage='request'):
+                return await response.make_response(self._phonebook)
+        finally:
+            self._admission.leave()
+
+    def request_answered(self, addr, verb: str, response: str,
+                         started: float) -> None:
+        '''
+        Logs and counts a response sent to the client, started is
+        the time.perf_counter() when the request was received.
+        Responses other than НОРМАЛДЫКС and НИНАШОЛ are always logged
+        '''
+        status = status_of(response)
+        if sampled() or status not in LOGGED_IF_SAMPLED:
+            logger.opt(lazy=True).info(
+                'Sent the following response to {}: {!r}',
+                lambda: addr, lambda: response)
+        REQUESTS.inc(verb=verb, status=status)
+        REQUEST_LATENCY.observe(time.perf_counter() - started,
+                                verb=verb, status=status)
+
+    def reject(self, reason: str) -> str:
+        '''
+        Counts a request that could not be accepted
+        and prepares the response to it
+        '''
+        self._admission.record_shed(reason)
+        return Response.from_request(None)._make_bad_request()
 
     async def handle_request(self,
                              reader: asyncio.StreamReader,
                              writer: asyncio.StreamWriter) -> str:
         '''
         Handles the connection from the client.
-        Receives request and sends the response.
+        Receives requests and sends the responses in the same order.
+        Without keep-alive the connection is closed after the first
+        response, otherwise it is closed when the client goes away,
+        stays idle for too long or has sent too many requests
         '''
-        logger.info('connection opened')
-        data = await reader.readuntil(separator=b'\r\n\r\n')
+        log_connection = should_sample()
+        if log_connection:
+            logger.info('connection opened')
+        addr = writer.get_extra_info('peername')
+        response = ''
+        served = 0
+        task = asyncio.current_task()
+        self._connections.add(task)
+        CONNECTIONS.inc()
         try:
-            raw_request = data.decode()
+            while True:
+                timeout = self._header_timeout
+                if served:
+                    timeout = self._keep_alive_timeout
+                    self._idle_connections.add(task)
+                rejected = False
+                verb = 'invalid'
+                try:
+                    data = await self._read_request(reader, timeout)
+                except RequestTooLargeError:
+                    response, rejected = self.reject('too_large'), True
+                except RequestTimeoutError:
+                    response, rejected = self.reject('read_timeout'), True
+                finally:
+                    self._idle_connections.discard(task)
+                started = time.perf_counter()
 
-            addr = writer.get_extra_info('peername')
-            logger.info('Received incoming request' +
-                        f'from {addr}: {raw_request!r}')
+                if not rejected:
+                    if data is None:
+                        break
+                    sample_request()
+                    with watched('handle_request'):
+                        verb, response = await self._make_response(
+                            data, addr)
+                with STAGE_LATENCY.time(stage='write', verb=verb):
+                    writer.write(response.encode())
+                    await writer.drain()
+                self.request_answered(addr, verb, response, started)
 
-            response = await Response(raw_request).make_response(
-                self._phonebook)
-        except UnicodeDecodeError:
-            response = await Response(raw_request)._make_bad_request(
-                self._phonebook)
-            logger.info('UnicodeDecodeError while parsing' +
-                        f'request from {addr}: {raw_request!r}')
+                served += 1
+                if rejected or not self._keep_alive or self.is_stopping or \
+                        served >= self._keep_alive_max_requests:
+                    break
+        finally:
+            writer.close()
+            self._connections.discard(task)
+            CONNECTIONS.dec()
+            if log_connection:
+                logger.info('connection closed')
+        return response
+
+    async def respond(self, request: Request | None, addr) -> str:
+        '''
+        Prepares a response to a request parsed by RKSOKProtocol
+        '''
+        if sampled():
+            logger.opt(lazy=True).info(
+                'Received incoming request from {}: {!r}',
+                lambda: addr, lambda: request)
+        with watched('handle_request'):
+            return await self._admit(Response.from_request(request))
 
-        logger.info(f'Sent the following response to {addr}: {response!r}')
+    def protocol_opened(self, protocol: RKSOKProtocol) -> None:
+        self._protocols.add(protocol)
+        CONNECTIONS.inc()
 
-        writer.write(response.encode())
-        await writer.drain()
-        writer.close()
-        logger.info('connection closed')
-        return response
+    def protocol_closed(self, protocol: RKSOKProtocol) -> None:
+        self._protocols.discard(protocol)
+        CONNECTIONS.dec()
+
+    def request_started(self, task: asyncio.Task) -> None:
+        self._connections.add(task)
+
+    def request_finished(self, task: asyncio.Task) -> None:
+        self._connections.discard(task)
+
+    def _make_protocol(self) -> RKSOKProtocol:
+        return RKSOKProtocol(self, self._keep_alive, self._keep_alive_timeout,
+                             self._keep_alive_max_requests,
+                             max_request_size=self._max_request_size,
+                             header_timeout=self._header_timeout,
+                             body_timeout=self._body_timeout)
+
+    async def _start_server(self) -> asyncio.AbstractServer:
+        '''
+        Starts listening with the configured transport:
+        'streams' handles connections with StreamReader/StreamWriter,
+        'protocol' with RKSOKProtocol
+        '''
+        if self._transport == 'protocol':
+            return await asyncio.get_running_loop().create_server(
+                self._make_protocol, self._addr, self._port,
+                reuse_port=self._reuse_port)
+        return await asyncio.start_server(
+            self.handle_request, self._addr, self._port,
+            limit=self._max_request_size, reuse_port=self._reuse_port)
+
+    @property
+    def is_stopping(self) -> bool:
+        return self._stopping is not None and self._stopping.is_set()
+
+    def stop(self) -> None:
+        '''
+        Asks the running server to shut down gracefully
+        '''
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def _finish_connections(self) -> None:
+        '''
+        Closes idle persistent connections right away and gives
+        the requests in progress some time to finish
+        '''
+        for task in self._idle_connections:
+            task.cancel()
+        for protocol in list(self._protocols):
+            protocol.close_if_idle()
+        if not self._connections:
+            return
+        _, pending = await asyncio.wait(self._connections,
+                                        timeout=self._shutdown_timeout)
+        for task in pending:
+            task.cancel()
+
+    def _register_metrics(self) -> None:
+        '''
+        Exposes the counters kept by the admission controller
+        and the storage
+        '''
+        REGISTRY.callback(
+            'rksok_admission_queued', 'Requests waiting for admission',
+            'gauge', lambda: self._admission.queued)
+        REGISTRY.callback(
+            'rksok_admission_shed_total', 'Requests rejected by reason',
+            'counter', lambda: dict(self._admission.shed), ('reason',))
+        cache = find_layer(self._phonebook, CachedStorage)
+        if cache is not None:
+            REGISTRY.callback(
+                'rksok_storage_cache_requests_total',
+                'Lookups in the storage cache by result', 'counter',
+                lambda: {'hit': cache.hits, 'miss': cache.misses},
+                ('result',))
+            REGISTRY.callback(
+                'rksok_storage_cache_bytes', 'Size of the storage cache',
+                'gauge', lambda: cache.size)
+            REGISTRY.callback(
+                'rksok_storage_cache_fill_ratio',
+                'Share of the storage cache size limit taken', 'gauge',
+                lambda: cache.fill_ratio)
 
     @logger.catch
     async def run(self) -> None:
         '''
         Runs the server!
+        Restores the snapshot before accepting connections.
+        Stops accepting connections on stop(), SIGTERM or SIGINT
+        and waits for the requests in progress before returning
         '''
-        server = await asyncio.start_server(
-            self.handle_request, self._addr, self._port, limit=float('inf'))
+        started = time.perf_counter()
+        self._stopping = asyncio.Event()
+        if self._snapshotter is not None:
+            await self._snapshotter.restore()
+        await self._phonebook.open()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+
+        metrics_server = None
+        try:
+            if self._metrics_port is not None:
+                self._register_metrics()
+                metrics_server = MetricsServer(METRICS_HOST,
+                                               self._metrics_port)
+                try:
+                    await metrics_server.start()
+                except OSError as e:
+                    # the metrics are not worth refusing to serve
+                    logger.warning('Could not serve metrics on '
+                                   f'{METRICS_HOST}:{self._metrics_port}, '
+                                   f'serving without them: {e!r}')
+                    metrics_server = None
+            if self._diagnostics is not None:
+                self._diagnostics.start(metrics_server)
+            server = await self._start_server()
+            STARTUP.set(time.perf_counter() - started)
+            if self._snapshotter is not None:
+                self._snapshotter.start()
 
-        addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
-        print(f'Serving on {addrs}')
+            addrs = ', '.join(
+                str(sock.getsockname()) for sock in server.sockets)
+            print(f'Serving on {addrs}')
 
-        async with server:
+            async with server:
+                await self._stopping.wait()
+                logger.info('Server is shutting down')
+            await self._finish_connections()
+        finally:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
+            if self._diagnostics is not None:
+                await self._diagnostics.close()
+            if metrics_server is not None:
+                await metrics_server.close()
+            closed = False
             try:
-                await server.serve_forever()
-            except KeyboardInterrupt:
-                print('interrupted')
-                sys.exit()
+                await self._phonebook.close()
+                closed = True
+            finally:
+                # the storage that failed to close is not snapshotted
+                # as clean, its in-memory state may not match the disk
+                if self._snapshotter is not None:
+                    await self._snapshotter.close(clean=closed)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='RKSOK server')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of worker processes sharing the port')
+    args = parser.parse_args()
+    if args.workers > 1 and STORAGE_BACKEND == 'log':
+        parser.error('the log storage backend can not be shared '
+                     'by worker processes')
+    return args
+
+
+def make_backend(backend: str = STORAGE_BACKEND,
+                 path: str | None = None) -> Storage:
+    '''
+    Creates the storage backend without the layers in front of it,
+    path defaults to the one configured for the backend
+    '''
+    if backend == 'log':
+        return LogPhoneBook(path or LOG_STORAGE_PATH)
+    if backend == 'sqlite':
+        return SQLitePhoneBook(path or SQLITE_PATH)
+    if backend == 'file':
+        return FilePhoneBook(path or FOLDERPATH)
+    raise ValueError(f'Unknown storage backend {backend!r}')
+
+
+def make_storage(single_process: bool = True) -> Storage:
+    '''
+    Creates the storage configured in conf.py,
+    the bloom filter is left out when other processes write as well
+    and the log backend is refused, its index is kept by one process.
+    In cluster mode the storage keeps the names owned by this node
+    '''
+    if STORAGE_BACKEND == 'log' and not single_process:
+        raise ValueError('The log storage backend can not be shared '
+                         'by worker processes')
+    storage = make_backend()
+    if STORAGE_CACHE_ENABLED:
+        storage = CachedStorage(storage)
+    if WRITE_BEHIND_ENABLED:
+        storage = WriteBehindStorage(storage)
+    if BLOOM_ENABLED:
+        if single_process:
+            storage = BloomStorage(storage)
+        else:
+            logger.warning('The bloom filter is disabled, it can not see '
+                           'the writes of the other workers')
+    if CLUSTER_NODES:
+        storage = ClusterStorage(storage, reuse_port=not single_process)
+    return storage
+
+
+def serve(reuse_port: bool = False, worker: int = 0) -> None:
+    storage = make_storage(single_process=not reuse_port)
+    metrics_port = METRICS_PORT + worker if METRICS_ENABLED else None
+    diagnostics = Diagnostics()
+    snapshotter = None
+    if SNAPSHOT_ENABLED:
+        snapshotter = Snapshotter(
+            storage, f'{SNAPSHOT_PATH}.{worker}' if reuse_port
+            else SNAPSHOT_PATH)
+    asyncio.run(Server(HOST, PORT, storage, reuse_port=reuse_port,
+                       metrics_port=metrics_port,
+                       diagnostics=diagnostics if diagnostics.enabled
+                       else None,
+                       snapshotter=snapshotter).run())
 
 
 if __name__ == '__main__':
-    filestorage = FilePhoneBook(FOLDERPATH)
-    asyncio.run(Server(HOST, PORT, filestorage).run())
+    args = parse_args()
+    if args.workers > 1:
+        WorkerSupervisor(
+            args.workers,
+            lambda worker: serve(reuse_port=True, worker=worker)).run()
+    else:
+        serve()
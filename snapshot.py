@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+import regagent
+from conf import logger, SNAPSHOT_PATH, SNAPSHOT_INTERVAL, SNAPSHOT_MAX_AGE
+from metrics import REGISTRY, SNAPSHOT_RESTORED
+from storage import Storage, get_storage_executor
+
+
+# the magic is followed by the sha256 of the rest of the file,
+# the zlib-compressed payload
+MAGIC = b'RKSOKSN1'
+VERSION = 1
+LENGTH = struct.Struct('>Q')
+
+DISCARDED = REGISTRY.counter(
+    'rksok_snapshot_discarded_total',
+    'Snapshots not restored by reason', ('reason',))
+SNAPSHOT_AGE = REGISTRY.gauge(
+    'rksok_snapshot_age_seconds',
+    'Age of the snapshot restored on startup')
+SNAPSHOT_SECONDS = REGISTRY.gauge(
+    'rksok_snapshot_duration_seconds',
+    'Seconds the last restore or save of a snapshot took', ('action',))
+
+
+def encode_snapshot(state: dict) -> bytes:
+    '''
+    Encodes the state as JSON, bytes values are stored
+    after it as they are
+    '''
+    blobs = []
+
+    def take_blob(value):
+        if not isinstance(value, (bytes, bytearray)):
+            raise TypeError(f'Can not snapshot {type(value).__name__}')
+        blobs.append(value)
+        return {'$blob': len(blobs) - 1}
+
+    document = json.dumps(state, default=take_blob).encode()
+    payload = b''.join([LENGTH.pack(len(document)), document,
+                        *(LENGTH.pack(len(blob)) + blob for blob in blobs)])
+    compressed = zlib.compress(payload, 1)
+    return MAGIC + hashlib.sha256(compressed).digest() + compressed
+
+
+def decode_snapshot(data: bytes) -> dict:
+    '''
+    Decodes what encode_snapshot() returned, raises ValueError
+    if the data is corrupted
+    '''
+    if not data.startswith(MAGIC):
+        raise ValueError('Not a snapshot')
+    checksum = data[len(MAGIC):len(MAGIC) + 32]
+    compressed = data[len(MAGIC) + 32:]
+    if hashlib.sha256(compressed).digest() != checksum:
+        raise ValueError('Snapshot checksum does not match')
+    payload = memoryview(zlib.decompress(compressed))
+    blobs = []
+    (length,) = LENGTH.unpack_from(payload)
+    offset = LENGTH.size + length
+    document = payload[LENGTH.size:offset]
+    while offset < len(payload):
+        (blob_length,) = LENGTH.unpack_from(payload, offset)
+        offset += LENGTH.size
+        blobs.append(bytes(payload[offset:offset + blob_length]))
+        offset += blob_length
+
+    def put_blob(value: dict):
+        if value.keys() == {'$blob'}:
+            return blobs[value['$blob']]
+        return value
+
+    state = json.loads(bytes(document), object_hook=put_blob)
+    if not isinstance(state, dict):
+        raise ValueError('Snapshot is not a mapping')
+    return state
+
+
+def write_snapshot(path: str, state: dict) -> int:
+    '''
+    Replaces the snapshot at once, returns its size
+    '''
+    data = encode_snapshot(state)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(data)
+
+
+def read_snapshot(path: str) -> dict:
+    with open(path, 'rb') as f:
+        return decode_snapshot(f.read())
+
+
+class Snapshotter:
+    '''
+    Saves the in-memory state of the storage (see Storage.snapshot)
+    and of the verdict cache to path every interval seconds and on
+    close(), restore() loads it before the server starts.
+    Snapshots that are corrupted, of another version or older
+    than max_age seconds are discarded
+    '''
+    def __init__(self, storage: Storage, path: str = SNAPSHOT_PATH,
+                 interval: float = SNAPSHOT_INTERVAL,
+                 max_age: float = SNAPSHOT_MAX_AGE,
+                 verdict_cache: regagent.VerdictCache | None = None) -> None:
+        self._storage = storage
+        self._path = path
+        self._interval = interval
+        self._max_age = max_age
+        self._verdict_cache = verdict_cache
+        self._task = None
+
+    @property
+    def verdict_cache(self) -> regagent.VerdictCache | None:
+        if self._verdict_cache is None:
+            return regagent.verdict_cache
+        return self._verdict_cache
+
+    def _discard(self, reason: str, message: str) -> bool:
+        DISCARDED.inc(reason=reason)
+        logger.warning(f'Snapshot {self._path} is discarded: {message}')
+        return False
+
+    async def restore(self) -> bool:
+        '''
+        Restores the state of the last snapshot,
+        returns False if there is no usable one
+        '''
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            state = await loop.run_in_executor(get_storage_executor(),
+                                               read_snapshot, self._path)
+        except FileNotFoundError:
+            logger.info(f'No snapshot at {self._path}, starting cold')
+            return False
+        except (OSError, ValueError, zlib.error, struct.error) as e:
+            return self._discard('corrupted', repr(e))
+        if state.get('version') != VERSION:
+            return self._discard('version',
+                                 f'version {state.get("version")}')
+        age = time.time() - state.get('created', 0)
+        if not 0 <= age <= self._max_age:
+            return self._discard('stale', f'taken {age:.0f}s ago')
+        try:
+            unchanged = await self._storage.restore(state['storage'])
+            verdict_cache = self.verdict_cache
+            if verdict_cache is not None and state['verdicts']:
+                verdict_cache.restore(state['verdicts'])
+                SNAPSHOT_RESTORED.set(len(verdict_cache),
+                                      component='verdict_cache')
+        except Exception:
+            logger.exception(f'Could not restore snapshot {self._path}')
+            DISCARDED.inc(reason='error')
+            return False
+        SNAPSHOT_AGE.set(age)
+        SNAPSHOT_SECONDS.set(time.perf_counter() - started, action='restore')
+        logger.info(f'Restored snapshot {self._path} taken {age:.0f}s ago, '
+                    'the storage has ' +
+                    ('not changed since' if unchanged else 'changed since'))
+        return True
+
+    async def save(self, clean: bool = False) -> None:
+        '''
+        Takes a snapshot, clean is True when the storage is closed
+        '''
+        started = time.perf_counter()
+        verdict_cache = self.verdict_cache
+        state = {'version': VERSION, 'created': time.time(), 'clean': clean,
+                 'storage': await self._storage.snapshot(clean),
+                 'verdicts': verdict_cache.snapshot()
+                 if verdict_cache is not None else None}
+        size = await asyncio.get_running_loop().run_in_executor(
+            get_storage_executor(), write_snapshot, self._path, state)
+        SNAPSHOT_SECONDS.set(time.perf_counter() - started, action='save')
+        logger.info(f'Saved snapshot {self._path}, {size} bytes')
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.save()
+            except (OSError, TypeError, ValueError):
+                logger.exception(f'Could not save snapshot {self._path}')
+
+    def start(self) -> None:
+        '''
+        Starts the periodic snapshots
+        '''
+        if self._task is None and self._interval:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, clean: bool = True) -> None:
+        '''
+        Stops the periodic snapshots and takes the last one,
+        call it after the storage is closed, clean is False
+        if closing the storage failed
+        '''
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.save(clean=clean)
+        except Exception:
+            # the server is shutting down, nothing is left to fail
+            logger.exception(f'Could not save snapshot {self._path}')
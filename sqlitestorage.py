@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from conf import logger, SQLITE_PATH, FOLDERPATH, FILE_FANOUT
+from storage import Storage, format_phones, name_digest, \
+    iter_phonebook_files
+
+
+PUT = 'put'
+DELETE = 'delete'
+
+
+class SQLitePhoneBook(Storage):
+    '''
+    Class for storing phones in an SQLite database in WAL mode
+    Names are keyed by the hex sha256 FilePhoneBook uses for file names.
+    Writes that arrive during one tick of the event loop are committed
+    together in one transaction on a dedicated writer thread, reads go
+    through a separate read-only connection on its own thread,
+    so they never wait for the writer
+    '''
+    def __init__(self, db_path: str) -> None:
+        self._db_path = db_path
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='sqlite-writer')
+        self._reader = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='sqlite-reader')
+        self._write_connection = self._writer.submit(
+            self._connect_writer).result()
+        self._read_connection = self._reader.submit(
+            self._connect_reader).result()
+        self._pending = []
+        self._flush_scheduled = False
+        self.transactions = 0
+        # fingerprint taken by close(), the threads are gone after it
+        self._closed_fingerprint = None
+
+    def _connect_writer(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._db_path, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS phonebook ('
+                           'key TEXT PRIMARY KEY, phones TEXT NOT NULL'
+                           ') WITHOUT ROWID')
+        return connection
+
+    def _connect_reader(self) -> sqlite3.Connection:
+        return sqlite3.connect(f'file:{self._db_path}?mode=ro', uri=True,
+                               isolation_level=None)
+
+    def _get_key(self, name: str) -> str:
+        return name_digest(name).hex()
+
+    def _select(self, key: str) -> str | None:
+        row = self._read_connection.execute(
+            'SELECT phones FROM phonebook WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _commit(self, operations: list) -> list:
+        '''
+        Applies the operations in one transaction, returns the number
+        of rows changed by each of them
+        '''
+        changed = []
+        connection = self._write_connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for operation, key, phones in operations:
+                if operation == PUT:
+                    cursor = connection.execute(
+                        'INSERT OR REPLACE INTO phonebook (key, phones) '
+                        'VALUES (?, ?)', (key, phones))
+                else:
+                    cursor = connection.execute(
+                        'DELETE FROM phonebook WHERE key = ?', (key,))
+                changed.append(cursor.rowcount)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self.transactions += 1
+        return changed
+
+    def _schedule(self, operation: str, key: str,
+                  phones: str | None = None) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((operation, key, phones, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return future
+
+    def _flush(self) -> asyncio.Future | None:
+        '''
+        Sends everything queued during this tick to the writer thread
+        '''
+        self._flush_scheduled = False
+        batch, self._pending = self._pending, []
+        if not batch:
+            return None
+        committed = asyncio.get_running_loop().run_in_executor(
+            self._writer, self._commit,
+            [(operation, key, phones) for operation, key, phones, _ in batch])
+        committed.add_done_callback(
+            lambda committed: self._resolve(batch, committed))
+        return committed
+
+    def _resolve(self, batch: list, committed: asyncio.Future) -> None:
+        if committed.cancelled():
+            error = asyncio.CancelledError()
+        else:
+            error = committed.exception()
+        for i, (_, _, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(committed.result()[i])
+
+    async def get(self, name: str) -> str:
+        '''
+        Returns the phones recorded for a given name
+        '''
+        return await self.get_key(name_digest(name))
+
+    async def get_key(self, key: bytes) -> str:
+        phones = await asyncio.get_running_loop().run_in_executor(
+            self._reader, self._select, key.hex())
+        if phones is None:
+            raise FileNotFoundError(key.hex())
+        return phones
+
+    async def write(self, name: str, phones: list) -> None:
+        '''
+        Records the phones of a given name,
+        returns when the transaction they belong to is committed
+        '''
+        await self.write_key(name_digest(name), phones)
+
+    async def write_key(self, key: bytes, phones: list) -> None:
+        await self._schedule(PUT, key.hex(), format_phones(phones))
+
+    async def delete(self, name: str) -> None:
+        '''
+        Deletes the phones of a given name,
+        committed in one transaction with the writes of the same tick
+        '''
+        if not await self._schedule(DELETE, self._get_key(name)):
+            raise FileNotFoundError(name)
+
+    def _select_keys(self) -> list:
+        return [bytes.fromhex(key) for key, in self._read_connection.execute(
+            'SELECT key FROM phonebook')]
+
+    async def scan_keys(self) -> list:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._reader, self._select_keys)
+
+    def commit_now(self, operations: list) -> list:
+        '''
+        Applies (operation, key, phones) triples in one transaction
+        on the writer thread and waits for it
+        '''
+        return self._writer.submit(self._commit, operations).result()
+
+    def _fingerprint(self) -> list:
+        '''
+        Sizes and modification times of the database and its
+        write-ahead log, an empty log is the same as none
+        '''
+        fingerprint = []
+        for path in (self._db_path, f'{self._db_path}-wal'):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_size:
+                fingerprint.append([path, stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+    async def snapshot(self, clean: bool) -> dict:
+        if self._closed_fingerprint is not None:
+            return {'fingerprint': self._closed_fingerprint}
+        fingerprint = await asyncio.get_running_loop().run_in_executor(
+            self._reader, self._fingerprint)
+        return {'fingerprint': fingerprint}
+
+    async def restore(self, state: dict | None) -> bool:
+        if state is None:
+            return False
+        return await asyncio.get_running_loop().run_in_executor(
+            self._reader, self._fingerprint) == state['fingerprint']
+
+    def _close_connections(self) -> None:
+        self._reader.submit(self._read_connection.close).result()
+        self._writer.submit(self._write_connection.close).result()
+        self._reader.shutdown()
+        self._writer.shutdown()
+
+    async def close(self) -> None:
+        '''
+        Commits queued writes and closes the connections
+        '''
+        if self._pending:
+            await asyncio.wait([self._flush()])
+        loop = asyncio.get_running_loop()
+        # every connection is closed on the thread it is used from
+        await loop.run_in_executor(self._reader, self._read_connection.close)
+        await loop.run_in_executor(self._writer,
+                                   self._write_connection.close)
+        self._closed_fingerprint = await loop.run_in_executor(
+            self._reader, self._fingerprint)
+        self._reader.shutdown(wait=False)
+        self._writer.shutdown(wait=False)
+
+
+def import_folder(folder_path: str, db_path: str,
+                  batch_size: int = 1000, fanout: int = FILE_FANOUT) -> int:
+    '''
+    Imports the files of a FilePhoneBook folder into the database,
+    returns the number of imported files. Files of the flat layout
+    come first, so the newer ones in the fan-out folders replace them
+    '''
+    storage = SQLitePhoneBook(db_path)
+    imported = 0
+    batch = []
+    try:
+        for key, path in iter_phonebook_files(folder_path, fanout):
+            with open(path) as f:
+                phones = format_phones(f.readlines())
+            batch.append((PUT, key.hex(), phones))
+            if len(batch) >= batch_size:
+                imported += len(storage.commit_now(batch))
+                batch = []
+        if batch:
+            imported += len(storage.commit_now(batch))
+    finally:
+        storage._close_connections()
+    return imported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Imports a FilePhoneBook folder into SQLite storage')
+    parser.add_argument('folder', nargs='?', default=FOLDERPATH)
+    parser.add_argument('database', nargs='?', default=SQLITE_PATH)
+    args = parser.parse_args()
+    count = import_folder(args.folder, args.database)
+    logger.info(f'Imported {count} names from {args.folder} '
+                f'to {args.database}')
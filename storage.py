@@ -1,55 +1,721 @@
 import aiofiles
+import aiofiles.os
+import asyncio
 import hashlib
 import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from conf import logger, STORAGE_CACHE_MAX_BYTES, STORAGE_CACHE_TTL, \
+    FILE_DURABILITY, GROUP_COMMIT_WINDOW, STORAGE_IO_THREADS, FILE_FANOUT, \
+    FILE_MIGRATION_BATCH, FILE_MIGRATION_INTERVAL, SNAPSHOT_WARM_PARALLELISM
+from metrics import REGISTRY, SNAPSHOT_RESTORED
+
+
+# FilePhoneBook durability modes
+DURABILITY_NONE = 'none'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_GROUP = 'group'
+
+
+def name_digest(name: str) -> bytes:
+    '''
+    Returns sha256 of the name, storages use it as the key of the name
+    '''
+    return hashlib.sha256(name.encode()).digest()
+
+
+def format_phones(phones: list) -> str:
+    '''
+    Returns phones the way Storage.get returns them
+    '''
+    return '\r\n'.join(phone.strip() for phone in phones if phone.strip())
+
+
+class StorageExecutor(ThreadPoolExecutor):
+    '''
+    Thread pool for storage I/O, so that slow disks do not hold up
+    the default executor. Counts the calls waiting for a thread
+    and the ones running
+    '''
+    def __init__(self, max_workers: int = STORAGE_IO_THREADS) -> None:
+        super().__init__(max_workers=max_workers,
+                         thread_name_prefix='storage-io')
+        self._counts_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+
+    def _run(self, fn, args, kwargs):
+        with self._counts_lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._counts_lock:
+                self.running -= 1
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._counts_lock:
+            self.queued += 1
+        try:
+            return super().submit(self._run, fn, args, kwargs)
+        except BaseException:
+            with self._counts_lock:
+                self.queued -= 1
+            raise
+
+
+_storage_executor = None
+
+
+def get_storage_executor() -> StorageExecutor:
+    '''
+    Returns the storage thread pool of this process, creating it
+    on first use, so forked workers get their own
+    '''
+    global _storage_executor
+    if _storage_executor is None:
+        _storage_executor = StorageExecutor()
+    return _storage_executor
+
+
+REGISTRY.callback(
+    'rksok_storage_io_queued', 'Storage calls waiting for an I/O thread',
+    'gauge', lambda: _storage_executor.queued if _storage_executor else 0)
+REGISTRY.callback(
+    'rksok_storage_io_running', 'Storage calls running on I/O threads',
+    'gauge', lambda: _storage_executor.running if _storage_executor else 0)
+
+
+MIGRATED = REGISTRY.counter(
+    'rksok_file_migrated_total',
+    'Files of the flat layout moved into the fan-out folders')
+
+
+def find_layer(storage: 'Storage', layer_type: type) -> 'Storage | None':
+    '''
+    Returns the first storage of layer_type among storage
+    and the layers under it
+    '''
+    while storage is not None:
+        if isinstance(storage, layer_type):
+            return storage
+        storage = storage.inner
+    return None
+
+
+def iter_phonebook_files(folder_path: str, fanout: int = 0):
+    '''
+    Yields (key, path) for the files of a FilePhoneBook folder,
+    files of the flat layout included. Temporary files of writes
+    in progress are skipped
+    '''
+    folders = [(folder_path, 0)]
+    while folders:
+        folder, depth = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                entries = list(entries)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if re.fullmatch('[0-9a-f]{64}', entry.name):
+                yield bytes.fromhex(entry.name), entry.path
+            elif depth < fanout and re.fullmatch('[0-9a-f]{2}', entry.name) \
+                    and entry.is_dir():
+                folders.append((entry.path, depth + 1))
 
 
 class Storage:
+    @property
+    def inner(self) -> 'Storage | None':
+        '''
+        The storage this one is a layer in front of, if any
+        '''
+        return None
+
     async def get(self, name: str) -> str:
         raise NotImplementedError
 
     async def write(self, name: str, phones: list) -> None:
         raise NotImplementedError
 
-    def delete(self, name: str) -> None:
+    async def delete(self, name: str) -> None:
+        raise NotImplementedError
+
+    async def scan_keys(self) -> list:
+        '''
+        Returns the name_digest of every stored name
+        '''
+        raise NotImplementedError
+
+    async def get_key(self, key: bytes) -> str:
+        '''
+        Returns the phones of the name with the given name_digest,
+        names can not be recovered from the keys scan_keys returns
+        '''
+        raise NotImplementedError
+
+    async def write_key(self, key: bytes, phones: list) -> None:
+        '''
+        Records the phones of the name with the given name_digest
+        '''
         raise NotImplementedError
 
+    async def snapshot(self, clean: bool) -> dict | None:
+        '''
+        Returns the in-memory state worth keeping over a restart,
+        clean is True when nothing changes the storage anymore,
+        see snapshot.py
+        '''
+        return None
+
+    async def restore(self, state: dict | None) -> bool:
+        '''
+        Restores the state returned by snapshot(), called before open().
+        Returns True if the storage is known not to have changed since
+        '''
+        return False
+
+    async def open(self) -> None:
+        '''
+        Starts background work of the storage, called before serving
+        '''
+
+    async def close(self) -> None:
+        '''
+        Stops background work and releases resources of the storage
+        '''
+
 
 class FilePhoneBook(Storage):
     '''
     Class for storing phones in the file system
-    Creates a separate file for each recorded name
+    Creates a separate file for each recorded name, nested in fanout
+    levels of folders named by the first bytes of the key.
+    Files left in the flat layout are read as well while they remain,
+    they are moved on access and by the migration started in open().
+    Durability of writes depends on the mode:
+    'none' leaves flushing to the OS, 'fsync' syncs every write
+    before acknowledging it, 'group' collects the writes made within
+    group_commit_window and syncs them together.
+    File I/O runs on executor, the storage thread pool by default
     '''
-    def __init__(self, folder_path: str) -> None:
+    def __init__(self, folder_path: str,
+                 durability: str = FILE_DURABILITY,
+                 group_commit_window: float = GROUP_COMMIT_WINDOW,
+                 executor: ThreadPoolExecutor | None = None,
+                 fanout: int = FILE_FANOUT,
+                 migration_batch: int = FILE_MIGRATION_BATCH,
+                 migration_interval: float = FILE_MIGRATION_INTERVAL
+                 ) -> None:
+        if durability not in (DURABILITY_NONE, DURABILITY_FSYNC,
+                              DURABILITY_GROUP):
+            raise ValueError(f'Unknown durability mode {durability!r}')
+        if not 0 <= fanout <= 32:
+            raise ValueError(f'Fan-out must be from 0 to 32, not {fanout}')
         self._folder_path = folder_path
+        self._durability = durability
+        self._group_commit_window = group_commit_window
+        self._group = []
+        self._group_committer = None
+        self._executor = executor or get_storage_executor()
+        self._fanout = fanout
+        self._migration_batch = migration_batch
+        self._migration_interval = migration_interval
+        # reads fall back to the flat layout until the migration is done
+        self.migrating = fanout > 0
+        self._migration_task = None
+        # fan-out folders known to exist
+        self._folders = {folder_path}
         if not os.path.exists(self._folder_path):
             os.makedirs(self._folder_path)
 
-    def _get_file_path(self, folder_name, file_name):
-        file_name = hashlib.sha256(file_name.encode()).hexdigest()
-        file_path = os.path.join(folder_name, file_name)
-        return file_path
+    def _get_key_path(self, key: bytes) -> str:
+        file_name = key.hex()
+        return os.path.join(
+            self._folder_path,
+            *(file_name[2 * i:2 * i + 2] for i in range(self._fanout)),
+            file_name)
+
+    def _get_flat_path(self, key: bytes) -> str:
+        return os.path.join(self._folder_path, key.hex())
+
+    def _make_folder(self, folder: str) -> None:
+        '''
+        Creates a fan-out folder with the missing folders above it,
+        in durable modes the new folder entries are synced
+        '''
+        os.makedirs(folder, exist_ok=True)
+        if self._durability != DURABILITY_NONE:
+            parent = folder
+            while parent not in self._folders:
+                parent = os.path.dirname(parent)
+                self._sync_folder(parent)
+        self._folders.add(folder)
+
+    async def _ensure_folder(self, file_path: str) -> None:
+        folder = os.path.dirname(file_path)
+        if folder not in self._folders:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._make_folder, folder)
+            self._folders.add(folder)
 
     async def get(self, name: str) -> str:
         '''
         Returns the contents of the file of a given name
         '''
-        file_path = self._get_file_path(self._folder_path, name)
-        async with aiofiles.open(file_path, mode='r') as f:
+        return await self.get_key(name_digest(name))
+
+    async def _read(self, file_path: str) -> str:
+        async with aiofiles.open(file_path, mode='r',
+                                 executor=self._executor) as f:
             contents = await f.readlines()
         return '\r\n'.join(line.strip() for line in contents)
 
+    async def get_key(self, key: bytes) -> str:
+        try:
+            return await self._read(self._get_key_path(key))
+        except FileNotFoundError:
+            if not self.migrating:
+                raise
+        try:
+            contents = await self._read(self._get_flat_path(key))
+        except FileNotFoundError:
+            # the file may have been moved in the meantime
+            return await self._read(self._get_key_path(key))
+        try:
+            if await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._move_flat, key):
+                MIGRATED.inc()
+        except OSError:
+            logger.exception(f'Could not move the file of {key.hex()} '
+                             'into its fan-out folder')
+        return contents
+
+    def _get_temp_path(self, file_path: str) -> str:
+        return f'{file_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+
     async def write(self, name: str, phones: list) -> None:
         '''
         Writes phones from to the file of a given name
-        Each call of this function rewrites the file
+        Each call of this function rewrites the file.
+        The phones are written to a temporary file which then replaces
+        the old one, so readers and concurrent writers (even from other
+        processes) never see a partially written file
         '''
-        file_path = self._get_file_path(self._folder_path, name)
-        async with aiofiles.open(file_path, mode='w') as f:
-            phones = [phone.strip() for phone in phones if phone.strip()]
-            await f.writelines([f'{phone}\r\n' for phone in phones])
+        await self.write_key(name_digest(name), phones)
+
+    async def write_key(self, key: bytes, phones: list) -> None:
+        file_path = self._get_key_path(key)
+        await self._ensure_folder(file_path)
+        temp_path = self._get_temp_path(file_path)
+        loop = asyncio.get_running_loop()
+        try:
+            async with aiofiles.open(temp_path, mode='w',
+                                     executor=self._executor) as f:
+                contents = format_phones(phones)
+                if contents:
+                    await f.write(f'{contents}\r\n')
+                if self._durability == DURABILITY_FSYNC:
+                    await f.flush()
+                    await loop.run_in_executor(
+                        self._executor, os.fsync, f.fileno())
+            if self._durability == DURABILITY_GROUP:
+                await self._commit_in_group(temp_path, file_path)
+                return
+            await aiofiles.os.replace(temp_path, file_path,
+                                      executor=self._executor)
+            if self._durability == DURABILITY_FSYNC:
+                await loop.run_in_executor(self._executor, self._sync_folder,
+                                           os.path.dirname(file_path))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
-    def delete(self, name: str) -> None:
+    def _sync_folder(self, folder: str) -> None:
+        '''
+        Makes renames in the folder durable
+        '''
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _sync_group(self, renames: list) -> list:
+        '''
+        Syncs the temporary files, moves them in place and syncs
+        every folder once for all of them.
+        Returns an exception or None for every (temp path, path) pair
+        '''
+        errors = []
+        for temp_path, file_path in renames:
+            try:
+                fd = os.open(temp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(temp_path, file_path)
+                errors.append(None)
+            except OSError as e:
+                errors.append(e)
+        folders = [os.path.dirname(file_path) for _, file_path in renames]
+        for folder in set(folders):
+            try:
+                self._sync_folder(folder)
+            except OSError as e:
+                errors = [error or (e if file_folder == folder else None)
+                          for error, file_folder in zip(errors, folders)]
+        return errors
+
+    async def _commit_in_group(self, temp_path: str, file_path: str) -> None:
+        '''
+        Waits until the write is made durable together with
+        the other writes of its group
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self._group.append((temp_path, file_path, future))
+        if self._group_committer is None:
+            self._group_committer = asyncio.create_task(
+                self._run_group_commit())
+        await future
+
+    async def _run_group_commit(self) -> None:
+        '''
+        Commits groups one after another, so that the renames
+        of the same name happen in the order of the writes
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            while self._group:
+                await asyncio.sleep(self._group_commit_window)
+                group, self._group = self._group, []
+                try:
+                    errors = await loop.run_in_executor(
+                        self._executor, self._sync_group,
+                        [(temp_path, file_path)
+                         for temp_path, file_path, _ in group])
+                except BaseException as e:
+                    errors = [e] * len(group)
+                for (_, _, future), error in zip(group, errors):
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        finally:
+            self._group_committer = None
+
+    async def delete(self, name: str) -> None:
         '''
         Deletes the file of a given name from the filesystem
         '''
-        os.remove(self._get_file_path(self._folder_path, name))
+        key = name_digest(name)
+        file_path = self._get_key_path(key)
+        try:
+            await aiofiles.os.remove(file_path, executor=self._executor)
+            deleted = True
+        except FileNotFoundError:
+            if not self.migrating:
+                raise
+            deleted = False
+        if not self.migrating:
+            return
+        # a file of the flat layout may be left behind a newer write.
+        # The migration may link it into the fan-out folder before
+        # it is removed here, so the fan-out path is removed once more
+        try:
+            await aiofiles.os.remove(self._get_flat_path(key),
+                                     executor=self._executor)
+        except FileNotFoundError:
+            if not deleted:
+                # moved in the meantime or there is no file at all
+                await aiofiles.os.remove(file_path, executor=self._executor)
+            return
+        try:
+            await aiofiles.os.remove(file_path, executor=self._executor)
+        except FileNotFoundError:
+            pass
+
+    def _move_flat(self, key: bytes) -> bool:
+        '''
+        Moves the flat file of the key into its fan-out folder,
+        a newer file already there is kept and the flat one removed.
+        Returns False if there is no flat file
+        '''
+        flat_path = self._get_flat_path(key)
+        file_path = self._get_key_path(key)
+        self._make_folder(os.path.dirname(file_path))
+        try:
+            # unlike a rename, a link never replaces a newer file
+            os.link(flat_path, file_path)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(flat_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _migrate_batch(self) -> tuple:
+        '''
+        Moves up to migration_batch flat files into the fan-out folders.
+        Returns the number of moved files and whether none are left
+        '''
+        moved = 0
+        with os.scandir(self._folder_path) as entries:
+            for entry in entries:
+                if not re.fullmatch('[0-9a-f]{64}', entry.name):
+                    continue
+                if moved >= self._migration_batch:
+                    return moved, False
+                moved += self._move_flat(bytes.fromhex(entry.name))
+        return moved, True
+
+    async def migrate(self) -> None:
+        '''
+        Moves the files of the flat layout into the fan-out folders
+        batch by batch, after that reads no longer look for them
+        '''
+        loop = asyncio.get_running_loop()
+        while self.migrating:
+            moved, done = await loop.run_in_executor(
+                self._executor, self._migrate_batch)
+            MIGRATED.inc(moved)
+            if done:
+                self.migrating = False
+                logger.info(f'Files in {self._folder_path} are moved '
+                            f'into {self._fanout} levels of folders')
+            elif self._migration_interval:
+                await asyncio.sleep(self._migration_interval)
+
+    async def _run_migration(self) -> None:
+        try:
+            await self.migrate()
+        except OSError:
+            logger.exception('Migration to the fan-out folders failed, '
+                             'files are moved on access only')
+
+    def _fingerprint(self) -> str:
+        '''
+        Digest of the modification times of the folders, a write
+        or a delete of a file changes the time of its folder
+        '''
+        digest = hashlib.sha256()
+        folders = [(self._folder_path, 0)]
+        while folders:
+            folder, depth = folders.pop()
+            digest.update(f'{folder} {os.stat(folder).st_mtime_ns}\n'.encode())
+            if depth < self._fanout:
+                with os.scandir(folder) as entries:
+                    folders.extend(sorted(
+                        ((entry.path, depth + 1) for entry in entries
+                         if re.fullmatch('[0-9a-f]{2}', entry.name) and
+                         entry.is_dir()), reverse=True))
+        return digest.hexdigest()
+
+    async def snapshot(self, clean: bool) -> dict:
+        fingerprint = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._fingerprint)
+        return {'fingerprint': fingerprint}
+
+    async def restore(self, state: dict | None) -> bool:
+        if state is None:
+            return False
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._fingerprint) == state['fingerprint']
+
+    def _scan_folder(self) -> list:
+        return list({key for key, _ in
+                     iter_phonebook_files(self._folder_path, self._fanout)})
+
+    async def scan_keys(self) -> list:
+        '''
+        Returns the digests of the names that have a file,
+        temporary files of writes in progress are skipped
+        '''
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._scan_folder)
+
+    async def open(self) -> None:
+        '''
+        Starts moving the files of the flat layout
+        into the fan-out folders
+        '''
+        if self.migrating and self._migration_task is None and \
+                self._migration_interval:
+            self._migration_task = asyncio.create_task(
+                self._run_migration())
+
+    async def close(self) -> None:
+        '''
+        Stops the migration and waits for the writes of the last group
+        to become durable
+        '''
+        if self._migration_task is not None:
+            self._migration_task.cancel()
+            try:
+                await self._migration_task
+            except asyncio.CancelledError:
+                pass
+            self._migration_task = None
+        if self._group_committer is not None:
+            await self._group_committer
+
+
+class CachedStorage(Storage):
+    '''
+    In-memory LRU cache in front of any Storage.
+    Keeps the formatted contents of recently used names
+    within max_bytes, writes go through to the storage and update
+    the cached entry, deletes drop it
+    '''
+    def __init__(self, storage: Storage,
+                 max_bytes: int = STORAGE_CACHE_MAX_BYTES,
+                 ttl: float | None = STORAGE_CACHE_TTL) -> None:
+        self._storage = storage
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        # bumped by every write and delete, so that a read which started
+        # before them does not put an outdated value into the cache
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def inner(self) -> Storage:
+        return self._storage
+
+    @property
+    def size(self) -> int:
+        '''
+        Approximate number of bytes held by the cache
+        '''
+        return self._size
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def fill_ratio(self) -> float:
+        '''
+        Share of max_bytes taken by the cached entries
+        '''
+        return self._size / self._max_bytes if self._max_bytes else 0.0
+
+    def _entry_size(self, name: str, contents: str) -> int:
+        return len(name.encode()) + len(contents.encode())
+
+    def _drop(self, name: str) -> None:
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def _put(self, name: str, contents: str) -> None:
+        self._drop(name)
+        size = self._entry_size(name, contents)
+        if size > self._max_bytes:
+            return
+        expires_at = None if self._ttl is None else \
+            time.monotonic() + self._ttl
+        self._entries[name] = (contents, expires_at, size)
+        self._size += size
+        while self._size > self._max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+
+    async def get(self, name: str) -> str:
+        '''
+        Returns the cached contents or reads them from the storage
+        '''
+        entry = self._entries.get(name)
+        if entry is not None:
+            contents, expires_at, _ = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return contents
+            self._drop(name)
+        self.misses += 1
+        version = self._version
+        contents = await self._storage.get(name)
+        if version == self._version:
+            self._put(name, contents)
+        return contents
+
+    async def write(self, name: str, phones: list) -> None:
+        '''
+        Writes phones to the storage and updates the cached entry
+        '''
+        self._version += 1
+        self._drop(name)
+        await self._storage.write(name, phones)
+        self._version += 1
+        self._put(name, format_phones(phones))
+
+    async def delete(self, name: str) -> None:
+        '''
+        Drops the cached entry and deletes the name from the storage
+        '''
+        self._version += 1
+        self._drop(name)
+        try:
+            await self._storage.delete(name)
+        finally:
+            self._version += 1
+
+    async def scan_keys(self) -> list:
+        return await self._storage.scan_keys()
+
+    async def snapshot(self, clean: bool) -> dict:
+        '''
+        Keeps the cached names from the least recently used on,
+        not their contents
+        '''
+        return {'storage': await self._storage.snapshot(clean),
+                'names': list(self._entries)}
+
+    async def restore(self, state: dict | None) -> bool:
+        '''
+        Reads the names cached at the snapshot back into the cache
+        '''
+        if state is None:
+            return False
+        unchanged = await self._storage.restore(state['storage'])
+        names = state['names']
+        for start in range(0, len(names), SNAPSHOT_WARM_PARALLELISM):
+            batch = names[start:start + SNAPSHOT_WARM_PARALLELISM]
+            contents = await asyncio.gather(
+                *[self._storage.get(name) for name in batch],
+                return_exceptions=True)
+            for name, result in zip(batch, contents):
+                if isinstance(result, FileNotFoundError):
+                    continue
+                if isinstance(result, BaseException):
+                    raise result
+                self._put(name, result)
+        SNAPSHOT_RESTORED.set(len(self._entries), component='storage_cache')
+        return unchanged
+
+    async def open(self) -> None:
+        await self._storage.open()
+
+    async def close(self) -> None:
+        await self._storage.close()
@@ -1,13 +1,46 @@
+import aiofiles.os
+import asyncio
+import signal
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 import hashlib
+import json
 import os
-from conf import FOLDERPATH, RequestVerb, PROTOCOL
-from exceptions import NameIsTooLongError, CanNotParseRequestError
-from regagent import ask_permission, process_permission
-from storage import FilePhoneBook
+import shutil
+from conf import RequestVerb, PROTOCOL, REG_FALLBACK_RESPONSE, \
+    READ_BUFFER_SIZE
+from exceptions import NameIsTooLongError, CanNotParseRequestError, \
+    InvalidMethodError, InvalidProtocolError, UndefinedResponseFromRegAgent
+from regagent import ask_permission, process_permission, RegAgentPool, \
+    VerdictCache, SingleFlight, RegAgentPipeline, CircuitBreaker, \
+    hedge_call, REG_CALLS
+from storage import FilePhoneBook, CachedStorage, StorageExecutor, \
+    name_digest, find_layer
+from bloom import BloomFilter, BloomStorage
+from writebehind import WriteBehindStorage
+from bulk import export_storage, import_dump
+from cluster import ClusterStorage, HashRing
+from diagnostics import Diagnostics, SLOW_CALLBACKS, watched
+from snapshot import Snapshotter, DISCARDED, decode_snapshot, \
+    encode_snapshot, read_snapshot
 from request import Request
 from response import Response
+from logstorage import LogPhoneBook, iter_records
+from protocol import RKSOKProtocol
+from server import Server, make_storage
+from fake_reg_agent import FakeRegAgent
+from loadgen import LoadGenerator, parse_mix, percentile
+from admission import AdmissionController
+from sqlitestorage import SQLitePhoneBook, import_folder
+from workers import WorkerSupervisor
+from logs import BatchingSink, sample_request, sampled, set_sample_rate
+from conf import logger
+from metrics import REGISTRY, Registry, MetricsServer, REQUESTS, \
+    STAGE_LATENCY, IN_FLIGHT, SPECULATIVE_READS
 
 
 events = []
@@ -20,9 +53,10 @@ class AsyncMock(mock.MagicMock):
 
 class TestFilePhoneBook(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
-        self.storage = FilePhoneBook(FOLDERPATH)
+        self.folder = tempfile.mkdtemp()
+        self.storage = FilePhoneBook(self.folder)
         filepath = os.path.join(
-            FOLDERPATH, hashlib.sha256('Кирилл Хмурый'.encode()).hexdigest())
+            self.folder, hashlib.sha256('Кирилл Хмурый'.encode()).hexdigest())
         with open(filepath, 'w') as self.f:
             self.f.write('79842342143')
         events.append("setUp")
@@ -40,17 +74,16 @@ class TestFilePhoneBook(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(got, '709931142255')
 
         os.remove(os.path.join(
-            FOLDERPATH, hashlib.sha256('John'.encode()).hexdigest()))
+            self.folder, hashlib.sha256('John'.encode()).hexdigest()))
 
     async def test_delete(self):
         await self.storage.write('John', ['78124445598'])
-        self.storage.delete('John')
+        await self.storage.delete('John')
         with self.assertRaises(FileNotFoundError):
             await self.storage.get('John')
 
     def tearDown(self):
-        os.remove(os.path.join(
-            FOLDERPATH, hashlib.sha256('Кирилл Хмурый'.encode()).hexdigest()))
+        shutil.rmtree(self.folder)
         events.append("tearDown")
 
 
@@ -104,12 +137,57 @@ class TestRequest(unittest.TestCase):
         self.assertRaises(NameIsTooLongError, Request, raw_request)
 
 
+class TestRequestFromBytes(unittest.TestCase):
+    def test_parse_bytes(self):
+        req = Request.from_bytes(
+            'ОТДОВАЙ Иван Хмурый РКСОК/1.0\r\n\r\n'.encode())
+        self.assertEqual(req.name, 'Иван Хмурый')
+        self.assertEqual(req.protocol, PROTOCOL)
+        self.assertEqual(req.method, RequestVerb.GET)
+        self.assertEqual(req.raw_request,
+                         'ОТДОВАЙ Иван Хмурый РКСОК/1.0\r\n\r\n')
+
+        req = Request.from_bytes(('ЗОПИШИ Иван Хмурый РКСОК/1.0\r\n'
+                                  '89012345678 — мобильный\r\n'
+                                  '02 — рабочий\r\n\r\n').encode())
+        self.assertEqual(req.method, RequestVerb.WRITE)
+        self.assertEqual(req.body, ['89012345678 — мобильный', '02 — рабочий'])
+
+    def test_parse_bytes_like_str(self):
+        for raw_request in ('ОТДОВАЙ Иван\u00a0Хмурый РКСОК/1.0\r\n\r\n',
+                            'УДОЛИ\u2003Иван  Хмурый\tРКСОК/1.0\r\n\r\n'):
+            req = Request.from_bytes(raw_request.encode())
+            self.assertEqual(req.name, Request(raw_request).name)
+            self.assertEqual(req.name, 'Иван Хмурый')
+
+    def test_parse_bytes_errors(self):
+        self.assertRaises(CanNotParseRequestError, Request.from_bytes,
+                          'ОТДОВАЙ РКСОК/1.0\r\n\r\n'.encode())
+        self.assertRaises(InvalidMethodError, Request.from_bytes,
+                          'ДАЙ Иван РКСОК/1.0\r\n\r\n'.encode())
+        self.assertRaises(InvalidProtocolError, Request.from_bytes,
+                          'ОТДОВАЙ Иван HTTP/1.1\r\n\r\n'.encode())
+        self.assertRaises(NameIsTooLongError, Request.from_bytes,
+                          ('ОТДОВАЙ ' + 'Я' * 31 + ' РКСОК/1.0\r\n\r\n'
+                           ).encode())
+        self.assertRaises(NameIsTooLongError, Request.from_bytes,
+                          'ОТДОВАЙ '.encode() + b'\xd0\x9e' * 500 +
+                          ' РКСОК/1.0\r\n\r\n'.encode())
+        self.assertRaises(CanNotParseRequestError, Request.from_bytes,
+                          'ОТДОВАЙ Иван РКСОК/1.0\r\n'.encode() +
+                          b'\xff\r\n\r\n')
+
+
 class TestResponse(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self) -> None:
-        self.storage = FilePhoneBook(FOLDERPATH)
+        self.folder = tempfile.mkdtemp()
+        self.storage = FilePhoneBook(self.folder)
         await self.storage.write('Petr', ['79842342143'])
         events.append("asyncSetUp")
 
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
     async def test_make_get(self):
         raw_request = 'ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'
         resp = Response(raw_request)
@@ -208,5 +286,1571 @@ class TestResponse(unittest.IsolatedAsyncioTestCase):
             await self.storage.get('Владимир Путин')
 
 
+class TestRegAgentPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.connections = 0
+        self.requests = 0
+        self.close_after_response = False
+        self.reply = 'МОЖНА РКСОК/1.0\r\n\r\n'
+        self.stall = False
+        self.answer_first_only = False
+        self.release = asyncio.Event()
+
+        async def agent(reader, writer):
+            self.connections += 1
+            while True:
+                try:
+                    await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                self.requests += 1
+                if self.stall or \
+                        (self.answer_first_only and self.requests > 1):
+                    await self.release.wait()
+                writer.write(self.reply.encode())
+                await writer.drain()
+                if self.close_after_response:
+                    break
+            writer.close()
+
+        self.agent = await asyncio.start_server(agent, '127.0.0.1', 0)
+        self.port = self.agent.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self) -> None:
+        self.release.set()
+        self.agent.close()
+        await self.agent.wait_closed()
+
+    async def test_reuses_connection(self):
+        pool = RegAgentPool('127.0.0.1', self.port, size=2)
+        for _ in range(3):
+            response = await pool.request(b'ping\r\n\r\n')
+            self.assertEqual(response.decode(), 'МОЖНА РКСОК/1.0\r\n\r\n')
+        self.assertEqual(self.connections, 1)
+        self.assertEqual(pool.idle_count, 1)
+        await pool.close()
+
+    async def test_replaces_broken_connection(self):
+        self.close_after_response = True
+        pool = RegAgentPool('127.0.0.1', self.port, size=2)
+        for _ in range(3):
+            await pool.request(b'ping\r\n\r\n')
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.connections, 3)
+        await pool.close()
+
+    async def test_idle_timeout(self):
+        pool = RegAgentPool('127.0.0.1', self.port, size=2, idle_timeout=0)
+        await pool.request(b'ping\r\n\r\n')
+        await pool.request(b'ping\r\n\r\n')
+        self.assertEqual(self.connections, 2)
+        await pool.close()
+
+    async def test_pipeline_batches_requests(self):
+        agent = FakeRegAgent(approve_ratio=0.5)
+        await agent.start()
+        self.addAsyncCleanup(agent.close)
+        pool = RegAgentPool('127.0.0.1', agent.port)
+        pipeline = RegAgentPipeline(pool, window=0.01)
+        payloads = [f'ping {i}\r\n\r\n'.encode() for i in range(10)]
+        responses = await asyncio.gather(
+            *[pipeline.request(payload) for payload in payloads])
+        self.assertEqual([response.decode() for response in responses],
+                         [agent.verdict(payload) for payload in payloads])
+        self.assertEqual(agent.connections, 1)
+        self.assertTrue(pipeline.supported)
+        await pipeline.close()
+        await pool.close()
+
+    async def test_pipeline_falls_back_to_one_request_per_connection(self):
+        self.close_after_response = True
+        pool = RegAgentPool('127.0.0.1', self.port)
+        pipeline = RegAgentPipeline(pool, window=0.01)
+        responses = await asyncio.gather(
+            *[pipeline.request(b'ping\r\n\r\n') for _ in range(3)])
+        self.assertEqual(responses,
+                         ['МОЖНА РКСОК/1.0\r\n\r\n'.encode()] * 3)
+        self.assertFalse(pipeline.supported)
+        self.assertEqual(self.requests, 3)
+        self.assertEqual(await pipeline.request(b'ping\r\n\r\n'),
+                         responses[0])
+        await pipeline.close()
+        await pool.close()
+
+    async def test_pipeline_gives_up_on_stalled_batch(self):
+        self.answer_first_only = True
+        pool = RegAgentPool('127.0.0.1', self.port)
+        pipeline = RegAgentPipeline(pool, window=0.01, timeout=0.05)
+        responses = await asyncio.wait_for(asyncio.gather(
+            *[pipeline.request(b'ping\r\n\r\n') for _ in range(3)],
+            return_exceptions=True), 1)
+        self.assertEqual(responses[0], 'МОЖНА РКСОК/1.0\r\n\r\n'.encode())
+        for response in responses[1:]:
+            self.assertIsInstance(response, asyncio.TimeoutError)
+        self.assertFalse(pipeline.supported)
+        self.assertFalse(pipeline._batches)
+        await pipeline.close()
+        await pool.close()
+
+    async def test_ask_permission_deadline(self):
+        self.stall = True
+        timeouts = REG_CALLS.get(result='timeout')
+        response = await asyncio.wait_for(ask_permission(
+            'ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n', '127.0.0.1', self.port,
+            timeout=0.05), 1)
+        self.assertEqual(response, REG_FALLBACK_RESPONSE)
+        self.assertFalse(await process_permission(response))
+        self.assertEqual(REG_CALLS.get(result='timeout'), timeouts + 1)
+
+    async def test_garbage_response_still_raises(self):
+        self.reply = 'ЧЕГО? РКСОК/1.0\r\n\r\n'
+        response = await ask_permission(
+            'ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n', '127.0.0.1', self.port)
+        self.assertEqual(response, self.reply)
+        with self.assertRaises(UndefinedResponseFromRegAgent):
+            await process_permission(response)
+
+    async def test_hedge_call(self):
+        calls = []
+
+        async def call():
+            calls.append(None)
+            if len(calls) == 1:
+                await asyncio.sleep(10)
+            return len(calls)
+
+        started = time.monotonic()
+        self.assertEqual(await hedge_call(call, 0.01), 2)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failures=2, reset_timeout=0.05)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    async def test_ask_permission_uses_verdict_cache(self):
+        cache = VerdictCache()
+        raw_request = 'ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'
+        for _ in range(3):
+            response = await ask_permission(
+                raw_request, '127.0.0.1', self.port, cache=cache)
+            self.assertTrue(await process_permission(response))
+        self.assertEqual(self.requests, 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    async def test_ask_permission_coalesces_concurrent_requests(self):
+        raw_request = 'ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'
+        responses = await asyncio.gather(*[ask_permission(
+            raw_request, '127.0.0.1', self.port) for _ in range(5)])
+        self.assertEqual(len(set(responses)), 1)
+        self.assertEqual(self.requests, 1)
+
+
+class TestVerdictCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = VerdictCache(size=10, ttl_approved=60, ttl_denied=60)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 'МОЖНА РКСОК/1.0\r\n\r\n')
+        cache.put('b', 'НИЛЬЗЯ РКСОК/1.0\r\nНеположено\r\n\r\n')
+        cache.put('c', 'ЧЕГО? РКСОК/1.0\r\n\r\n')
+        self.assertEqual(cache.get('a'), 'МОЖНА РКСОК/1.0\r\n\r\n')
+        self.assertEqual(cache.get('b'),
+                         'НИЛЬЗЯ РКСОК/1.0\r\nНеположено\r\n\r\n')
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_ratio, 0.5)
+
+    def test_ttl(self):
+        cache = VerdictCache(size=10, ttl_approved=60, ttl_denied=0)
+        cache.put('a', 'МОЖНА РКСОК/1.0\r\n\r\n')
+        cache.put('b', 'НИЛЬЗЯ РКСОК/1.0\r\n\r\n')
+        self.assertEqual(len(cache), 1)
+        with mock.patch('regagent.time.monotonic', return_value=1e12):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = VerdictCache(size=2)
+        cache.put('a', 'МОЖНА РКСОК/1.0\r\n\r\n')
+        cache.put('b', 'МОЖНА РКСОК/1.0\r\n\r\n')
+        cache.get('a')
+        cache.put('c', 'МОЖНА РКСОК/1.0\r\n\r\n')
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_shares_result(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'МОЖНА РКСОК/1.0\r\n\r\n'
+
+        results = await asyncio.gather(
+            *[single_flight.do('key', call) for _ in range(10)])
+        self.assertEqual(results, ['МОЖНА РКСОК/1.0\r\n\r\n'] * 10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(single_flight.shared, 9)
+        self.assertEqual(len(single_flight), 0)
+
+        await single_flight.do('key', call)
+        self.assertEqual(len(calls), 2)
+
+    async def test_propagates_errors(self):
+        single_flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.01)
+            raise ConnectionResetError
+
+        results = await asyncio.gather(
+            *[single_flight.do('key', call) for _ in range(3)],
+            return_exceptions=True)
+        for result in results:
+            self.assertIsInstance(result, ConnectionResetError)
+        self.assertEqual(len(single_flight), 0)
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.storage = FilePhoneBook(self.folder)
+        await self.storage.write('Petr', ['79842342143'])
+        patcher = mock.patch(
+            'response.ask_permission',
+            AsyncMock(return_value='МОЖНА РКСОК/1.0\r\n\r\n'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    transport = 'streams'
+
+    async def start(self, **kwargs) -> int:
+        self.server = Server('127.0.0.1', 0, self.storage,
+                             transport=self.transport, **kwargs)
+        self.listener = await self.server._start_server()
+        return self.listener.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self) -> None:
+        self.listener.close()
+        await self.listener.wait_closed()
+        shutil.rmtree(self.folder)
+
+    async def test_single_shot(self):
+        port = await self.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode())
+        response = await reader.read()
+        self.assertEqual(response.decode(),
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n79842342143\r\n\r\n')
+        writer.close()
+
+    async def test_keep_alive_pipelined(self):
+        port = await self.start(keep_alive=True, keep_alive_timeout=1)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(('ЗОПИШИ Витя РКСОК/1.0\r\n79846543210\r\n\r\n'
+                      'ОТДОВАЙ Витя РКСОК/1.0\r\n\r\n'
+                      'УДОЛИ Витя РКСОК/1.0\r\n\r\n'
+                      'ОТДОВАЙ Витя РКСОК/1.0\r\n\r\n').encode())
+        writer.write_eof()
+        response = await reader.read()
+        self.assertEqual(response.decode(),
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n\r\n'
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n79846543210\r\n\r\n'
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n\r\n'
+                         'НИНАШОЛ РКСОК/1.0\r\n\r\n')
+        writer.close()
+
+    async def test_records_metrics(self):
+        port = await self.start()
+        answered = REQUESTS.get(verb=RequestVerb.GET, status='НОРМАЛДЫКС')
+        writes = STAGE_LATENCY.count(stage='write', verb=RequestVerb.GET)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode())
+        await reader.read()
+        writer.close()
+        self.assertEqual(
+            REQUESTS.get(verb=RequestVerb.GET, status='НОРМАЛДЫКС'),
+            answered + 1)
+        self.assertEqual(
+            STAGE_LATENCY.count(stage='write', verb=RequestVerb.GET),
+            writes + 1)
+        self.assertEqual(IN_FLIGHT.get(stage='storage'), 0)
+
+    async def test_keep_alive_limits(self):
+        port = await self.start(keep_alive=True, keep_alive_timeout=0.05,
+                                keep_alive_max_requests=2)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode() * 3)
+        response = await reader.read()
+        self.assertEqual(response.decode().count('НОРМАЛДЫКС'), 2)
+        writer.close()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode())
+        response = await asyncio.wait_for(reader.read(), 1)
+        self.assertEqual(response.decode().count('НОРМАЛДЫКС'), 1)
+        writer.close()
+
+    async def test_bad_requests(self):
+        port = await self.start(keep_alive=True, keep_alive_timeout=1)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ДАЙ Petr РКСОК/1.0\r\n\r\n'.encode() +
+                     b'\xff\xfe\r\n\r\n' +
+                     'ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode())
+        writer.write_eof()
+        response = await reader.read()
+        self.assertEqual(response.decode(),
+                         'НИПОНЯЛ РКСОК/1.0\r\n\r\n'
+                         'НИПОНЯЛ РКСОК/1.0\r\n\r\n'
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n79842342143\r\n\r\n')
+        writer.close()
+
+    async def test_too_large_request(self):
+        port = await self.start(max_request_size=100)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(('ЗОПИШИ Витя РКСОК/1.0\r\n' +
+                      '79846543210\r\n' * 20 + '\r\n').encode())
+        response = await reader.read()
+        self.assertEqual(response.decode(), 'НИПОНЯЛ РКСОК/1.0\r\n\r\n')
+        self.assertEqual(self.server.admission.shed['too_large'], 1)
+        writer.close()
+
+    async def test_read_timeouts(self):
+        port = await self.start(header_timeout=0.05, body_timeout=0.05)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ЗОПИШИ Витя РКСОК/1.0\r\n79846543210\r\n'.encode())
+        response = await asyncio.wait_for(reader.read(), 1)
+        self.assertEqual(response.decode(), 'НИПОНЯЛ РКСОК/1.0\r\n\r\n')
+        self.assertEqual(self.server.admission.shed['read_timeout'], 1)
+        writer.close()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ЗОПИШИ Витя'.encode())
+        response = await asyncio.wait_for(reader.read(), 1)
+        self.assertEqual(response, b'')
+        writer.close()
+
+    async def test_overload(self):
+        admission = AdmissionController(max_in_flight=0, max_queued=0)
+        port = await self.start(admission=admission)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode())
+        response = await reader.read()
+        self.assertEqual(response.decode(), 'НИПОНЯЛ РКСОК/1.0\r\n\r\n')
+        self.assertEqual(admission.shed['overloaded'], 1)
+        writer.close()
+
+
+class TestServerProtocol(TestServer):
+    transport = 'protocol'
+
+    async def test_split_and_large_requests(self):
+        port = await self.start(keep_alive=True, keep_alive_timeout=1)
+        self.server._make_protocol = lambda: RKSOKProtocol(
+            self.server, True, 1, 100, buffer_size=8)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        request = 'ЗОПИШИ Витя РКСОК/1.0\r\n' + '79846543210\r\n' * 100 + \
+            '\r\n'
+        for i in range(0, len(request), 7):
+            writer.write(request[i:i + 7].encode())
+            await writer.drain()
+        writer.write('ОТДОВАЙ Витя РКСОК/1.0\r\n\r\n'.encode())
+        writer.write_eof()
+        response = await reader.read()
+        self.assertEqual(response.decode(),
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n\r\n'
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n' +
+                         '79846543210\r\n' * 100 + '\r\n')
+        writer.close()
+
+    async def test_drops_data_after_last_request(self):
+        async def slow_permission(*args):
+            await asyncio.sleep(0.3)
+            return 'МОЖНА РКСОК/1.0\r\n\r\n'
+
+        port = await self.start(max_request_size=1024)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        with mock.patch('response.ask_permission', slow_permission):
+            writer.write('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n'.encode())
+            await asyncio.sleep(0.05)
+            protocol, = self.server._protocols
+            for _ in range(100):
+                writer.write(b'x' * 65536)
+                await asyncio.sleep(0)
+            response = await asyncio.wait_for(reader.read(), 1)
+        self.assertEqual(response.decode(),
+                         'НОРМАЛДЫКС РКСОК/1.0\r\n79842342143\r\n\r\n')
+        self.assertEqual(len(protocol._buffer), READ_BUFFER_SIZE)
+        writer.close()
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.handlers = {signum: signal.getsignal(signum)
+                         for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+
+    def test_restarts_crashed_workers_and_stops(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        marker = os.path.join(folder, 'crashed')
+
+        def serve(index):
+            try:
+                os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                time.sleep(60)
+            else:
+                raise RuntimeError('worker crashed')
+
+        supervisor = WorkerSupervisor(2, serve, restart_delay=0)
+        spawned = []
+        spawn = supervisor._spawn
+        supervisor._spawn = lambda index: spawned.append(spawn(index))
+        threading.Timer(1, supervisor.stop).start()
+        supervisor.run(poll_interval=0.01)
+
+        self.assertEqual(len(spawned), 3)
+        self.assertEqual(supervisor.pids, set())
+        for pid in spawned:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+class TestStorageExecutor(unittest.IsolatedAsyncioTestCase):
+    async def test_counts_queued_and_running_calls(self):
+        executor = StorageExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        storage = FilePhoneBook(folder, executor=executor)
+        await storage.write('John', ['78124445598'])
+
+        blocker = executor.submit(release.wait)
+        delete = asyncio.ensure_future(storage.delete('John'))
+        await asyncio.sleep(0.05)
+        self.assertEqual((executor.running, executor.queued), (1, 1))
+        self.assertFalse(delete.done())
+        release.set()
+        await delete
+        blocker.result()
+        self.assertEqual((executor.running, executor.queued), (0, 0))
+        self.assertEqual(os.listdir(folder), [])
+
+
+class TestCachedStorage(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.storage = FilePhoneBook(self.folder)
+        self.cache = CachedStorage(self.storage, max_bytes=1024)
+        await self.storage.write('John', ['78124445598', '02'])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    async def test_get(self):
+        self.assertEqual(await self.cache.get('John'), '78124445598\r\n02')
+        self.assertEqual(await self.cache.get('John'), '78124445598\r\n02')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_ratio, 0.5)
+        with self.assertRaises(FileNotFoundError):
+            await self.cache.get('Petr')
+
+    async def test_write_through(self):
+        await self.cache.get('John')
+        await self.cache.write('John', [' 709931142255 ', ''])
+        self.assertEqual(await self.cache.get('John'), '709931142255')
+        self.assertEqual(await self.storage.get('John'), '709931142255')
+        self.assertEqual(self.cache.misses, 1)
+
+    async def test_delete(self):
+        await self.cache.get('John')
+        await self.cache.delete('John')
+        self.assertEqual(len(self.cache), 0)
+        with self.assertRaises(FileNotFoundError):
+            await self.cache.get('John')
+
+    async def test_byte_bound(self):
+        cache = CachedStorage(self.storage, max_bytes=30)
+        await cache.write('Petr', ['79842342143'])
+        await cache.get('John')
+        self.assertEqual(len(cache), 1)
+        self.assertLessEqual(cache.size, 30)
+        await cache.get('Petr')
+        self.assertEqual(cache.misses, 2)
+
+
+class TestLogPhoneBook(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.path = os.path.join(folder, 'phonebook.log')
+        self.storage = LogPhoneBook(self.path, compaction_interval=0)
+        await self.storage.write('Кирилл Хмурый', ['79842342143'])
+
+    async def asyncTearDown(self) -> None:
+        await self.storage.close()
+
+    async def test_get(self):
+        self.assertEqual(await self.storage.get('Кирилл Хмурый'),
+                         '79842342143')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('John')
+
+    async def test_write(self):
+        await self.storage.write('John', ['78124445598'])
+        got = await self.storage.get('John')
+        self.assertEqual(got, '78124445598')
+        await self.storage.write('John', ['709931142255', ' 02 '])
+        got = await self.storage.get('John')
+        self.assertEqual(got, '709931142255\r\n02')
+
+    async def test_delete(self):
+        await self.storage.write('John', ['78124445598'])
+        await self.storage.delete('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.delete('John')
+
+    async def test_rebuilds_index(self):
+        await self.storage.write('John', ['78124445598'])
+        await self.storage.write('John', ['709931142255'])
+        await self.storage.write('Petr', ['02'])
+        await self.storage.delete('Petr')
+        await self.storage.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'torn record')
+
+        self.storage = LogPhoneBook(self.path, compaction_interval=0)
+        self.assertEqual(len(self.storage), 2)
+        self.assertEqual(await self.storage.get('John'), '709931142255')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('Petr')
+        await self.storage.write('Petr', ['03'])
+        self.assertEqual(await self.storage.get('Petr'), '03')
+
+    async def test_compact(self):
+        for i in range(100):
+            await self.storage.write('John', [str(i)])
+        await self.storage.delete('Кирилл Хмурый')
+        size = os.path.getsize(self.path)
+        self.assertGreater(self.storage.garbage, 0)
+
+        await self.storage.compact()
+        self.assertEqual(self.storage.garbage, 0)
+        self.assertLess(os.path.getsize(self.path), size / 10)
+        self.assertEqual(await self.storage.get('John'), '99')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('Кирилл Хмурый')
+
+        await self.storage.write('Petr', ['02'])
+        await self.storage.close()
+        self.storage = LogPhoneBook(self.path, compaction_interval=0)
+        self.assertEqual(await self.storage.get('John'), '99')
+        self.assertEqual(await self.storage.get('Petr'), '02')
+
+    async def test_writes_during_compaction(self):
+        for i in range(100):
+            await self.storage.write(f'name {i}', [str(i)])
+        compaction = asyncio.create_task(self.storage.compact())
+        await asyncio.sleep(0)
+        await self.storage.write('name 1', ['new'])
+        await self.storage.delete('name 2')
+        await compaction
+        self.assertEqual(await self.storage.get('name 1'), 'new')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('name 2')
+        self.assertEqual(await self.storage.get('name 3'), '3')
+
+    async def test_concurrent_writes(self):
+        await asyncio.gather(*[self.storage.write(f'name {i}', [str(i)])
+                               for i in range(50)])
+        await self.storage.close()
+        self.storage = LogPhoneBook(self.path, compaction_interval=0)
+        await self.storage.open()
+        self.assertEqual(len(self.storage), 51)
+        for i in range(50):
+            self.assertEqual(await self.storage.get(f'name {i}'), str(i))
+
+    def test_refused_by_workers(self):
+        with mock.patch('server.STORAGE_BACKEND', 'log'):
+            with self.assertRaises(ValueError):
+                make_storage(single_process=False)
+
+
+class TestSQLitePhoneBook(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, 'phonebook.sqlite3')
+        self.storage = SQLitePhoneBook(self.path)
+        await self.storage.write('Кирилл Хмурый', ['79842342143'])
+
+    async def asyncTearDown(self) -> None:
+        await self.storage.close()
+
+    async def test_get(self):
+        self.assertEqual(await self.storage.get('Кирилл Хмурый'),
+                         '79842342143')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('John')
+
+    async def test_write(self):
+        await self.storage.write('John', ['78124445598'])
+        got = await self.storage.get('John')
+        self.assertEqual(got, '78124445598')
+        await self.storage.write('John', ['709931142255'])
+        got = await self.storage.get('John')
+        self.assertEqual(got, '709931142255')
+
+    async def test_delete(self):
+        await self.storage.write('John', ['78124445598'])
+        await self.storage.delete('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.delete('John')
+
+    async def test_batches_concurrent_writes(self):
+        transactions = self.storage.transactions
+        await asyncio.gather(*[self.storage.write(f'name {i}', [str(i)])
+                               for i in range(50)])
+        self.assertEqual(self.storage.transactions, transactions + 1)
+        self.assertEqual(await self.storage.get('name 42'), '42')
+
+    async def test_import_folder(self):
+        phonebook = FilePhoneBook(os.path.join(self.folder, 'phonebook'))
+        await phonebook.write('John', ['78124445598', '02'])
+        await phonebook.write('Petr', ['79842342143'])
+        database = os.path.join(self.folder, 'imported.sqlite3')
+        self.assertEqual(import_folder(
+            os.path.join(self.folder, 'phonebook'), database), 2)
+        storage = SQLitePhoneBook(database)
+        self.assertEqual(await storage.get('John'), '78124445598\r\n02')
+        self.assertEqual(await storage.get('Petr'), '79842342143')
+        await storage.close()
+
+
+class TestFilePhoneBookDurability(unittest.IsolatedAsyncioTestCase):
+    async def test_fsync(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        storage = FilePhoneBook(folder, durability='fsync')
+        with mock.patch('storage.os.fsync', wraps=os.fsync) as fsync:
+            await storage.write('John', ['78124445598'])
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(await storage.get('John'), '78124445598')
+
+    async def test_group_commit(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        storage = FilePhoneBook(folder, durability='group')
+        with mock.patch.object(storage, '_sync_group',
+                               wraps=storage._sync_group) as sync_group:
+            await asyncio.gather(*[storage.write(f'name {i}', [str(i)])
+                                   for i in range(20)])
+            await storage.write('name 1', ['new'])
+        self.assertEqual(sync_group.call_count, 2)
+        self.assertEqual(await storage.get('name 2'), '2')
+        self.assertEqual(await storage.get('name 1'), 'new')
+        self.assertEqual(len(os.listdir(folder)), 20)
+        await storage.close()
+
+    def test_unknown_mode(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        with self.assertRaises(ValueError):
+            FilePhoneBook(folder, durability='sometimes')
+
+
+class TestFilePhoneBookFanOut(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        flat = FilePhoneBook(self.folder)
+        for i in range(5):
+            await flat.write(f'name {i}', [str(i)])
+        self.storage = FilePhoneBook(self.folder, fanout=2,
+                                     migration_batch=2,
+                                     migration_interval=0)
+
+    async def asyncTearDown(self) -> None:
+        await self.storage.close()
+
+    def path(self, name: str, fanout: int = 2) -> str:
+        digest = name_digest(name).hex()
+        return os.path.join(self.folder,
+                            *[digest[2 * i:2 * i + 2] for i in range(fanout)],
+                            digest)
+
+    async def test_nested_layout(self):
+        await self.storage.write('John', ['78124445598'])
+        self.assertTrue(os.path.exists(self.path('John')))
+        self.assertEqual(await self.storage.get('John'), '78124445598')
+        await self.storage.delete('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.delete('John')
+
+    async def test_moves_flat_files_on_access(self):
+        self.assertEqual(await self.storage.get('name 0'), '0')
+        self.assertFalse(os.path.exists(self.path('name 0', 0)))
+        self.assertTrue(os.path.exists(self.path('name 0')))
+        await self.storage.write('name 1', ['new'])
+        self.assertEqual(await self.storage.get('name 1'), 'new')
+        await self.storage.delete('name 2')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('name 2')
+        self.assertEqual(len(await self.storage.scan_keys()), 4)
+
+    async def test_migrate(self):
+        await self.storage.write('name 1', ['new'])
+        await self.storage.migrate()
+        self.assertFalse(self.storage.migrating)
+        self.assertEqual(
+            [entry for entry in os.listdir(self.folder)
+             if len(entry) == 64], [])
+        self.assertEqual(await self.storage.get('name 1'), 'new')
+        self.assertEqual(await self.storage.get('name 4'), '4')
+        self.assertEqual(sorted(await self.storage.scan_keys()),
+                         sorted(name_digest(f'name {i}') for i in range(5)))
+
+    async def test_migrates_in_background(self):
+        storage = FilePhoneBook(self.folder, fanout=1,
+                                migration_interval=0.01)
+        await storage.open()
+        while storage.migrating:
+            await asyncio.sleep(0.01)
+        await storage.close()
+        self.assertEqual(await storage.get('name 3'), '3')
+        self.assertTrue(os.path.exists(self.path('name 3', 1)))
+
+    def migrate_after(self, method, path: str):
+        '''
+        Moves the flat file of name 0 into its fan-out folder right after
+        the first call of method with path, as the migration thread may
+        '''
+        key = name_digest('name 0')
+        moved = False
+
+        async def call(file_path, *args, **kwargs):
+            nonlocal moved
+            try:
+                return await method(file_path, *args, **kwargs)
+            finally:
+                if file_path == path and not moved:
+                    moved = True
+                    self.storage._move_flat(key)
+        return call
+
+    async def test_delete_during_migration(self):
+        move_flat = self.storage._move_flat
+
+        def link_flat(key):
+            # the delete removes the flat file before the migration does
+            os.link(self.path('name 0', 0), self.path('name 0'))
+
+        for migrate in (move_flat, link_flat):
+            os.makedirs(os.path.dirname(self.path('name 0')), exist_ok=True)
+            if not os.path.exists(self.path('name 0', 0)):
+                with open(self.path('name 0', 0), 'w') as f:
+                    f.write('0\r\n')
+            self.storage._move_flat = migrate
+            with mock.patch('aiofiles.os.remove', self.migrate_after(
+                    aiofiles.os.remove, self.path('name 0'))):
+                await self.storage.delete('name 0')
+            self.storage._move_flat = move_flat
+            with self.assertRaises(FileNotFoundError):
+                await self.storage.get('name 0')
+            self.assertFalse(os.path.exists(self.path('name 0')))
+
+    async def test_get_during_migration(self):
+        self.storage._read = self.migrate_after(self.storage._read,
+                                                self.path('name 0'))
+        self.assertEqual(await self.storage.get('name 0'), '0')
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    async def test_limits_in_flight_requests(self):
+        admission = AdmissionController(max_in_flight=2, max_queued=1,
+                                        queue_timeout=1)
+        self.assertTrue(await admission.enter())
+        self.assertTrue(await admission.enter())
+        queued = asyncio.create_task(admission.enter())
+        await asyncio.sleep(0)
+        self.assertEqual(admission.queued, 1)
+        self.assertFalse(await admission.enter())
+        self.assertEqual(admission.shed['overloaded'], 1)
+
+        admission.leave()
+        self.assertTrue(await queued)
+        self.assertEqual(admission.in_flight, 2)
+        admission.leave()
+        admission.leave()
+        self.assertEqual(admission.in_flight, 0)
+
+    async def test_queue_timeout(self):
+        admission = AdmissionController(max_in_flight=1, max_queued=1,
+                                        queue_timeout=0.01)
+        self.assertTrue(await admission.enter())
+        self.assertFalse(await admission.enter())
+        self.assertEqual(admission.shed['queue_timeout'], 1)
+        self.assertEqual(admission.queued, 0)
+        admission.leave()
+        self.assertEqual(admission.in_flight, 0)
+
+
+class TestBenchmarkHarness(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.agent = FakeRegAgent(approve_ratio=0.5)
+        await self.agent.start()
+
+    async def asyncTearDown(self) -> None:
+        await self.agent.close()
+
+    async def test_fake_agent(self):
+        verdicts = []
+        for i in range(100):
+            response = await ask_permission(
+                f'ОТДОВАЙ name{i} РКСОК/1.0\r\n\r\n',
+                '127.0.0.1', self.agent.port)
+            verdicts.append(await process_permission(response))
+        self.assertTrue(20 < sum(verdicts) < 80)
+        response = await ask_permission(
+            'ОТДОВАЙ name1 РКСОК/1.0\r\n\r\n', '127.0.0.1',
+            self.agent.port)
+        self.assertEqual(await process_permission(response), verdicts[1])
+        self.assertEqual(self.agent.requests, 101)
+
+    async def test_load_generator(self):
+        async def permission(raw_request):
+            return await ask_permission(
+                raw_request, '127.0.0.1', self.agent.port)
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        storage = FilePhoneBook(folder)
+        server = Server('127.0.0.1', 0, storage)
+        listener = await server._start_server()
+        port = listener.sockets[0].getsockname()[1]
+        with mock.patch('response.ask_permission', permission):
+            report = await LoadGenerator(
+                '127.0.0.1', port, concurrency=5, duration=0.3,
+                names=10, seed=1).run()
+        listener.close()
+        await listener.wait_closed()
+
+        self.assertGreater(report['latency']['requests'], 0)
+        self.assertGreater(report['throughput'], 0)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['error_rate'], 0)
+        self.assertIn('НИЛЬЗЯ', report['statuses'])
+        self.assertLessEqual(report['latency']['p50_ms'],
+                             report['latency']['p99_ms'])
+
+    def test_helpers(self):
+        self.assertEqual(parse_mix('get=1,WRITE=2'),
+                         {RequestVerb.GET: 1.0, RequestVerb.WRITE: 2.0})
+        values = list(range(1, 1001))
+        self.assertEqual(percentile(values, 0.5), 500)
+        self.assertEqual(percentile(values, 0.99), 990)
+        self.assertEqual(percentile(values, 0.999), 999)
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def test_render(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests', ('verb',))
+        latency = registry.histogram('latency_seconds', 'Latency',
+                                     buckets=(0.1, 1))
+        requests.inc(verb=RequestVerb.GET)
+        requests.inc(2, verb='say "hi"')
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+        registry.callback('answer', 'Answer', 'gauge', lambda: 42)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{verb="ОТДОВАЙ"} 1',
+            'requests_total{verb="say \\"hi\\""} 2',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+            '# HELP answer Answer',
+            '# TYPE answer gauge',
+            'answer 42',
+        ])
+
+    async def test_metrics_server(self):
+        registry = Registry()
+        registry.gauge('up', 'Up').set(1)
+        server = MetricsServer('127.0.0.1', 0, registry)
+        await server.start()
+        self.addAsyncCleanup(server.close)
+
+        for path, status in (('/metrics', b'200'), ('/other', b'404')):
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', server.port)
+            writer.write(f'GET {path} HTTP/1.1\r\n\r\n'.encode())
+            response = await reader.read()
+            writer.close()
+            self.assertEqual(response.split()[1], status)
+        self.assertTrue(response.endswith(b'not found\n'))
+
+    def test_cache_metrics_under_other_layers(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        cache = CachedStorage(FilePhoneBook(folder))
+        storage = BloomStorage(WriteBehindStorage(cache))
+        self.assertIs(find_layer(storage, CachedStorage), cache)
+        self.assertIsNone(find_layer(storage, SQLitePhoneBook))
+        cache.hits = 7
+        Server('127.0.0.1', 0, storage)._register_metrics()
+        self.assertIn('rksok_storage_cache_requests_total{result="hit"} 7',
+                      REGISTRY.render())
+
+    async def test_serves_when_metrics_port_is_taken(self):
+        taken = socket.socket()
+        taken.bind(('127.0.0.1', 0))
+        taken.listen()
+        self.addCleanup(taken.close)
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        server = Server('127.0.0.1', 0, FilePhoneBook(folder),
+                        metrics_port=taken.getsockname()[1])
+        run = asyncio.create_task(server.run())
+        await asyncio.sleep(0.1)
+        self.assertFalse(run.done())
+        server.stop()
+        await asyncio.wait_for(run, 5)
+
+
+class TestSampledLogging(unittest.IsolatedAsyncioTestCase):
+    def tearDown(self):
+        set_sample_rate(1)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_batching_sink(self):
+        path = os.path.join(self.folder, 'log')
+        handler = logger.add(BatchingSink(path, batch_size=2,
+                                          flush_interval=60),
+                             format='{message}', filter=__name__)
+        logger.info('first')
+        logger.info('second')
+        logger.info('third')
+        logger.remove(handler)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'first\nsecond\nthird\n')
+
+    def test_batching_sink_bounds_and_forks(self):
+        path = os.path.join(self.folder, 'log')
+        sink = BatchingSink(path, batch_size=100, flush_interval=60,
+                            max_records=2)
+        for message in ('first\n', 'second\n', 'dropped\n'):
+            sink.write(message)
+        self.assertEqual(sink.dropped, 1)
+        pid = os.fork()
+        if not pid:
+            sink.write('child\n')
+            sink.stop()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        sink.stop()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'child\nfirst\nsecond\n')
+
+    async def test_logs_sampled_requests_and_failures(self):
+        messages = []
+        handler = logger.add(messages.append, format='{message}',
+                             filter='server')
+        self.addCleanup(logger.remove, handler)
+        server = Server('127.0.0.1', 0, FilePhoneBook(self.folder))
+        set_sample_rate(0)
+        self.assertFalse(sample_request())
+        self.assertFalse(sampled())
+        server.request_answered('addr', RequestVerb.GET,
+                                'НОРМАЛДЫКС РКСОК/1.0\r\n\r\n', 0)
+        server.request_answered('addr', RequestVerb.GET,
+                                'НИЛЬЗЯ РКСОК/1.0\r\nнельзя\r\n\r\n', 0)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('НИЛЬЗЯ', messages[0])
+
+        set_sample_rate(1)
+        self.assertTrue(sample_request())
+        server.request_answered('addr', RequestVerb.GET,
+                                'НОРМАЛДЫКС РКСОК/1.0\r\n\r\n', 0)
+        self.assertEqual(len(messages), 2)
+
+
+class TestSpeculativeGet(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.reading = asyncio.Event()
+        self.storage = mock.MagicMock()
+
+        async def get(name):
+            self.reading.set()
+            return '79842342143'
+        self.storage.get = get
+        self.storage.write = AsyncMock()
+
+    def patch_permission(self, reg_response: str) -> None:
+        async def ask_permission(raw_request):
+            if raw_request.startswith(RequestVerb.GET):
+                # the read has started before the agent answered
+                await asyncio.wait_for(self.reading.wait(), 1)
+            else:
+                self.storage.write.assert_not_called()
+            return reg_response
+        patcher = mock.patch('response.ask_permission', ask_permission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_sends_prefetched_phones_if_approved(self):
+        self.patch_permission('МОЖНА РКСОК/1.0\r\n\r\n')
+        used = SPECULATIVE_READS.get(result='used')
+        response = Response('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n')
+        self.assertEqual(
+            await response.make_response(self.storage, speculative_get=True),
+            'НОРМАЛДЫКС РКСОК/1.0\r\n79842342143\r\n\r\n')
+        self.assertEqual(SPECULATIVE_READS.get(result='used'), used + 1)
+
+    async def test_discards_prefetched_phones_if_denied(self):
+        denial = 'НИЛЬЗЯ РКСОК/1.0\r\nне положено\r\n\r\n'
+        self.patch_permission(denial)
+        discarded = SPECULATIVE_READS.get(result='discarded')
+        response = Response('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n')
+        self.assertEqual(
+            await response.make_response(self.storage, speculative_get=True),
+            denial)
+        self.assertEqual(SPECULATIVE_READS.get(result='discarded'),
+                         discarded + 1)
+
+    async def test_write_waits_for_permission(self):
+        self.patch_permission('МОЖНА РКСОК/1.0\r\n\r\n')
+        response = Response('ЗОПИШИ Petr РКСОК/1.0\r\n79842342143\r\n\r\n')
+        self.assertEqual(
+            await response.make_response(self.storage, speculative_get=True),
+            'НОРМАЛДЫКС РКСОК/1.0\r\n\r\n')
+        self.storage.write.assert_called_once()
+
+
+class TestBloomStorage(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.storage = FilePhoneBook(self.folder)
+        await self.storage.write('John', ['78124445598'])
+        # a write in progress in another process
+        with open(os.path.join(self.folder, name_digest('Petr').hex() +
+                               '.123.abc.tmp'), 'w') as f:
+            f.write('79842342143\r\n')
+        self.bloom = BloomStorage(self.storage, capacity=100,
+                                  rebuild_interval=0)
+        await self.bloom.open()
+
+    async def asyncTearDown(self) -> None:
+        await self.bloom.close()
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add(name_digest(f'name{i}'))
+        self.assertTrue(all(name_digest(f'name{i}') in bloom_filter
+                            for i in range(1000)))
+        false_positives = sum(name_digest(f'other{i}') in bloom_filter
+                              for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    async def test_scan_keys_skips_temporary_files(self):
+        self.assertEqual(await self.storage.scan_keys(),
+                         [name_digest('John')])
+
+    async def test_answers_absent_names_without_storage(self):
+        with mock.patch.object(self.storage, 'get') as get, \
+                mock.patch.object(self.storage, 'delete') as delete:
+            with self.assertRaises(FileNotFoundError):
+                await self.bloom.get('Petr')
+            with self.assertRaises(FileNotFoundError):
+                await self.bloom.delete('Petr')
+            get.assert_not_called()
+            delete.assert_not_called()
+        self.assertEqual(await self.bloom.get('John'), '78124445598')
+
+    async def test_write_and_rebuild(self):
+        await self.bloom.write('Petr', ['79842342143'])
+        self.assertEqual(await self.bloom.get('Petr'), '79842342143')
+        await self.bloom.delete('Petr')
+        self.assertIn(name_digest('Petr'), self.bloom.filter)
+        await self.bloom.rebuild()
+        self.assertNotIn(name_digest('Petr'), self.bloom.filter)
+        self.assertIn(name_digest('John'), self.bloom.filter)
+
+    async def test_rebuild_during_write(self):
+        written = asyncio.Event()
+        write = self.storage.write
+
+        async def blocked_write(*args):
+            await written.wait()
+            await write(*args)
+
+        with mock.patch.object(self.storage, 'write', blocked_write):
+            writing = asyncio.create_task(
+                self.bloom.write('Petr', ['79842342143']))
+            await asyncio.sleep(0)
+            await self.bloom.rebuild()
+            written.set()
+            await writing
+        self.assertEqual(await self.bloom.get('Petr'), '79842342143')
+        self.assertFalse(self.bloom._in_flight)
+
+
+class TestWriteBehindStorage(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.storage = FilePhoneBook(folder)
+        self.storage.write = mock.Mock(wraps=self.storage.write)
+        self.buffer = WriteBehindStorage(self.storage, flush_interval=60,
+                                         max_pending=3)
+
+    async def test_coalesces_writes_to_one_name(self):
+        for phone in ('71111111111', '72222222222', '73333333333'):
+            await self.buffer.write('John', [phone])
+        self.assertEqual(await self.buffer.get('John'), '73333333333')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.get('John')
+
+        await self.buffer.flush()
+        self.storage.write.assert_called_once_with('John', ['73333333333'])
+        self.assertEqual(await self.storage.get('John'), '73333333333')
+        self.assertEqual(len(self.buffer), 0)
+
+    async def test_flushes_when_enough_names_are_pending(self):
+        for name in ('John', 'Petr', 'Ivan'):
+            await self.buffer.write(name, ['78124445598'])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.storage.write.call_count, 3)
+        self.assertEqual(await self.storage.get('Ivan'), '78124445598')
+
+    async def test_delete(self):
+        await self.buffer.write('John', ['78124445598'])
+        await self.buffer.delete('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.buffer.get('John')
+        with self.assertRaises(FileNotFoundError):
+            await self.buffer.delete('John')
+        await self.buffer.flush()
+        self.storage.write.assert_not_called()
+
+    async def test_close_flushes_everything(self):
+        await self.buffer.open()
+        await self.buffer.write('John', ['78124445598'])
+        await self.buffer.close()
+        self.assertEqual(await self.storage.get('John'), '78124445598')
+
+
+class TestCluster(unittest.IsolatedAsyncioTestCase):
+    nodes = ()
+
+    async def start(self, replicas: int = 0, secret: str = 'secret') -> None:
+        ports = []
+        for _ in range(3):
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                ports.append(sock.getsockname()[1])
+        self.addresses = [f'127.0.0.1:{port}' for port in ports]
+        self.folders = [tempfile.mkdtemp() for _ in self.addresses]
+        for folder in self.folders:
+            self.addCleanup(shutil.rmtree, folder)
+        self.nodes = [
+            ClusterStorage(FilePhoneBook(folder), self.addresses, address,
+                           secret, replicas=replicas, timeout=1)
+            for folder, address in zip(self.folders, self.addresses)]
+        for node in self.nodes:
+            await node.open()
+
+    async def asyncTearDown(self) -> None:
+        for node in self.nodes:
+            await node.close()
+
+    def node_of(self, name: str, i: int = 0) -> int:
+        address = self.nodes[0].ring.owners(name_digest(name), i + 1)[i]
+        return self.addresses.index(address)
+
+    def test_ring_spreads_names(self):
+        ring = HashRing(['a:1', 'b:1', 'c:1'])
+        counts = {}
+        for i in range(3000):
+            owners = ring.owners(name_digest(f'name{i}'), 2)
+            self.assertEqual(len(set(owners)), 2)
+            counts[owners[0]] = counts.get(owners[0], 0) + 1
+        self.assertTrue(all(count > 500 for count in counts.values()))
+        self.assertEqual(ring.owners(name_digest('John'), 5),
+                         HashRing(['c:1', 'a:1', 'b:1']).owners(
+                             name_digest('John'), 5)[:3])
+
+    async def test_names_are_kept_by_their_owners(self):
+        await self.start()
+        names = [f'name{i}' for i in range(20)]
+        for i, name in enumerate(names):
+            await self.nodes[i % 3].write(name, [f'7984234{i:04}'])
+        for i, name in enumerate(names):
+            owner = self.node_of(name)
+            self.assertEqual(await self.nodes[(i + 1) % 3].get(name),
+                             f'7984234{i:04}')
+            self.assertEqual(
+                [name_digest(name) in await node.scan_keys()
+                 for node in self.nodes],
+                [j == owner for j in range(3)])
+        await self.nodes[0].delete(names[1])
+        for node in self.nodes:
+            with self.assertRaises(FileNotFoundError):
+                await node.get(names[1])
+            with self.assertRaises(FileNotFoundError):
+                await node.delete(names[1])
+
+    async def test_reads_fall_back_to_replica(self):
+        await self.start(replicas=1)
+        name = 'John'
+        owner, replica = self.node_of(name), self.node_of(name, 1)
+        other = ({0, 1, 2} - {owner, replica}).pop()
+        await self.nodes[other].write(name, ['78124445598'])
+        self.assertEqual(await self.nodes[replica].scan_keys(),
+                         [name_digest(name)])
+        await self.nodes[owner].close()
+        self.assertEqual(await self.nodes[other].get(name), '78124445598')
+
+    async def test_refuses_calls_without_secret(self):
+        await self.start()
+        with self.assertRaises(ValueError):
+            ClusterStorage(FilePhoneBook(self.folders[0]), self.addresses,
+                           self.addresses[0], '')
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        intruder = ClusterStorage(FilePhoneBook(folder),
+                                  self.addresses, self.addresses[0], 'guess')
+        name = next(f'name{i}' for i in range(100)
+                    if self.node_of(f'name{i}') != 0)
+        with self.assertRaises(ConnectionError):
+            await intruder.write(name, ['78124445598'])
+        await intruder.close()
+        self.assertEqual(await self.nodes[self.node_of(name)].scan_keys(), [])
+
+
+class TestBulk(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.source = FilePhoneBook(self.folder)
+        self.names = [f'name{i}' for i in range(50)]
+        for i, name in enumerate(self.names):
+            await self.source.write(name, [f'7984234{i:04}', '02'])
+        self.dump = os.path.join(self.folder, 'dump')
+        self.checkpoint = os.path.join(self.folder, 'checkpoint')
+        self.target = SQLitePhoneBook(os.path.join(self.folder, 'db'))
+
+    async def asyncTearDown(self) -> None:
+        await self.target.close()
+
+    def failing_after(self, method, calls: int):
+        done = 0
+
+        async def call(*args):
+            nonlocal done
+            done += 1
+            if done > calls:
+                raise OSError('disk failure')
+            return await method(*args)
+        return call
+
+    async def assert_copied(self):
+        for i, name in enumerate(self.names):
+            self.assertEqual(await self.target.get(name),
+                             f'7984234{i:04}\r\n02')
+
+    async def test_export_and_import(self):
+        progress = await export_storage(self.source, self.dump,
+                                        parallelism=8)
+        self.assertEqual(progress.done, 50)
+        progress = await import_dump(self.target, self.dump, parallelism=8)
+        self.assertEqual(progress.done, 50)
+        await self.assert_copied()
+
+    async def test_resumes_export(self):
+        with mock.patch.object(
+                self.source, 'get_key',
+                self.failing_after(self.source.get_key, 30)):
+            with self.assertRaises(OSError):
+                await export_storage(self.source, self.dump, parallelism=8,
+                                     checkpoint_path=self.checkpoint,
+                                     checkpoint_every=10)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['done'], 16)
+        progress = await export_storage(self.source, self.dump,
+                                        parallelism=8,
+                                        checkpoint_path=self.checkpoint,
+                                        checkpoint_every=10)
+        self.assertEqual(progress.done, 50)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        with open(self.dump, 'rb') as f:
+            self.assertEqual(len(list(iter_records(f))), 50)
+        await import_dump(self.target, self.dump)
+        await self.assert_copied()
+
+    async def test_resumes_import(self):
+        await export_storage(self.source, self.dump)
+        with mock.patch.object(
+                self.target, 'write_key',
+                self.failing_after(self.target.write_key, 25)):
+            with self.assertRaises(OSError):
+                await import_dump(self.target, self.dump, parallelism=10,
+                                  checkpoint_path=self.checkpoint,
+                                  checkpoint_every=10)
+        progress = await import_dump(self.target, self.dump,
+                                     parallelism=10,
+                                     checkpoint_path=self.checkpoint,
+                                     checkpoint_every=10)
+        self.assertEqual(progress.done, 50)
+        await self.assert_copied()
+
+    async def test_import_stops_at_torn_record(self):
+        await export_storage(self.source, self.dump)
+        with open(self.dump, 'ab') as f:
+            f.write(b'torn record')
+        with self.assertRaises(ValueError):
+            await import_dump(self.target, self.dump)
+        await self.assert_copied()
+
+
+class TestDiagnostics(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.messages = []
+        handler = logger.add(self.messages.append, format='{message}',
+                             filter='diagnostics')
+        self.addCleanup(logger.remove, handler)
+
+    async def start(self, **kwargs) -> Diagnostics:
+        kwargs = {'profiler': False, 'slow_callback': None,
+                  'latency_budget': None, **kwargs}
+        diagnostics = Diagnostics(**kwargs)
+        metrics_server = MetricsServer('127.0.0.1', 0, Registry())
+        await metrics_server.start()
+        self.addAsyncCleanup(metrics_server.close)
+        diagnostics.start(metrics_server)
+        self.addAsyncCleanup(diagnostics.close)
+        self.port = metrics_server.port
+        return diagnostics
+
+    async def get(self, path: str) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.port)
+        writer.write(f'GET {path} HTTP/1.1\r\n\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def test_profiler(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        diagnostics = await self.start(profiler=True, profile_dir=folder)
+        self.assertTrue((await self.get('/debug/profile')).endswith(
+            b'profiling\n'))
+        self.assertTrue(diagnostics.profiler.running)
+        await self.get('/debug/profile?stop')
+        self.assertFalse(diagnostics.profiler.running)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        await asyncio.sleep(0.01)
+        self.assertTrue(diagnostics.profiler.running)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        await asyncio.sleep(0.01)
+        self.assertFalse(diagnostics.profiler.running)
+        self.assertEqual(len(os.listdir(folder)), 2)
+
+    async def test_slow_callbacks(self):
+        await self.start(slow_callback=0.01)
+        slow_callbacks = SLOW_CALLBACKS.get()
+        asyncio.get_running_loop().call_soon(time.sleep, 0.05)
+        await asyncio.sleep(0.01)
+        self.assertEqual(SLOW_CALLBACKS.get(), slow_callbacks + 1)
+        self.assertTrue(any('took' in message for message in self.messages))
+
+    async def test_latency_budget(self):
+        self.assertFalse(hasattr(watched('ask_permission'), '_call'))
+        await self.start(latency_budget=0.05)
+
+        async def stalled_agent(*args):
+            await asyncio.sleep(1)
+
+        with mock.patch('regagent._call_reg_agent', stalled_agent):
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    ask_permission('ОТДОВАЙ Petr РКСОК/1.0\r\n\r\n',
+                                   single_flight=False), 0.2)
+        self.assertEqual(len(self.messages), 1)
+        self.assertIn('ask_permission has been running', self.messages[0])
+        self.assertIn('in stalled_agent', self.messages[0])
+        self.assertIn('await asyncio.sleep(1)', self.messages[0])
+
+
+class TestSnapshot(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.snapshot_path = os.path.join(self.folder, 'snapshot')
+        self.log_path = os.path.join(self.folder, 'phonebook.log')
+        self.verdicts = VerdictCache(ttl_approved=60)
+        self.storage = await self.start()
+        for i in range(10):
+            await self.storage.write(f'name {i}', [str(i)])
+        await self.storage.delete('name 9')
+        self.verdicts.put('a', 'МОЖНА РКСОК/1.0\r\n\r\n')
+        await self.storage.close()
+        await self.snapshotter.close()
+
+    async def start(self, restored: bool | None = None) -> BloomStorage:
+        self.log = LogPhoneBook(self.log_path, compaction_interval=0)
+        self.cache = CachedStorage(self.log)
+        storage = BloomStorage(self.cache, capacity=100, rebuild_interval=0)
+        self.snapshotter = Snapshotter(storage, self.snapshot_path,
+                                       interval=0,
+                                       verdict_cache=self.verdicts)
+        if restored is not None:
+            self.assertEqual(await self.snapshotter.restore(), restored)
+        await storage.open()
+        return storage
+
+    def test_encoding(self):
+        state = {'version': 1, 'array': b'\x00\xff', 'nested': [b'', 'x']}
+        data = encode_snapshot(state)
+        self.assertEqual(decode_snapshot(data), state)
+        with self.assertRaises(ValueError):
+            decode_snapshot(data[:-1] + bytes([data[-1] ^ 1]))
+
+    async def test_warm_start(self):
+        self.verdicts.clear()
+        with mock.patch.object(LogPhoneBook, '_load') as load, \
+                mock.patch.object(LogPhoneBook, 'scan_keys') as scan_keys:
+            storage = await self.start(restored=True)
+            load.assert_not_called()
+            scan_keys.assert_not_called()
+        self.assertEqual(len(self.log), 9)
+        self.assertEqual(len(self.cache), 9)
+        self.assertIsNotNone(storage.filter)
+        self.assertEqual(self.verdicts.get('a'), 'МОЖНА РКСОК/1.0\r\n\r\n')
+        with mock.patch.object(self.log, 'get_key') as get_key:
+            self.assertEqual(await storage.get('name 1'), '1')
+            with self.assertRaises(FileNotFoundError):
+                await storage.get('John')
+            get_key.assert_not_called()
+        self.assertEqual(await storage.get('name 5'), '5')
+        await storage.close()
+
+    async def test_storage_changed_since(self):
+        offline = LogPhoneBook(self.log_path, compaction_interval=0)
+        await offline.write('John', ['78124445598'])
+        await offline.close()
+        with mock.patch.object(LogPhoneBook, '_load') as load:
+            storage = await self.start(restored=True)
+            load.assert_not_called()
+        self.assertEqual(len(self.log), 10)
+        self.assertEqual(len(self.cache), 9)
+        self.assertEqual(await storage.get('John'), '78124445598')
+        await storage.close()
+
+    async def test_discards_corrupted_and_stale(self):
+        with open(self.snapshot_path, 'r+b') as f:
+            f.seek(50)
+            f.write(b'garbage')
+        discarded = DISCARDED.get(reason='corrupted')
+        storage = await self.start(restored=False)
+        self.assertEqual(DISCARDED.get(reason='corrupted'), discarded + 1)
+        self.assertEqual(await storage.get('name 1'), '1')
+        await storage.close()
+        await self.snapshotter.close()
+
+        discarded = DISCARDED.get(reason='stale')
+        with mock.patch('snapshot.time.time', return_value=time.time() + 1e6):
+            storage = await self.start(restored=False)
+        self.assertEqual(DISCARDED.get(reason='stale'), discarded + 1)
+        self.assertEqual(len(self.cache), 0)
+        await storage.close()
+
+    async def test_file_storage_fingerprint(self):
+        storage = FilePhoneBook(os.path.join(self.folder, 'phonebook'),
+                                fanout=1)
+        await storage.write('John', ['78124445598'])
+        state = await storage.snapshot(clean=True)
+        self.assertTrue(await storage.restore(state))
+        await storage.write('Petr', ['02'])
+        self.assertFalse(await storage.restore(state))
+
+    async def test_sqlite_snapshot_after_close(self):
+        path = os.path.join(self.folder, 'phonebook.sqlite3')
+        storage = SQLitePhoneBook(path)
+        await storage.write('John', ['78124445598'])
+        await storage.close()
+        snapshotter = Snapshotter(storage, self.snapshot_path, interval=0)
+        await snapshotter.close()
+        self.assertTrue(read_snapshot(self.snapshot_path)['clean'])
+
+        storage = SQLitePhoneBook(path)
+        snapshotter = Snapshotter(storage, self.snapshot_path, interval=0)
+        self.assertTrue(await snapshotter.restore())
+        self.assertTrue(await storage.restore(
+            read_snapshot(self.snapshot_path)['storage']))
+        await storage.close()
+
+    async def test_saved_when_storage_fails_to_close(self):
+        os.remove(self.snapshot_path)
+        storage = FilePhoneBook(os.path.join(self.folder, 'phonebook'))
+        storage.close = AsyncMock(side_effect=OSError('disk failure'))
+        server = Server('127.0.0.1', 0, storage, snapshotter=Snapshotter(
+            storage, self.snapshot_path, interval=0))
+        run = asyncio.create_task(server.run())
+        await asyncio.sleep(0.1)
+        server.stop()
+        await asyncio.wait_for(run, 5)
+        self.assertFalse(read_snapshot(self.snapshot_path)['clean'])
+
+    def test_verdicts(self):
+        verdicts = VerdictCache()
+        entries = self.verdicts.snapshot()
+        entries.append(['b', 'МОЖНА РКСОК/1.0\r\n\r\n', time.time() - 1])
+        verdicts.restore(entries)
+        self.assertEqual(len(verdicts), 1)
+        self.assertEqual(verdicts.get('a'), 'МОЖНА РКСОК/1.0\r\n\r\n')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+import os
+import signal
+import time
+from typing import Callable
+from conf import logger, WORKER_RESTART_DELAY, SHUTDOWN_TIMEOUT
+
+
+class WorkerSupervisor:
+    '''
+    Forks worker processes, each of them runs its own Server
+    on the same port (the kernel spreads connections between them
+    thanks to SO_REUSEPORT).
+    serve receives the index of the worker, a restarted worker
+    keeps the index of the one it replaces.
+    Crashed workers are restarted, SIGTERM or SIGINT sent to the supervisor
+    is forwarded to all workers, which finish their requests and exit
+    '''
+    def __init__(self, workers: int, serve: Callable[[int], None],
+                 restart_delay: float = WORKER_RESTART_DELAY,
+                 # leave the workers time to finish their own shutdown
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT + 5) -> None:
+        self._workers = workers
+        self._serve = serve
+        self._restart_delay = restart_delay
+        self._shutdown_timeout = shutdown_timeout
+        # worker index by pid
+        self._pids = {}
+        self._stopping = False
+        self._stop_deadline = None
+
+    @property
+    def pids(self) -> set:
+        return set(self._pids)
+
+    def _spawn(self, index: int) -> int:
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = index
+            logger.info(f'Started worker {index} as {pid}')
+            return pid
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            self._serve(index)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception(f'Worker {os.getpid()} crashed')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def stop(self, *args) -> None:
+        '''
+        Forwards the shutdown to every worker
+        '''
+        if self._stopping:
+            return
+        self._stopping = True
+        self._stop_deadline = time.monotonic() + self._shutdown_timeout
+        for pid in self._pids:
+            self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self) -> list:
+        '''
+        Collects exited workers,
+        returns their (pid, index, exit code) triples
+        '''
+        exited = []
+        while self._pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._pids.clear()
+                break
+            if pid == 0:
+                break
+            exited.append((pid, self._pids.pop(pid, None),
+                           os.waitstatus_to_exitcode(status)))
+        return exited
+
+    def run(self, poll_interval: float = 0.1) -> None:
+        '''
+        Starts the workers and supervises them until all of them exit
+        after a shutdown
+        '''
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+        for index in range(self._workers):
+            self._spawn(index)
+
+        while self._pids:
+            time.sleep(poll_interval)
+            for pid, index, exit_code in self._reap():
+                if self._stopping:
+                    logger.info(f'Worker {pid} stopped')
+                    continue
+                logger.error(f'Worker {pid} exited with code {exit_code}, '
+                             f'restarting in {self._restart_delay}s')
+                time.sleep(self._restart_delay)
+                if not self._stopping:
+                    self._spawn(index)
+            if self._stopping and time.monotonic() > self._stop_deadline:
+                for pid in self._pids:
+                    logger.error(f'Worker {pid} did not stop in time, '
+                                 'killing it')
+                    self._signal(pid, signal.SIGKILL)
+                self._stop_deadline = float('inf')
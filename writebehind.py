@@ -0,0 +1,177 @@
+import asyncio
+from conf import logger, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_PENDING
+from metrics import REGISTRY
+from storage import Storage, format_phones, name_digest
+
+
+PENDING = REGISTRY.gauge(
+    'rksok_write_behind_pending', 'Names with a write not flushed yet')
+COALESCED = REGISTRY.counter(
+    'rksok_write_behind_coalesced_total',
+    'Writes replaced by a later write to the same name before a flush')
+FLUSHED = REGISTRY.counter(
+    'rksok_write_behind_flushed_total', 'Writes flushed to the storage')
+
+
+class WriteBehindStorage(Storage):
+    '''
+    Buffers writes in front of any Storage and acknowledges them
+    right away. Only the last pending value of a name is written,
+    pending values are flushed every flush_interval seconds or as soon
+    as max_pending names are waiting, one batch at a time, so writes
+    to the same name reach the storage in order.
+    Reads see the pending values, deletes wait for the batch
+    in flight and drop the pending value, close() flushes everything
+    '''
+    def __init__(self, storage: Storage,
+                 flush_interval: float = WRITE_BEHIND_INTERVAL,
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING) -> None:
+        self._storage = storage
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending = {}
+        # the batch being written to the storage
+        self._flushing = {}
+        self._flush_lock = None
+        self._flush_needed = None
+        self._flusher = None
+        self._flushes = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def inner(self) -> Storage:
+        return self._storage
+
+    def _lock(self) -> asyncio.Lock:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def get(self, name: str) -> str:
+        '''
+        Returns the latest accepted phones of a given name
+        '''
+        for phones in (self._pending.get(name), self._flushing.get(name)):
+            if phones is not None:
+                return format_phones(phones)
+        return await self._storage.get(name)
+
+    async def write(self, name: str, phones: list) -> None:
+        '''
+        Buffers the phones, replacing a pending write of the same name
+        '''
+        if self._pending.pop(name, None) is not None:
+            COALESCED.inc()
+        self._pending[name] = list(phones)
+        PENDING.set(len(self._pending))
+        if len(self._pending) >= self._max_pending:
+            if self._flush_needed is not None:
+                self._flush_needed.set()
+            else:
+                task = asyncio.ensure_future(self.flush())
+                self._flushes.add(task)
+                task.add_done_callback(self._flushes.discard)
+
+    async def delete(self, name: str) -> None:
+        '''
+        Drops the pending write of a given name and deletes it
+        from the storage after the batch in flight is written
+        '''
+        async with self._lock():
+            pending = self._pending.pop(name, None)
+            PENDING.set(len(self._pending))
+            try:
+                await self._storage.delete(name)
+            except FileNotFoundError:
+                if pending is None:
+                    raise
+
+    async def _flush_one(self, name: str, phones: list) -> None:
+        try:
+            await self._storage.write(name, phones)
+        except Exception:
+            logger.exception(f'Could not flush the write of {name!r}, '
+                             'it will be retried')
+            return
+        del self._flushing[name]
+        FLUSHED.inc()
+
+    async def flush(self) -> None:
+        '''
+        Writes the pending values to the storage
+        '''
+        async with self._lock():
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            PENDING.set(0)
+            try:
+                await asyncio.gather(
+                    *[self._flush_one(name, phones)
+                      for name, phones in list(self._flushing.items())])
+            finally:
+                # values that failed or were cancelled are kept
+                # unless a newer value has come meanwhile
+                for name, phones in self._flushing.items():
+                    self._pending.setdefault(name, phones)
+                self._flushing = {}
+                PENDING.set(len(self._pending))
+
+    async def _run_flusher(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(),
+                                       self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    async def scan_keys(self) -> list:
+        keys = set(await self._storage.scan_keys())
+        keys.update(name_digest(name)
+                    for name in (*self._pending, *self._flushing))
+        return list(keys)
+
+    async def snapshot(self, clean: bool) -> dict:
+        return {'storage': await self._storage.snapshot(clean)}
+
+    async def restore(self, state: dict | None) -> bool:
+        if state is None:
+            return False
+        return await self._storage.restore(state['storage'])
+
+    async def open(self) -> None:
+        '''
+        Opens the storage and starts the periodic flushes
+        '''
+        await self._storage.open()
+        if self._flusher is None:
+            self._flush_needed = asyncio.Event()
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def close(self) -> None:
+        '''
+        Stops the periodic flushes, flushes everything and closes
+        the storage
+        '''
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+            self._flush_needed = None
+        await self.flush()
+        while self._pending:
+            # writes that failed are retried once more
+            failed = len(self._pending)
+            await self.flush()
+            if len(self._pending) >= failed:
+                logger.error(f'{failed} writes could not be flushed '
+                             'on shutdown')
+                break
+        await self._storage.close()